@@ -0,0 +1,7 @@
+"""Benchmarks for the clustering pipeline.
+
+Synthetic FASTQ files with UID tagged reads can be created with
+:func:`pyrates.bench.data.generate` and processed with
+:func:`pyrates.bench.runner.run`. Use ``python -m pyrates.bench --help``
+for the command-line interface.
+"""
@@ -0,0 +1,6 @@
+"""Run benchmarks from the command-line."""
+
+from pyrates.bench.runner import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Generation of synthetic sequencing data.
+"""
+
+import random
+
+import pyrates.utils as utils
+
+ALPHABET = 'ACGT'
+QUALITIES = '5?DI'
+
+def _mutate(sequence, error_rate, n_rate, rand):
+    """Introduce substitutions and uncalled bases into a sequence."""
+    if error_rate == 0 and n_rate == 0:
+        return sequence
+    bases = list(sequence)
+    for (i, base) in enumerate(bases):
+        draw = rand.random()
+        if draw < n_rate:
+            bases[i] = 'N'
+        elif draw < n_rate + error_rate:
+            bases[i] = rand.choice(ALPHABET.replace(base, ''))
+    return ''.join(bases)
+
+def generate(file_name, molecules=1000, duplicates=5, id_length=8, adapter='GACT',
+             read_length=100, length_sd=10, uid_error=0.01, n_rate=0.001, seq_error=0.001,
+             seed=42):
+    """Create a FASTQ file with reads from UID labelled molecules.
+
+    Each read consists of the first half of its molecule's UID, the adapter, the read
+    sequence, the reversed adapter and the second half of the UID. Base qualities are
+    chosen at random, except for *N*, which always has the lowest quality. The output
+    is determined by the parameters and `seed`. Reads are written in random order.
+
+    Args:
+        file_name (:obj:`str`): Name of output file. Files with a *.gz* extension are
+            compressed.
+        molecules (:obj:`int`, optional): Number of distinct molecules.
+        duplicates (:obj:`float`, optional): Average number of reads per molecule.
+        id_length (:obj:`int`, optional): Length of UID sequence at beginning/end of read.
+        adapter (:obj:`str`, optional): Adapter sequence.
+        read_length (:obj:`int`, optional): Average length of the sequence between adapters.
+        length_sd (:obj:`float`, optional): Standard deviation of read lengths.
+        uid_error (:obj:`float`, optional): Probability of a substitution at each UID position.
+        n_rate (:obj:`float`, optional): Probability of an *N* at each position of a read.
+        seq_error (:obj:`float`, optional): Probability of a substitution at each position
+            of the read sequence.
+        seed (:obj:`int`, optional): Seed for the random number generator.
+
+    Returns:
+        :obj:`int`: The number of reads written.
+    """
+    rand = random.Random(seed)
+    reads = []
+    for _ in range(molecules):
+        uid = ''.join(rand.choice(ALPHABET) for _ in range(2*id_length))
+        length = max(1, int(round(rand.gauss(read_length, length_sd))))
+        insert = ''.join(rand.choice(ALPHABET) for _ in range(length))
+        for _ in range(rand.randint(1, max(1, int(round(2*duplicates)) - 1))):
+            read_uid = _mutate(uid, uid_error, n_rate, rand)
+            read = read_uid[:id_length] + adapter + _mutate(insert, seq_error, n_rate, rand) + \
+                   adapter[::-1] + read_uid[id_length:]
+            reads.append(read)
+    rand.shuffle(reads)
+    output_fun = utils.smart_open(file_name)
+    with output_fun(file_name, 'wt') as fastq:
+        for (i, read) in enumerate(reads):
+            qual = ''.join('#' if base == 'N' else rand.choice(QUALITIES) for base in read)
+            fastq.write("@synthetic_%d\n%s\n+\n%s\n" % (i, read, qual))
+    return len(reads)
@@ -0,0 +1,193 @@
+"""Measure the performance of the clustering pipeline.
+"""
+
+import argparse
+import concurrent.futures
+import functools
+import os
+import os.path
+import resource
+import shutil
+import tempfile
+import time
+
+import pyrates.clustering as clust
+import pyrates.consensus as cons
+import pyrates.parallel as par
+import pyrates.sequence as pseq
+import pyrates.utils as utils
+from pyrates.bench import data
+from pyrates.cmd_consensus import UID_INDEX
+
+## methods for which timings are recorded while clustering
+STAGES = [(cons.Consensus, 'update'), (pseq.GroupedSequenceStore, 'search'),
+          (pseq.PigeonholeStore, 'search'), (par.PartitionedSequenceStore, 'search'),
+          (par.PartitionedSequenceStore, 'prefetch')]
+
+def _timed(method, timing):
+    """Wrap a method to accumulate the number of calls and time spent in `timing`."""
+    @functools.wraps(method)
+    def wrapper(*args, **kw):
+        started = time.time()
+        try:
+            return method(*args, **kw)
+        finally:
+            timing[0] += 1
+            timing[1] += time.time() - started
+    return wrapper
+
+def run(input_file, id_length=8, adapter='GACT', output_file=None, consensus=cons.Consensus,
+        **kw):
+    """Cluster reads from a FASTQ file and record performance statistics.
+
+    Timings are recorded for the whole of :meth:`pyrates.clustering.Clustering.from_fastq`
+    and :meth:`pyrates.clustering.Clustering.write` as well as for the consensus updates
+    and UID searches carried out during clustering. The instrumentation of the latter
+    adds some overhead, so the overall throughput is slightly lower than without it.
+    With several workers, the time spent waiting for batches of searches is recorded
+    for :meth:`pyrates.parallel.PartitionedSequenceStore.prefetch` and the CPU time
+    used by the worker processes is reported separately.
+
+    Args:
+        input_file (:obj:`str`): Name of input file.
+        id_length (:obj:`int`, optional): Length of UID sequence at beginning/end of read.
+        adapter (:obj:`str`, optional): Adapter sequence.
+        output_file (:obj:`str`, optional): File name for the consensus sequences. If this
+            is `None` a temporary file is used.
+        consensus (:obj:`type`, optional): Class used to represent consensus sequences.
+
+        Additional named arguments are passed to
+        :meth:`pyrates.clustering.Clustering.from_fastq`.
+
+    Returns:
+        :obj:`dict`: Number of *reads* and *clusters*, throughput in *reads_per_second*,
+        peak resident set size of this process in MB (*max_rss*), CPU seconds used by
+        worker processes during clustering (*worker_cpu*) and (calls, seconds) for each
+        entry in *stages*.
+    """
+    stages = {}
+    patched = []
+    for (cls, name) in [(consensus, 'update')] + STAGES[1:]:
+        label = '%s.%s' % (cls.__name__, name)
+        if label in stages:
+            continue
+        stages[label] = [0, 0.0]
+        patched.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, _timed(getattr(cls, name), stages[label]))
+    try:
+        ## worker processes have terminated by the time from_fastq returns
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.time()
+        seq = clust.Clustering.from_fastq(input_file, id_length, adapter, consensus=consensus,
+                                          **kw)
+        stages['Clustering.from_fastq'] = [1, time.time() - started]
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        worker_cpu = usage.ru_utime + usage.ru_stime - children.ru_utime - children.ru_stime
+    finally:
+        for (cls, name, method) in patched:
+            if method is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, method)
+    tmp_dir = None
+    if output_file is None:
+        tmp_dir = tempfile.mkdtemp()
+        output_file = os.path.join(tmp_dir, 'consensus.fastq')
+    try:
+        started = time.time()
+        seq.write(output_file)
+        stages['Clustering.write'] = [1, time.time() - started]
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    reads = sum(seq.stats['reads'])
+    return {
+        'reads':reads,
+        'clusters':len(seq),
+        'reads_per_second':reads/max(stages['Clustering.from_fastq'][1], 1e-9),
+        'max_rss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0,
+        'worker_cpu':worker_cpu,
+        'stages':dict((label, tuple(timing)) for (label, timing) in stages.items()
+                      if timing[0] > 0)
+    }
+
+def main():
+    """Entrypoint for command-line interface
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark consensus calling on synthetic data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('--input', '-i', metavar='FILE',
+                        help='Use existing FASTQ file instead of generating synthetic data.')
+    parser.add_argument('--keep', metavar='FILE',
+                        help='Keep generated input in this file.')
+    parser.add_argument('--molecules', '-m', default=10000, type=int,
+                        help='Number of distinct molecules.')
+    parser.add_argument('--duplicates', '-d', default=5, type=float,
+                        help='Average number of reads per molecule.')
+    parser.add_argument('--id-length', '-b', metavar='LENGTH', default=8, type=int,
+                        help='Length of unique identifier at start of read.')
+    parser.add_argument('--adapter', '-a', default='GACT', help='Adapter sequence.')
+    parser.add_argument('--read-length', '-r', default=100, type=int,
+                        help='Average read length.')
+    parser.add_argument('--length-sd', default=10, type=float,
+                        help='Standard deviation of read lengths.')
+    parser.add_argument('--uid-error', default=0.01, type=float,
+                        help='Probability of a substitution at each UID position.')
+    parser.add_argument('--n-rate', default=0.001, type=float,
+                        help='Probability of an N at each position.')
+    parser.add_argument('--seq-error', default=0.001, type=float,
+                        help='Probability of a substitution at each position of the read.')
+    parser.add_argument('--seed', default=42, type=int, help='Random seed.')
+    parser.add_argument('--id-tolerance', '-t', default=5, type=int,
+                        help='Maximum number of differences between IDs allowed.')
+    parser.add_argument('--prefix-length', '-p', metavar='PREFIX', default=5, type=int,
+                        help='Length of UID prefix to use in read clustering.')
+    parser.add_argument('--workers', '-w', default=1, type=int,
+                        help='Number of worker processes to use.')
+    parser.add_argument('--packed-uids', action='store_true', help='Store UIDs in packed form.')
+    parser.add_argument('--uid-index', choices=sorted(UID_INDEX), default='composition',
+                        help='Data structure used to search for similar UIDs.')
+    parser.add_argument('--numpy', action='store_true',
+                        help='Use NumPy arrays to compute consensus sequences.')
+    args = parser.parse_args()
+    if args.numpy and cons.np is None:
+        parser.error('--numpy requires NumPy to be installed')
+    logger = utils.get_logger('pyrates', 'INFO', [utils.console_handler()])
+
+    tmp_dir = None
+    input_file = args.input
+    try:
+        if input_file is None:
+            input_file = args.keep
+            if input_file is None:
+                tmp_dir = tempfile.mkdtemp()
+                input_file = os.path.join(tmp_dir, 'synthetic.fastq')
+            started = time.time()
+            ## the reads are generated in memory, in a separate process so that this
+            ## doesn't count towards the peak memory usage of the clustering
+            with concurrent.futures.ProcessPoolExecutor(1) as executor:
+                count = executor.submit(data.generate, input_file, molecules=args.molecules,
+                                        duplicates=args.duplicates, id_length=args.id_length,
+                                        adapter=args.adapter, read_length=args.read_length,
+                                        length_sd=args.length_sd, uid_error=args.uid_error,
+                                        n_rate=args.n_rate, seq_error=args.seq_error,
+                                        seed=args.seed).result()
+            logger.info('Generated %d reads in %.1f s', count, time.time() - started)
+        stats = run(input_file, id_length=args.id_length, adapter=args.adapter,
+                    threshold=args.id_tolerance, prefix=args.prefix_length,
+                    workers=args.workers, packed=args.packed_uids,
+                    index=UID_INDEX[args.uid_index],
+                    consensus=cons.ArrayConsensus if args.numpy else cons.Consensus)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    print("reads\t%d" % stats['reads'])
+    print("clusters\t%d" % stats['clusters'])
+    print("reads/s\t%.1f" % stats['reads_per_second'])
+    print("peak RSS (MB)\t%.1f" % stats['max_rss'])
+    print("worker CPU (s)\t%.3f" % stats['worker_cpu'])
+    for label in sorted(stats['stages']):
+        calls, seconds = stats['stages'][label]
+        print("%s\t%d calls\t%.3f s" % (label, calls, seconds))
@@ -1,14 +1,200 @@
 """CLustering of reads to create consensus sequences.
 """
 
+import collections.abc
+import contextlib
 import logging
 import time
 import datetime
+import functools
+import gzip
+import heapq
+import itertools
+import os
 import os.path
+import pickle
 import pyrates.utils as utils
+import pyrates.fastq as fq
+import pyrates.index as idx
+import pyrates.parallel as par
 import pyrates.sequence as pseq
 import pyrates.consensus as cons
 
+CHECKPOINT_VERSION = 1
+CHECKPOINT_INTERVAL = 1800
+
+def save_checkpoint(file_name, clustering, id_map, read_count, offset, settings):
+    """Save the state of a clustering run.
+
+    The checkpoint is written to a temporary file first and then moved into place,
+    so that an interrupted write never replaces the previous checkpoint. The UID
+    store isn't saved, it is recreated from the cluster centres instead.
+
+    Args:
+        file_name (:obj:`str`): Name of the checkpoint file.
+        clustering (:obj:`Clustering`): Clusters computed so far.
+        id_map (:obj:`pyrates.utils.LRUCache`): Known approximate matches for UIDs.
+        read_count (:obj:`int`): Number of reads processed so far.
+        offset (:obj:`int`): Position in the input immediately after the last read
+            processed.
+        settings (:obj:`dict`): Parameters of the run. These have to match when the
+            checkpoint is loaded.
+    """
+    stats = dict(clustering.stats)
+    stats['elapsed'] = time.time() - stats.pop('start_time')
+    del stats['batch_start']
+    state = {'version':CHECKPOINT_VERSION, 'settings':settings, 'clusters':clustering._clusters,
+             'stats':stats, 'id_map':id_map, 'reads':read_count, 'offset':offset}
+    with gzip.open(file_name + '.tmp', 'wb', compresslevel=1) as checkpoint:
+        pickle.dump(state, checkpoint, pickle.HIGHEST_PROTOCOL)
+    os.replace(file_name + '.tmp', file_name)
+
+def load_checkpoint(file_name, settings):
+    """Load the state of a clustering run saved with :func:`save_checkpoint`.
+
+    Args:
+        file_name (:obj:`str`): Name of the checkpoint file.
+        settings (:obj:`dict`): Parameters of the current run.
+
+    Returns:
+        :obj:`dict`: The saved state with entries *clusters*, *stats*, *id_map*,
+        *reads* and *offset*.
+
+    Raises:
+        ValueError: if the checkpoint was created by an incompatible version or
+            with different settings.
+    """
+    with gzip.open(file_name, 'rb') as checkpoint:
+        state = pickle.load(checkpoint)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError("Unsupported checkpoint version in %r" % file_name)
+    changed = sorted(key for key in settings if state['settings'].get(key) != settings[key])
+    if changed:
+        raise ValueError("Checkpoint %r was created with different settings: %s" %
+                         (file_name, ', '.join(changed)))
+    return state
+
+def _format(records, batch_size):
+    """Consensus sequences in FASTQ format, in batches of `batch_size`."""
+    records = iter(records)
+    while True:
+        batch = ''.join([str(consensus) + "\n" for (_, consensus)
+                         in itertools.islice(records, batch_size)])
+        if not batch:
+            break
+        yield batch
+
+def write_consensus(output_file, records, level=fq.COMPRESSION_LEVEL, threads=1,
+                    batch_size=10000, indexed=False):
+    """Write consensus sequences to fastq file.
+
+    Output to files with a *.gz* extension is gzip compressed. Consensus sequences
+    are formatted in batches that are compressed independently and in parallel.
+    Records are consumed as they are written, so that output can be produced while
+    later consensus sequences are still being computed.
+
+    Args:
+        output_file (:obj:`str`): File name for output. Will be replaced if it exists.
+        records: Iterable of (uid, consensus) pairs.
+        level (:obj:`int`, optional): Compression level between 1 (fastest) and
+            9 (smallest output).
+        threads (:obj:`int`, optional): Number of threads used for compression.
+        batch_size (:obj:`int`, optional): Number of consensus sequences per batch.
+        indexed (:obj:`bool`, optional): Write BGZF compressed output together with an
+            index that provides access to consensus sequences by UID (see
+            :mod:`pyrates.index`). This ignores the file extension.
+    """
+    if indexed:
+        idx.write_indexed(((uid, str(consensus) + "\n") for (uid, consensus) in records),
+                          output_file, level, threads)
+    elif output_file.endswith('.gz'):
+        with open(output_file, 'wb') as output:
+            fq.write_gzip(output, _format(records, batch_size), level, threads)
+    else:
+        with open(output_file, 'w') as output:
+            for batch in _format(records, batch_size):
+                output.write(batch)
+
+class _Duplicates(object):
+    """Reads with identical UID and sequence waiting to be added to a cluster.
+
+    Args:
+        key (:obj:`tuple`): UID and read sequence shared by all reads in this group.
+    """
+    __slots__ = 'key', 'uid_quality', 'read_quality', 'count', 'is_long', 'id_matched'
+
+    def __init__(self, key):
+        self.key = key
+        self.uid_quality = None
+        self.read_quality = None
+        self.count = 0
+        self.is_long = False
+        self.id_matched = False
+
+    def add(self, uid_qual, read_qual, is_long, id_matched):
+        """Add another read, keeping the highest quality at each position."""
+        if self.count == 0:
+            self.uid_quality = uid_qual
+            self.read_quality = read_qual
+            self.is_long = is_long
+            self.id_matched = id_matched
+        else:
+            self.uid_quality = ''.join(map(max, zip(self.uid_quality, uid_qual)))
+            self.read_quality = ''.join(map(max, zip(self.read_quality, read_qual)))
+        self.count += 1
+
+class _ClusterView(collections.abc.MutableMapping):
+    """Mapping of UIDs to the consensus sequences of a :obj:`Clustering`.
+
+    Clusters stored as :obj:`pyrates.consensus.Singleton` are returned as consensus
+    objects, without replacing the stored singleton. Changes are applied to the
+    underlying clusters directly. As with the plain :obj:`dict` used previously, the
+    UID index of the :obj:`Clustering` is not updated.
+    """
+    __slots__ = '_clustering',
+
+    def __init__(self, clustering):
+        self._clustering = clustering
+
+    def __getitem__(self, uid):
+        return self._clustering._view(uid, self._clustering._clusters[uid])
+
+    def __setitem__(self, uid, consensus):
+        self._clustering._clusters[uid] = consensus
+
+    def __delitem__(self, uid):
+        del self._clustering._clusters[uid]
+
+    def __contains__(self, uid):
+        return uid in self._clustering._clusters
+
+    def __iter__(self):
+        return iter(self._clustering._clusters)
+
+    def __len__(self):
+        return len(self._clustering._clusters)
+
+def _reach(tag, threshold):
+    """Lexicographically largest UID prefix within `threshold` differences of `tag`.
+
+    UIDs are assumed to consist of *A*, *C*, *G*, *T* and the wildcard *N*.
+    """
+    reach = list(tag)
+    for (pos, letter) in enumerate(reach):
+        if threshold == 0:
+            break
+        if letter < 'T':
+            reach[pos] = 'T'
+            threshold -= 1
+    return ''.join(reach)
+
+def _wrap(seq, name=''):
+    """Create a :obj:`pyrates.sequence.SequenceWithQuality` from a (sequence, quality)
+    pair. Existing sequence objects are returned unchanged."""
+    if isinstance(seq, tuple):
+        return pseq.SequenceWithQuality(seq[0], seq[1], name=name)
+    return seq
+
 class Clustering(object):
     """Clustering of reads with UIDs.
 
@@ -19,18 +205,38 @@ class Clustering(object):
             If this is missing it will be computed from the cluster centres.
         wildcard (:obj:`string`): Single character that should be treated as wildcard or
                 `None` to disable use of wildcard matching.
-
-    Attributes:
-        clusters (:obj:`dict`): Cluster centres represented by consensus
-            sequences and identified by the associated UID.
+        packed (:obj:`bool`, optional): Store UIDs in packed form to reduce memory usage.
+            This is ignored if `store` is provided.
+        consensus (:obj:`type`, optional): Class used to represent the consensus sequences
+            of new clusters. If this is :obj:`pyrates.consensus.ClusterTable` all
+            consensus sequences are stored in a single table instead.
+        index (:obj:`type`, optional): Class used to index UIDs for approximate matching,
+            one of :obj:`pyrates.sequence.SequenceStore`, :obj:`pyrates.sequence.BKTreeStore`
+            or :obj:`pyrates.sequence.PigeonholeStore`. This is ignored if `store` is provided.
+        deepening (:obj:`bool`, optional): Search for similar UIDs with increasing radius
+            and stop at the first radius that yields a suitable cluster (see
+            :meth:`merge_target`).
+
+    Consensus sequences are stored in a :obj:`pyrates.consensus.ClusterTable` if
+    `consensus` is that class. Otherwise clusters created from a single read are stored
+    as :obj:`pyrates.consensus.Singleton` until a second read is added. Accessing a
+    cluster through the :obj:`Clustering` always returns a consensus object.
     """
-    __slots__ = 'clusters', '_store', 'stats'
+    __slots__ = '_clusters', '_store', 'stats', '_consensus', '_pending', '_lengths', \
+                '_deepening'
     _logger = utils.get_logger(__name__)
 
     def __init__(self, centres, store=None, wildcard=None,
                  alphabet=('A', 'C', 'G', 'T'), tag_size=5, max_diff=3,
-                 read_length=None):
-        self.clusters = centres
+                 read_length=None, packed=False, consensus=cons.Consensus,
+                 index=pseq.SequenceStore, deepening=False):
+        if isinstance(consensus, type) and issubclass(consensus, cons.ClusterTable):
+            centres = consensus(centres)
+        self._clusters = centres
+        self._consensus = consensus
+        self._pending = {}
+        self._deepening = deepening
+        self._index_lengths()
         ## keep track of UID handling for fragments that are shorter/longer than read length
         created_at = time.time()
         self.stats = {
@@ -46,57 +252,215 @@ class Clustering(object):
         }
         if store is not None:
             self._store = store
+        elif index is pseq.PigeonholeStore:
+            self._store = pseq.PigeonholeStore.from_list(list(centres.keys()),
+                                                         alphabet=alphabet,
+                                                         tag_size=tag_size,
+                                                         max_diff=max_diff,
+                                                         wildcard=wildcard,
+                                                         packed=packed)
         elif tag_size > 0:
             self._store = pseq.GroupedSequenceStore.from_list(list(centres.keys()),
                                                               alphabet=alphabet,
                                                               tag_size=tag_size,
                                                               max_diff=max_diff,
-                                                              wildcard=wildcard)
+                                                              wildcard=wildcard,
+                                                              packed=packed,
+                                                              index=index)
         else:
-            self._store = pseq.SequenceStore.from_list(list(centres.keys()),
-                                                       alphabet=alphabet)
+            self._store = index.from_list(list(centres.keys()), alphabet=alphabet, packed=packed)
+
+    def _index_lengths(self):
+        """Group the UIDs of all clusters by length of the consensus sequence."""
+        self._lengths = {}
+        for (uid, cluster) in self._clusters.items():
+            self._lengths.setdefault(len(cluster), set()).add(uid)
+
+    def _retag(self, uid, length):
+        """Record a change in the consensus length of a cluster."""
+        if uid not in self._lengths.get(length, ()):
+            for uids in self._lengths.values():
+                uids.discard(uid)
+            self._lengths.setdefault(length, set()).add(uid)
 
     def _filter(self, pattern, candidates, read_seq, threshold):
-        candidates = [cand for cand in candidates if
-                      len(self[cand].sequence) == len(read_seq)]
-        candidates = [cand for cand in candidates if
-                      not self[cand].sequence.grosslydifferent(read_seq)]
-        candidates = [(cand, pseq.SequenceStore.diff(cand, pattern)) for
-                      cand in candidates]
-        candidates = [cand for cand in candidates if cand[1] <= threshold]
-        return candidates
-
-    def merge_target(self, uid, read_seq, id_map, threshold):
+        ## candidates with a different consensus length are rejected before looking
+        ## up the cluster, the remaining checks are applied in a single pass
+        same_length = self._lengths.get(len(read_seq))
+        if not same_length:
+            return []
+        clusters = self._clusters
+        diff = pseq.SequenceStore.diff
+        matches = []
+        for cand in candidates:
+            if cand in same_length:
+                distance = diff(cand, pattern)
+                if distance <= threshold and not clusters[cand].grosslydifferent(read_seq):
+                    matches.append((cand, distance))
+        return matches
+
+    def merge_target(self, uid, read_seq, id_map, threshold, name=''):
         """Compute set of candidate clusters for a given read.
 
+        If there is no suitable cluster, a new cluster is created for the read.
+        The UID and read can be given as (sequence, quality) pairs, in which case
+        the new cluster is stored as a :obj:`pyrates.consensus.Singleton` until
+        another read is added to it.
+
+        With iterative deepening enabled, the UID index is searched with a radius of
+        1, 2, ... `threshold` differences in turn, stopping at the first radius for
+        which a suitable cluster is found. Since each search returns all clusters
+        within its radius, this finds the same cluster as a single search with the
+        full radius, but most UID errors are found by the much cheaper searches with
+        small radius.
+
         Args:
             uid (:obj:`pyrates.sequence.SequenceWithQuality`): UID sequence.
             read_seq (:obj:`pyrates.sequence.SequenceWithQuality`): Read sequence.
             id_map (:obj:`dictionary`): A mapping of known approximate matches for UIDs.
             threshold (:obj:`int`): Maximum number of differences allowed between UIDs.
+            name (:obj:`str`, optional): Name to use for the read sequence of a new cluster
+                if `read_seq` is a (sequence, quality) pair.
 
         Returns:
             :obj:`string`: Either the best approximate match for the UID or `None`
-                if no valid match was found.
+                if no valid match was found. Ties between equally good matches are
+                resolved in favour of the lexicographically smallest UID.
         """
-        nameid = uid.sequence
-        id_cands = self._store.search(nameid, max_hits=100, raw=True)
-        id_cands = self._filter(nameid, id_cands, read_seq, threshold)
-        if id_cands:
-            similar_id = min(id_cands, key=lambda x: x[1])
-            similar_id = similar_id[0]
-        else:
-            similar_id = None
+        nameid = uid[0] if isinstance(uid, tuple) else uid.sequence
+        sequence = read_seq[0] if isinstance(read_seq, tuple) else read_seq.sequence
+        similar_id = self.find(nameid, sequence, threshold)
         ## Create new cluster or merge with existing consensus
         if similar_id is None:
-            self.clusters[nameid] = cons.Consensus(uid, read_seq)
-            self._store.add(nameid)
+            if isinstance(uid, tuple) and isinstance(read_seq, tuple) and \
+               not isinstance(self._clusters, cons.ClusterTable):
+                self._clusters[nameid] = cons.Singleton(uid[1], read_seq[0], read_seq[1], name)
+                self._lengths.setdefault(len(sequence), set()).add(nameid)
+                self._store.add(nameid)
+            else:
+                self.add(_wrap(uid), _wrap(read_seq, name))
         else:
             id_map[nameid] = similar_id
         return similar_id
 
+    def find(self, uid, sequence, threshold):
+        """Find the cluster a read would be added to, without modifying the clustering.
+
+        Args:
+            uid (:obj:`str`): UID sequence.
+            sequence (:obj:`str`): Read sequence.
+            threshold (:obj:`int`): Maximum number of differences allowed between UIDs.
+
+        Returns:
+            :obj:`string`: The best approximate match for the UID as determined by
+                :meth:`merge_target` or `None` if there is no suitable cluster.
+        """
+        radii = [None]
+        if self._deepening:
+            radii = list(range(1, threshold)) + radii
+        for radius in radii:
+            id_cands = self._store.search(uid, max_hits=100, raw=True, max_diff=radius)
+            for cand in id_cands:
+                if cand in self._pending:
+                    self._flush(cand)
+            id_cands = self._filter(uid, id_cands, sequence,
+                                    threshold if radius is None else radius)
+            if id_cands:
+                return min(id_cands, key=lambda x: (x[1], x[0]))[0]
+        return None
+
+    def _update(self, similar_id, uid, read_seq, size, is_long, id_matched):
+        """Add reads to an existing cluster and record the outcome.
+
+        `uid` and `read_seq` are (sequence, quality) pairs.
+        """
+        cluster = self[similar_id]
+        if cluster.update(uid, read_seq, size_other=size):
+            if not id_matched:
+                self.stats['total_merged'][is_long] += size
+            if cluster.size - size < 2 <= cluster.size:
+                self.stats['single_count'][is_long] -= 1
+        else:
+            self.stats['total_skipped'][is_long] += size
+            ## a single read consensus is replaced by longer reads
+            self._retag(similar_id, len(cluster))
+
+    def _flush(self, similar_id):
+        """Add pending duplicate reads to a cluster."""
+        pending = self._pending.pop(similar_id)
+        if pending.count:
+            self._update(similar_id, (pending.key[0], pending.uid_quality),
+                         (pending.key[1], pending.read_quality), pending.count,
+                         pending.is_long, pending.id_matched)
+
+    def cluster_reads(self, reads, id_map, threshold, name='', max_short=0, collapse=True):
+        """Assign reads to clusters.
+
+        Each read is added to the consensus of the cluster with the best matching UID.
+        Reads for which no suitable cluster exists become the centre of a new cluster.
+
+        Reads with the same UID and sequence as the previous read added to the same
+        cluster are collected and added to the consensus together, once another read
+        requires the cluster or all reads have been processed. The result is identical
+        to adding them one at a time.
+
+        Args:
+            reads (:obj:`list`): (uid, uid quality, sequence, sequence quality) tuples
+                as produced by :func:`pyrates.fastq.split_reads`.
+            id_map (:obj:`dictionary`): A mapping of known approximate matches for UIDs,
+                e.g. a :obj:`pyrates.utils.LRUCache`. This is updated with any new matches
+                found. UIDs without a match become the centre of a new cluster and are
+                therefore never searched for again.
+            threshold (:obj:`int`): Maximum number of differences allowed between UIDs.
+            name (:obj:`str`, optional): Name to use for read sequences.
+            max_short (:obj:`int`, optional): Reads with sequences up to this length are
+                counted as short fragments.
+            collapse (:obj:`bool`, optional): Whether duplicate reads should be collected
+                and added to clusters together.
+        """
+        try:
+            for (nameid, qnameid, sequence, qsequence) in reads:
+                is_long = len(sequence) > max_short
+                self.stats['reads'][is_long] += 1
+
+                ## Look for similar IDs that may be candidates for merging
+                similar_id = None
+                if nameid in self:
+                    similar_id = nameid
+                    id_matched = True
+                else:
+                    id_matched = False
+                    similar_id = id_map.get(nameid)
+                    if similar_id is None:
+                        similar_id = self.merge_target((nameid, qnameid), (sequence, qsequence),
+                                                       id_map, threshold, name)
+                    if similar_id is not None:
+                        self.stats['total_fixed'][is_long] += 1
+                if similar_id is not None:
+                    pending = self._pending.get(similar_id)
+                    if pending is not None:
+                        if pending.key == (nameid, sequence):
+                            pending.add(qnameid, qsequence, is_long, id_matched)
+                            continue
+                        self._flush(similar_id)
+                    self._update(similar_id, (nameid, qnameid), (sequence, qsequence), 1,
+                                 is_long, id_matched)
+                else:
+                    self.stats['single_count'][is_long] += 1
+                    self.stats['clusters'][is_long] += 1
+                    similar_id = nameid
+                if collapse:
+                    self._pending[similar_id] = _Duplicates((nameid, sequence))
+        finally:
+            for similar_id in list(self._pending):
+                self._flush(similar_id)
+
     @classmethod
-    def from_fastq(cls, input_file, id_length, adapter, threshold=5, prefix=5, read_length=None):
+    def from_fastq(cls, input_file, id_length, adapter, threshold=5, prefix=5, read_length=None,
+                   workers=1, packed=False, consensus=cons.Consensus, index=pseq.SequenceStore,
+                   cache_size=None, checkpoint=None,
+                   checkpoint_interval=CHECKPOINT_INTERVAL, resume=False, readers=1,
+                   deepening=False, id_map=None):
         """Read FASTQ file to generate consensus sequences.
 
         Args:
@@ -108,81 +472,246 @@ class Clustering(object):
             read_length (:obj:`int`, optional): Original read length used. If this is set and
                 and the logging level is sufficiently high, additional log entries are generated
                 to track the number of short and long fragments processed.
+            workers (:obj:`int`, optional): Number of worker processes used to search for
+                similar UIDs. The results are identical to those obtained with a single process.
+            packed (:obj:`bool`, optional): Store UIDs in packed form to reduce memory usage.
+            consensus (:obj:`type`, optional): Class used to represent consensus sequences,
+                e.g. :obj:`pyrates.consensus.ArrayConsensus` or
+                :obj:`pyrates.consensus.ClusterTable`.
+            index (:obj:`type`, optional): Class used to index UIDs for approximate matching,
+                e.g. :obj:`pyrates.sequence.BKTreeStore` or
+                :obj:`pyrates.sequence.PigeonholeStore`.
+            cache_size (:obj:`int`, optional): Maximum number of corrected UIDs for which
+                the matching cluster is remembered. By default all of them are remembered.
+                With a limit, a UID that has been forgotten is searched for again and may
+                then be matched to a cluster created after its first occurrence, so the
+                results can differ from those of an unlimited cache.
+            checkpoint (:obj:`str`, optional): Name of a file used to save the state of the
+                clustering at regular intervals (see :func:`save_checkpoint`).
+            checkpoint_interval (:obj:`int`, optional): Minimum number of seconds between
+                checkpoints.
+            resume (:obj:`bool`, optional): Continue from the state saved in `checkpoint`,
+                if the file exists. The input is read from the position recorded in the
+                checkpoint and the result is the same as that of an uninterrupted run.
+            readers (:obj:`int`, optional): Number of processes used to parse uncompressed
+                input (see :func:`pyrates.fastq.read_parallel`).
+            deepening (:obj:`bool`, optional): Search for similar UIDs with increasing
+                radius (see :meth:`merge_target`). The results are unchanged.
+            id_map (:obj:`pyrates.utils.LRUCache`, optional): Cache of UID matches to use
+                instead of creating one of size `cache_size`. It is updated with the UID of
+                the cluster each read was added to, unless the UID matched a cluster exactly.
+                This is ignored when resuming from a checkpoint.
+
         Returns:
             :obj:`dict`: Computed consensus sequences.
         """
-        adapt_length = id_length + len(adapter)
         if read_length is not None:
             max_short = read_length - id_length - len(adapter)
         else:
             max_short = 0
         name = os.path.basename(input_file).split('.')[0]
 
-        id_set = pseq.GroupedSequenceStore(id_length*2, tag_size=prefix, max_diff=threshold,
-                                           wildcard='N')
-        id_map = {}
-        seq = cls({}, id_set, read_length=read_length)
-
-        open_fun = utils.smart_open(input_file)
-        line_count = 0
-        ping_freq = 40000
+        if workers > 1:
+            id_set = par.PartitionedSequenceStore(id_length*2, workers=workers, tag_size=prefix,
+                                                  max_diff=threshold, wildcard='N', packed=packed,
+                                                  index=index)
+        else:
+            id_set = pseq.create_store(id_length*2, tag_size=prefix, max_diff=threshold,
+                                       wildcard='N', packed=packed, index=index)
+        settings = {'input':os.path.basename(input_file), 'input_size':os.path.getsize(input_file),
+                    'id_length':id_length, 'adapter':adapter, 'threshold':threshold,
+                    'prefix':prefix, 'read_length':read_length, 'packed':packed,
+                    'consensus':consensus.__name__, 'index':index.__name__}
+        if id_map is None:
+            id_map = utils.LRUCache(cache_size)
+        seq = cls({}, id_set, read_length=read_length, consensus=consensus, deepening=deepening)
+
+        read_count = 0
+        start = 0
+        if resume and checkpoint is not None and os.path.exists(checkpoint):
+            state = load_checkpoint(checkpoint, settings)
+            for uid in state['clusters']:
+                id_set.add(uid)
+            if workers > 1:
+                id_set.flush()
+            seq._clusters = state['clusters']
+            seq._index_lengths()
+            stats = state['stats']
+            stats['start_time'] = time.time() - stats.pop('elapsed')
+            stats['batch_start'] = time.time()
+            seq.stats = stats
+            id_map = state['id_map']
+            id_map.max_size = cache_size
+            read_count = state['reads']
+            start = state['offset']
+            cls._logger.info("Resuming from checkpoint %r after %d reads", checkpoint, read_count)
+        ping_freq = 10000
         if cls._logger.isEnabledFor(logging.INFO) and not cls._logger.isEnabledFor(logging.DEBUG):
             ping_freq = ping_freq * 10
-        with open_fun(input_file) as fastq:
-            for (line_count, line) in enumerate(fastq):
-                # print out some stats as we go
-                if cls._logger.isEnabledFor(logging.INFO) and line_count > 0 and \
-                        (line_count % ping_freq) == 0:
-                    seq.log_progress(line_count)
-                elif (line_count % 4) == 1:
-                    line = line.rstrip("\n")
-                    nameid = line[0:id_length] + line[-id_length:]
-                    sequence = line[adapt_length:-adapt_length]
-                    is_long = len(sequence) > max_short
-                    seq.stats['reads'][is_long] += 1
-                elif (line_count % 4) == 3:
-                    line = line.rstrip("\n")
-                    qnameid = line[0:id_length] + line[-id_length:]
-                    qsequence = line[adapt_length:-adapt_length]
-
-                    uid = pseq.SequenceWithQuality(nameid, qnameid)
-                    read_seq = pseq.SequenceWithQuality(sequence, qsequence, name=name)
-                    ## Look for similar IDs that may be candidates for merging
-                    similar_id = None
-                    if nameid in id_map:
-                        similar_id = id_map[nameid]
-                        seq.stats['total_fixed'][is_long] += 1
-                        id_matched = False
-                    elif nameid not in seq:
-                        similar_id = seq.merge_target(uid, read_seq, id_map, threshold)
-                        id_matched = False
-                        if similar_id is not None:
-                            seq.stats['total_fixed'][is_long] += 1
-                    else:
-                        similar_id = nameid
-                        id_matched = True
-                    if similar_id is not None:
-                        success = seq[similar_id].update(uid, read_seq)
-                        if success:
-                            if not id_matched:
-                                seq.stats['total_merged'][is_long] += 1
-                            if seq[similar_id].size == 2:
-                                seq.stats['single_count'][is_long] -= 1
-                        else:
-                            seq.stats['total_skipped'][is_long] += 1
-                    else:
-                        seq.add(uid, read_seq)
-                        seq.stats['single_count'][is_long] += 1
-                        seq.stats['clusters'][is_long] += 1
-        if cls._logger.isEnabledFor(logging.DEBUG) and line_count > 0:
-            seq.log_progress(line_count)
+        next_ping = read_count - read_count % ping_freq + ping_freq
+        next_checkpoint = time.time() + checkpoint_interval
+        try:
+            split = functools.partial(fq.split_reads, id_length=id_length,
+                                      adapter_length=len(adapter))
+            blocks = fq.read_file(input_file, fq.BLOCK_SIZE, offsets=True, start=start,
+                                  process=split, readers=readers)
+            with contextlib.closing(blocks):
+                ## parse input in the background while clustering previous reads
+                batches = fq.prefetch(blocks)
+                with contextlib.closing(batches):
+                    for (reads, offset) in batches:
+                        if workers > 1:
+                            id_set.prefetch(set(read[0] for read in reads
+                                                if read[0] not in id_map and read[0] not in seq))
+                        seq.cluster_reads(reads, id_map, threshold, name, max_short)
+                        if workers > 1:
+                            id_set.flush()
+                        read_count += len(reads)
+                        # print out some stats as we go
+                        if read_count >= next_ping and cls._logger.isEnabledFor(logging.INFO):
+                            seq.log_progress(read_count, id_map)
+                            next_ping = read_count - read_count % ping_freq + ping_freq
+                        if checkpoint is not None and time.time() >= next_checkpoint:
+                            save_checkpoint(checkpoint, seq, id_map, read_count, offset, settings)
+                            cls._logger.debug("Saved checkpoint after %d reads", read_count)
+                            next_checkpoint = time.time() + checkpoint_interval
+        finally:
+            if workers > 1:
+                id_set.close()
+        if workers > 1:
+            ## the UIDs were only held by the worker processes
+            seq._store = pseq.create_store(id_length*2, tag_size=prefix, max_diff=threshold,
+                                           wildcard='N', packed=packed, index=index)
+            for uid in seq._clusters:
+                seq._store.add(uid)
+        if cls._logger.isEnabledFor(logging.DEBUG) and read_count > 0:
+            seq.log_progress(read_count, id_map)
         return seq
 
-    def log_progress(self, line_count):
+    @classmethod
+    def stream_fastq(cls, input_file, id_length, adapter, threshold=5, prefix=5, read_length=None,
+                     packed=False, consensus=cons.Consensus, index=pseq.SequenceStore,
+                     readers=1, deepening=False):
+        """Generate consensus sequences from a FASTQ file that is sorted by UID.
+
+        The input has to be sorted by UID, or at least by the first `prefix` characters
+        of the UID. Reads are clustered in the same way as by :meth:`from_fastq` and the
+        resulting clusters are identical. Clusters are handed to the caller and
+        discarded, together with all UIDs associated with them, as soon as the input
+        has moved past all UID prefixes within `threshold` differences of their own
+        prefix, since no later read can be added to them.
+
+        A single error in the first position of a UID moves a read far ahead in the sort
+        order. Clusters therefore remain in memory until the input reaches the UID prefixes
+        obtained by replacing the first `threshold` bases that aren't *T* with *T*. The
+        reduction in memory use compared to :meth:`from_fastq` is largest for small
+        values of `threshold`.
+
+        Args:
+            input_file (:obj:`str`): Name of input file.
+            id_length (:obj:`int`): Length of UID sequence at beginning/end of read.
+            adapter (:obj:`str`): Adapter sequence.
+            threshold (:obj:`int`, optional): Maximum number of differences allowed between UIDs.
+            prefix (:obj:`int`, optional): Length of UID prefix by which the input is sorted.
+            read_length (:obj:`int`, optional): Original read length used.
+            packed (:obj:`bool`, optional): Store UIDs in packed form to reduce memory usage.
+            consensus (:obj:`type`, optional): Class used to represent consensus sequences.
+            index (:obj:`type`, optional): Class used to index UIDs for approximate matching.
+            readers (:obj:`int`, optional): Number of processes used to parse uncompressed
+                input (see :func:`pyrates.fastq.read_parallel`).
+            deepening (:obj:`bool`, optional): Search for similar UIDs with increasing
+                radius (see :meth:`merge_target`).
+
+        Yields:
+            :obj:`Clustering`: Clusters that can't receive any more reads. The statistics
+            in :attr:`stats` are shared between all of them and cover the entire input.
+
+        Raises:
+            ValueError: if the input isn't sorted by UID prefix.
+        """
+        if read_length is not None:
+            max_short = read_length - id_length - len(adapter)
+        else:
+            max_short = 0
+        name = os.path.basename(input_file).split('.')[0]
+
+        def clustering(stats=None):
+            store = pseq.create_store(id_length*2, tag_size=prefix, max_diff=threshold,
+                                      wildcard='N', packed=packed, index=index)
+            seq = cls({}, store, read_length=read_length, consensus=consensus,
+                      deepening=deepening)
+            if stats is not None:
+                seq.stats = stats
+            return seq
+
+        def complete(key):
+            ## move clusters that are out of reach of `key` to a separate clustering
+            done = clustering(seq.stats)
+            while active and active[0][0] < key:
+                for uid in members.pop(heapq.heappop(active)[1]):
+                    done._clusters[uid] = seq._clusters[uid]
+                    done._store.add(uid)
+                    seq.remove(uid)
+            done._index_lengths()
+            return done
+
+        seq = clustering()
+        id_map = {}
+        key = None
+        ## clusters by UID prefix and a heap of the largest prefix within reach of each
+        members = {}
+        active = []
+        created = {}
+        read_count = 0
+        ping_freq = 100000
+        next_ping = ping_freq
+        split = functools.partial(fq.split_reads, id_length=id_length,
+                                  adapter_length=len(adapter))
+        blocks = fq.read_file(input_file, process=split, readers=readers)
+        with contextlib.closing(blocks):
+            batches = fq.prefetch(blocks)
+            with contextlib.closing(batches):
+                for reads in batches:
+                    start = 0
+                    for (pos, read) in enumerate(reads):
+                        if read[0][:prefix] == key:
+                            continue
+                        seq.cluster_reads(reads[start:pos], id_map, threshold, name, max_short)
+                        created.update((uid, None) for (uid, _, _, _) in reads[start:pos]
+                                       if uid in seq)
+                        start = pos
+                        if key is not None:
+                            if read[0][:prefix] < key:
+                                raise ValueError("Input is not sorted by UID prefix, reads " +
+                                                 "with prefix %r follow prefix %r" %
+                                                 (read[0][:prefix], key))
+                            members[key] = list(created)
+                            heapq.heappush(active, (_reach(key, threshold), key))
+                        key = read[0][:prefix]
+                        created = {}
+                        ## UIDs with an earlier prefix won't be seen again
+                        id_map = {}
+                        if active and active[0][0] < key:
+                            done = complete(key)
+                            if len(done):
+                                yield done
+                    seq.cluster_reads(reads[start:], id_map, threshold, name, max_short)
+                    created.update((uid, None) for (uid, _, _, _) in reads[start:] if uid in seq)
+                    read_count += len(reads)
+                    if read_count >= next_ping:
+                        cls._logger.info("reads: %d, clusters: %d, active clusters: %d",
+                                         read_count, sum(seq.stats['clusters']), len(seq))
+                        next_ping = read_count - read_count % ping_freq + ping_freq
+        if len(seq):
+            yield seq
+
+    def log_progress(self, read_count, id_map=None):
         """ Produce series of log messages indicating progress of clustering.
 
         Args:
-            line_count (:obj:`int`): Number of input lines processed so far.
+            read_count (:obj:`int`): Number of input reads processed so far.
+            id_map (:obj:`pyrates.utils.LRUCache`, optional): Cache of UID matches
+                used during clustering.
         """
         checkpoint = time.time()
         total_time = checkpoint - self.stats['start_time']
@@ -190,10 +719,10 @@ class Clustering(object):
         self.stats['batch_start'] = checkpoint
         self._logger.info("reads: %d, clusters: %d, singletons: %d (%.1f%%), " +
                           "corrupted UIDs: %d (%.2f%%)",
-                          line_count/4, len(self), sum(self.stats['single_count']),
+                          read_count, len(self), sum(self.stats['single_count']),
                           sum(self.stats['single_count'])/(len(self)/100.0),
                           self.fail_count,
-                          self.fail_count/(line_count/4.0)*100)
+                          self.fail_count/float(read_count)*100)
         if self.stats['read_length'] is not None:
             self._logger.info("reads (short/long): %d %d",
                               self.stats['reads'][0], self.stats['reads'][1])
@@ -204,11 +733,11 @@ class Clustering(object):
         self._logger.info("similar UIDs: %d (%.1f%%), UIDs merged: %d (%.1f%%), " +
                           "merge failures: %d (%.1f%%)",
                           sum(self.stats['total_fixed']),
-                          sum(self.stats['total_fixed'])/(line_count/4.0)*100,
+                          sum(self.stats['total_fixed'])/float(read_count)*100,
                           sum(self.stats['total_merged']),
-                          sum(self.stats['total_merged'])/(line_count/4.0)*100,
+                          sum(self.stats['total_merged'])/float(read_count)*100,
                           sum(self.stats['total_skipped']),
-                          sum(self.stats['total_skipped'])/(line_count/4.0)*100)
+                          sum(self.stats['total_skipped'])/float(read_count)*100)
         if self.stats['read_length'] is not None:
             self._logger.info("similar UIDs (short/long): %d %d",
                               self.stats['total_fixed'][0],
@@ -219,49 +748,90 @@ class Clustering(object):
             self._logger.info("merge failures (short/long): %d %d",
                               self.stats['total_skipped'][0],
                               self.stats['total_skipped'][1])
+        if id_map is not None:
+            lookups = max(id_map.hits + id_map.misses, 1)
+            self._logger.info("UID cache entries: %d, hits: %d (%.1f%%), misses: %d (%.1f%%)",
+                              len(id_map), id_map.hits, id_map.hits/float(lookups)*100,
+                              id_map.misses, id_map.misses/float(lookups)*100)
         self._logger.info("total time: %s, increment: %s, rate: %.1f reads/s",
                           datetime.timedelta(seconds=total_time),
                           datetime.timedelta(seconds=batch_time),
-                          line_count/4.0/total_time)
+                          float(read_count)/total_time)
 
-    def write(self, output_file):
+    def write(self, output_file, level=fq.COMPRESSION_LEVEL, threads=1, batch_size=10000,
+              indexed=False):
         """Write consensus sequences to fastq file.
 
+        See :func:`write_consensus` for details.
+
         Args:
             output_file (:obj:`str`): File name for output. Will be replaced if it exists.
+            level (:obj:`int`, optional): Compression level between 1 (fastest) and
+                9 (smallest output).
+            threads (:obj:`int`, optional): Number of threads used for compression.
+            batch_size (:obj:`int`, optional): Number of consensus sequences per batch.
+            indexed (:obj:`bool`, optional): Write BGZF compressed output together with an
+                index that provides access to consensus sequences by UID.
+        """
+        write_consensus(output_file, self.items(), level, threads, batch_size, indexed)
+
+    @property
+    def clusters(self):
+        """Mapping of UIDs to consensus sequences (see :meth:`items`).
+
+        Assigning a mapping replaces the stored clusters. This does not update the UID
+        index, use :meth:`add` and :meth:`remove` to keep both in sync.
         """
-        output_fun = utils.smart_open(output_file)
-        with output_fun(output_file, 'w') as output:
-            for uid in self:
-                output.write(str(self[uid]) + "\n")
+        return _ClusterView(self)
+
+    @clusters.setter
+    def clusters(self, centres):
+        if isinstance(centres, _ClusterView):
+            if centres._clustering is self:
+                return
+            centres = centres._clustering._clusters
+        if isinstance(self._consensus, type) and issubclass(self._consensus, cons.ClusterTable) \
+           and not isinstance(centres, cons.ClusterTable):
+            centres = self._consensus(centres)
+        self._clusters = centres
 
     def keys(self):
         """UIDs used to identify clusters."""
-        return self.clusters.keys()
+        return self._clusters.keys()
+
+    def _view(self, uid, cluster):
+        """Consensus object for a cluster, without storing promoted singletons."""
+        if isinstance(cluster, cons.Singleton):
+            return cluster.promote(uid, self._consensus)
+        return cluster
 
     def values(self):
-        """Consensus sequences corresponding to clusters."""
+        """Consensus sequences corresponding to clusters.
+
+        Singletons are converted to consensus objects as they are produced, without
+        replacing the stored singletons. The result can be iterated over repeatedly.
+        """
         return self.clusters.values()
 
     def items(self):
-        """UIDs / consensus sequence pairs."""
+        """UIDs / consensus sequence pairs (see :meth:`values`)."""
         return self.clusters.items()
 
     def iterkeys(self):
         """UIDs used to identify clusters."""
-        return self.clusters.iterkeys()
+        return iter(self.keys())
 
     def itervalues(self):
         """Consensus sequences corresponding to clusters."""
-        return self.clusters.itervalues()
+        return iter(self.values())
 
     def iteritems(self):
         """UIDs / consensus sequence pairs."""
-        return self.clusters.iteritems()
+        return iter(self.items())
 
     def has_key(self, key):
         """Test for presence of UID"""
-        return key in self.clusters
+        return key in self._clusters
 
     def add(self, uid, sequence):
         """Add a new cluster centre.
@@ -271,16 +841,34 @@ class Clustering(object):
             sequence (:obj:`pyrates.sequence.SequenceWithQuality`): Sequence to represent cluster.
         """
         nameid = uid.sequence
-        self.clusters[nameid] = cons.Consensus(uid, sequence)
+        if isinstance(self._clusters, cons.ClusterTable):
+            self._clusters.add(uid, sequence)
+        else:
+            self._clusters[nameid] = self._consensus(uid, sequence)
+        self._lengths.setdefault(len(sequence), set()).add(nameid)
         self._store.add(nameid)
 
+    def remove(self, uid):
+        """Remove a cluster.
+
+        Args:
+            uid (:obj:`str`): UID of the cluster.
+
+        Raises:
+            KeyError: if there is no cluster with this UID.
+        """
+        cluster = self._clusters[uid]
+        del self._clusters[uid]
+        self._lengths.get(len(cluster), set()).discard(uid)
+        self._store.discard(uid)
+
     def cluster_fails(self):
         """Sequences that were not assigned to any cluster.
 
         Returns:
             :obj:`dict`: UID / sequence pairs
         """
-        return {key:self.clusters[key] for key in self._store.wild_tags}
+        return {key:self._view(key, self._clusters[key]) for key in self._store.wild_tags}
 
     @property
     def fail_count(self):
@@ -289,20 +877,23 @@ class Clustering(object):
         return len(self._store.wild_tags)
 
     def __contains__(self, item):
-        return item in self.clusters
+        return item in self._clusters
 
     def __getitem__(self, key):
-        return self.clusters[key]
+        cluster = self._clusters[key]
+        if isinstance(cluster, cons.Singleton):
+            cluster = self._clusters[key] = cluster.promote(key, self._consensus)
+        return cluster
 
     def __iter__(self):
-        return iter(self.clusters)
+        return iter(self._clusters)
 
     def __len__(self):
-        return len(self.clusters)
+        return len(self._clusters)
 
     def __str__(self):
         str_lst = [str(c) for c in self]
         return "\n".join(str_lst)
 
     def __repr__(self):
-        return "Clustering(centres=%r)" % self.clusters
+        return "Clustering(centres=%r)" % self._clusters
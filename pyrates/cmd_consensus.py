@@ -3,15 +3,21 @@
 
 import argparse
 import datetime
+import os
 import resource
 import time
 import logging
 
 import pyrates.clustering as clust
+import pyrates.consensus as cons
+import pyrates.partition as part
+import pyrates.sequence as pseq
 import pyrates.utils as utils
 from . import __version__
 from ._version import get_versions
 
+UID_INDEX = {'composition':pseq.SequenceStore, 'bktree':pseq.BKTreeStore,
+             'pigeonhole':pseq.PigeonholeStore}
 
 def main():
     """Entrypoint for command-line interface
@@ -58,6 +64,117 @@ def main():
         default=None, required=False, type=int,
         help='Read length used in sequencing.'
     )
+    parser.add_argument(
+        '--iterative-search',
+        action='store_true',
+        help='Search for similar UIDs with one allowed difference first and only allow' +
+        ' more differences if no match is found. Results are unchanged, but this is' +
+        ' usually faster if most UID errors are single substitutions.'
+    )
+    parser.add_argument(
+        '--workers', '-w',
+        default=1, type=int,
+        help='Number of worker processes to use for the search of similar UIDs.'
+    )
+    parser.add_argument(
+        '--readers',
+        default=1, type=int,
+        help='Number of processes used to parse uncompressed input files.'
+    )
+    parser.add_argument(
+        '--uid-cache',
+        metavar='SIZE',
+        type=int,
+        help='Maximum number of corrected UIDs for which the matching cluster is remembered.' +
+        ' By default all of them are remembered. Setting a limit reduces memory usage but' +
+        ' may change the results, because forgotten UIDs can be matched to a different' +
+        ' cluster when they are seen again.'
+    )
+    parser.add_argument(
+        '--packed-uids',
+        action='store_true',
+        help='Store UIDs in a compact binary form. This reduces memory usage for large' +
+        ' datasets but requires UIDs to consist of the letters A, C, G, T and N only.'
+    )
+    parser.add_argument(
+        '--uid-index',
+        choices=sorted(UID_INDEX),
+        default='composition',
+        help='Data structure used to search for similar UIDs. The BK-tree and pigeonhole' +
+        ' indices only consider UIDs within the allowed number of differences and can be' +
+        ' faster for large datasets. The pigeonhole index does not group UIDs by prefix.'
+    )
+    parser.add_argument(
+        '--numpy',
+        action='store_true',
+        help='Use NumPy arrays to compute consensus sequences. This is faster for' +
+        ' datasets with many reads per UID. Requires NumPy to be installed.'
+    )
+    parser.add_argument(
+        '--cluster-table',
+        action='store_true',
+        help='Store all consensus sequences in a single table rather than as separate' +
+        ' objects. This reduces memory usage for datasets with many clusters.'
+    )
+    parser.add_argument(
+        '--index-output',
+        action='store_true',
+        help='Write BGZF compressed output and an index that allows consensus sequences' +
+        ' to be retrieved by UID with pyrates-fetch. The index is written to the output' +
+        ' file name with the suffix .idx.'
+    )
+    parser.add_argument(
+        '--compression-level',
+        metavar='LEVEL',
+        default=6, type=int, choices=range(1, 10),
+        help='Compression level used for output files with a .gz extension, from 1 (fastest)' +
+        ' to 9 (smallest output).'
+    )
+    parser.add_argument(
+        '--write-threads',
+        metavar='THREADS',
+        default=4, type=int,
+        help='Number of threads used to compress the output.'
+    )
+    parser.add_argument(
+        '--sorted-input',
+        action='store_true',
+        help='Input is sorted by UID. Consensus sequences are written as soon as no later' +
+        ' read can be added to them, which reduces memory usage. The results are the same' +
+        ' as for unsorted input.'
+    )
+    parser.add_argument(
+        '--partitions',
+        metavar='COUNT',
+        default=1, type=int,
+        help='Split the input into this many partitions by UID prefix and process one' +
+        ' partition at a time to reduce memory usage. Clusters are matched against the' +
+        ' clusters of all other partitions in a second pass and matching clusters are' +
+        ' combined.'
+    )
+    parser.add_argument(
+        '--tmp-dir',
+        metavar='DIR',
+        help='Directory for partition files. Defaults to the system temporary directory.'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        metavar='FILE',
+        help='Save the state of the clustering to this file at regular intervals.' +
+        ' The file is removed once the output has been written.'
+    )
+    parser.add_argument(
+        '--checkpoint-interval',
+        metavar='SECONDS',
+        default=clust.CHECKPOINT_INTERVAL, type=int,
+        help='Minimum time between checkpoints.'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an interrupted run from the state saved in the checkpoint file,' +
+        ' if it exists. All other options need to be the same as for the original run.'
+    )
     parser.add_argument(
         '--log',
         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
@@ -70,6 +187,16 @@ def main():
         version='%(prog)s ' + __version__
     )
     args = parser.parse_args()
+    if args.numpy and cons.np is None:
+        parser.error('--numpy requires NumPy to be installed')
+    if args.numpy and args.cluster_table:
+        parser.error('--numpy cannot be used with --cluster-table')
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume requires --checkpoint')
+    if args.sorted_input and args.checkpoint is not None:
+        parser.error('--checkpoint cannot be used with --sorted-input')
+    if args.partitions > 1 and (args.sorted_input or args.checkpoint is not None):
+        parser.error('--partitions cannot be used with --sorted-input or --checkpoint')
 
     ## configure logging
     logger = utils.get_logger('pyrates', args.log, [utils.console_handler()])
@@ -86,32 +213,85 @@ def main():
         logger.info('To reduce running time choose a prefix longer than the allowed number' +
                     ' of UID mismatches')
     logger.info('Adapter sequence: %r', args.adapter)
+    logger.info('UID index: %s', args.uid_index)
+    if args.sorted_input:
+        logger.info('Input is sorted by UID')
+        if args.workers > 1:
+            logger.info('Worker processes are not used for sorted input')
+    elif args.workers > 1:
+        logger.info('Worker processes: %d', args.workers)
+    if args.partitions > 1:
+        logger.info('Input partitions: %d', args.partitions)
 
 
     ## start consensus computation
     started_at = time.time()
-    seq = clust.Clustering.from_fastq(input_file=args.fastq, id_length=args.id_length,
-                                      adapter=args.adapter, threshold=args.id_tolerance,
-                                      prefix=args.prefix_length, read_length=args.read_length)
-    seq.write(args.output)
-    if logger.isEnabledFor(logging.INFO):
-        total_different = 0
-        total_shorter = 0
-        total_longer = 0
+    consensus = cons.Consensus
+    if args.numpy:
+        consensus = cons.ArrayConsensus
+    elif args.cluster_table:
+        consensus = cons.ClusterTable
+    if args.sorted_input:
+        windows = clust.Clustering.stream_fastq(input_file=args.fastq, id_length=args.id_length,
+                                                adapter=args.adapter, threshold=args.id_tolerance,
+                                                prefix=args.prefix_length,
+                                                read_length=args.read_length,
+                                                packed=args.packed_uids, consensus=consensus,
+                                                index=UID_INDEX[args.uid_index],
+                                                readers=args.readers,
+                                                deepening=args.iterative_search)
+    elif args.partitions > 1:
+        windows = part.cluster_partitioned(input_file=args.fastq, id_length=args.id_length,
+                                           adapter=args.adapter, prefix=args.prefix_length,
+                                           partitions=args.partitions, tmp_dir=args.tmp_dir,
+                                           threshold=args.id_tolerance,
+                                           read_length=args.read_length,
+                                           workers=args.workers, packed=args.packed_uids,
+                                           consensus=consensus,
+                                           index=UID_INDEX[args.uid_index],
+                                           cache_size=args.uid_cache,
+                                           readers=args.readers,
+                                           deepening=args.iterative_search)
+    else:
+        windows = [clust.Clustering.from_fastq(input_file=args.fastq, id_length=args.id_length,
+                                               adapter=args.adapter, threshold=args.id_tolerance,
+                                               prefix=args.prefix_length,
+                                               read_length=args.read_length,
+                                               workers=args.workers, packed=args.packed_uids,
+                                               consensus=consensus,
+                                               index=UID_INDEX[args.uid_index],
+                                               cache_size=args.uid_cache,
+                                               checkpoint=args.checkpoint,
+                                               checkpoint_interval=args.checkpoint_interval,
+                                               resume=args.resume,
+                                               readers=args.readers,
+                                               deepening=args.iterative_search)]
+    totals = {'clusters':0, 'different':0, 'shorter':0, 'longer':0, 'failed':0}
 
-        for uid in seq:
-            total_different += seq[uid].different
-            total_shorter += seq[uid].shorter
-            total_longer += seq[uid].longer
-        logger.info("Number of consensus sequence with unique labels: %d", len(seq))
+    def tally(windows):
+        for seq in windows:
+            totals['failed'] += seq.fail_count
+            for (uid, cluster) in seq.items():
+                totals['clusters'] += 1
+                totals['different'] += cluster.different
+                totals['shorter'] += cluster.shorter
+                totals['longer'] += cluster.longer
+                yield uid, cluster
+
+    clust.write_consensus(args.output, tally(windows), level=args.compression_level,
+                          threads=args.write_threads, indexed=args.index_output)
+    if args.checkpoint is not None and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Number of consensus sequence with unique labels: %d", totals['clusters'])
         logger.info("Number sequences grossly different from consensus with same label: %d",
-                    total_different)
+                    totals['different'])
         logger.info("Number of sequences that were shorter than consensus sequence: %d",
-                    total_shorter)
+                    totals['shorter'])
         logger.info("Number of sequences that were longer then consensus sequence %d",
-                    total_longer)
+                    totals['longer'])
         logger.info("Number of sequences with corrupted label %d (%.2f%%)",
-                    seq.fail_count, seq.fail_count/float(len(seq))*100)
+                    totals['failed'], totals['failed']/float(max(totals['clusters'], 1))*100)
     logger.info('Total time taken: %s', str(datetime.timedelta(seconds=time.time() - started_at)))
     mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
     logger.info('Memory used: %.2f MB', mem)
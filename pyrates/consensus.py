@@ -1,9 +1,208 @@
 """Functions to facilitate consensus calling.
 """
 
-from collections import defaultdict
+from array import array
+import pyrates.sequence as pseq
 import pyrates.utils as utils
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _unwrap(seq):
+    """Sequence and qualities of a :obj:`pyrates.sequence.SequenceWithQuality`
+    or of a (sequence, quality) pair."""
+    if isinstance(seq, tuple):
+        return seq
+    return seq.sequence, seq.quality
+
+def _as_array(value):
+    """View ASCII string as array of bytes."""
+    return np.frombuffer(value.encode('ascii'), dtype=np.uint8)
+
+class DiffCounts(object):
+    """Nucleotide counts for positions at which differences between reads were observed.
+
+    Counts are stored in a flat array of 32 bit integers with one row per observed
+    position and one column per nucleotide. Rows are added as positions are observed
+    and their offsets are recorded by position, so the space used depends on the number
+    of variable positions rather than the sequence length. Counts for characters other
+    than *A*, *C*, *G*, *N* and *T* are kept separately.
+
+    This behaves like a mapping of positions to the nucleotide counts observed at that
+    position. Only positions for which counts were recorded are included.
+    """
+    __slots__ = '_counts', '_rows', '_other'
+    _alphabet = 'ACGNT'
+    _columns = {nuc:i for (i, nuc) in enumerate('ACGNT')}
+    _empty = array('i', [0])*5
+
+    def __init__(self):
+        self._counts = None
+        self._rows = None
+        self._other = None
+
+    def get(self, pos, nuc):
+        """Number of times a nucleotide was observed at a position."""
+        if self._rows is None or pos not in self._rows:
+            return 0
+        col = self._columns.get(nuc)
+        if col is None:
+            return self._other.get((pos, nuc), 0) if self._other else 0
+        return self._counts[self._rows[pos] + col]
+
+    def _row(self, pos):
+        """Offset of the counts for a position, adding a row if necessary."""
+        if self._rows is None:
+            self._counts = array('i')
+            self._rows = {}
+        offset = self._rows.get(pos)
+        if offset is None:
+            offset = self._rows[pos] = len(self._counts)
+            self._counts.extend(self._empty)
+        return offset
+
+    def add(self, pos, nuc, count):
+        """Add to the count for a nucleotide at a position."""
+        offset = self._row(pos)
+        col = self._columns.get(nuc)
+        if col is None:
+            if self._other is None:
+                self._other = {}
+            self._other[(pos, nuc)] = self._other.get((pos, nuc), 0) + count
+        else:
+            self._counts[offset + col] += count
+
+    def merge(self, other):
+        """Add counts from another collection of differences.
+
+        Args:
+            other: A :obj:`DiffCounts` object or a :obj:`dict` mapping positions to
+                nucleotide counts.
+        """
+        if isinstance(other, DiffCounts):
+            if not other:
+                return
+            for (pos, other_offset) in other._rows.items():
+                offset = self._row(pos)
+                for col in range(5):
+                    self._counts[offset + col] += other._counts[other_offset + col]
+            if other._other:
+                for ((pos, nuc), count) in other._other.items():
+                    self.add(pos, nuc, count)
+        else:
+            for pos in other:
+                for nuc in other[pos]:
+                    self.add(pos, nuc, other[pos][nuc])
+
+    def counts(self, pos):
+        """Nucleotides observed at a position together with their counts.
+
+        Returns:
+            :obj:`list`: (nucleotide, count) pairs, sorted by nucleotide.
+        """
+        if self._rows is None or pos not in self._rows:
+            return []
+        offset = self._rows[pos]
+        observed = [(nuc, self._counts[offset + col]) for (col, nuc) in enumerate(self._alphabet)
+                    if self._counts[offset + col]]
+        if self._other:
+            observed.extend((key[1], count) for (key, count) in self._other.items()
+                            if key[0] == pos)
+            observed.sort()
+        return observed
+
+    def to_dict(self):
+        """Convert differences to a :obj:`dict` of :obj:`dict`."""
+        return {pos:dict(self.counts(pos)) for pos in self}
+
+    def __getitem__(self, pos):
+        return _DiffRow(self, pos)
+
+    def __contains__(self, pos):
+        return self._rows is not None and pos in self._rows
+
+    def __iter__(self):
+        if self._rows is None:
+            return iter([])
+        return iter(sorted(self._rows))
+
+    def __len__(self):
+        return 0 if self._rows is None else len(self._rows)
+
+    def __eq__(self, other):
+        if isinstance(other, DiffCounts):
+            return self.to_dict() == other.to_dict()
+        try:
+            return self.to_dict() == {pos:dict(other[pos]) for pos in other}
+        except (TypeError, KeyError):
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return (self._counts, self._rows, self._other)
+
+    def __setstate__(self, state):
+        (self._counts, self._rows, self._other) = state
+
+    def __str__(self):
+        return ' '.join(str(pos + 1) + ''.join(nuc + str(count) for (nuc, count)
+                                               in self.counts(pos))
+                        for pos in self)
+
+    def __repr__(self):
+        return "DiffCounts(%r)" % self.to_dict()
+
+class _DiffRow(object):
+    """Nucleotide counts at a single position of a :obj:`DiffCounts` object."""
+    __slots__ = '_diffs', '_pos'
+
+    def __init__(self, diffs, pos):
+        self._diffs = diffs
+        self._pos = pos
+
+    def items(self):
+        """(nucleotide, count) pairs."""
+        return self._diffs.counts(self._pos)
+
+    def keys(self):
+        """Observed nucleotides."""
+        return [nuc for (nuc, _) in self.items()]
+
+    def __getitem__(self, nuc):
+        return self._diffs.get(self._pos, nuc)
+
+    def __setitem__(self, nuc, value):
+        self._diffs.add(self._pos, nuc, value - self._diffs.get(self._pos, nuc))
+
+    def __contains__(self, nuc):
+        return self._diffs.get(self._pos, nuc) > 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
 class Consensus(object):
     """Consensus sequence inferred from observed read sequences.
 
@@ -21,7 +220,7 @@ class Consensus(object):
             consensus sequence.
         sequence (:obj:`pyrates.sequence.SequenceWithQuality`): The
             consensus sequence.
-        diffs (:obj:`dict`): A collection of all sequence
+        diffs (:obj:`DiffCounts`): A collection of all sequence
             differences observed between the consensus and the
             underlying reads.
         size (:obj:`int`): Number of reads used to compute the consensus.
@@ -37,7 +236,7 @@ class Consensus(object):
     def __init__(self, uid, sequence):
         self.uid = uid
         self.sequence = sequence
-        self.diffs = defaultdict(lambda: defaultdict(int))
+        self.diffs = DiffCounts()
         self.size = 1
         self.different = 0
         self.shorter = 0
@@ -55,10 +254,11 @@ class Consensus(object):
 
         Args:
             uid_other (:obj:`pyrates.sequence.SequenceWithQuality`): UID
-                sequence with associated qualities.
+                sequence with associated qualities. A (sequence, quality)
+                pair is accepted as well.
         """
         qual_update = list(self.uid.quality)
-        for (i, qual_other) in enumerate(uid_other.quality):
+        for (i, qual_other) in enumerate(_unwrap(uid_other)[1]):
             if qual_other > qual_update[i]:
                 qual_update[i] = qual_other
         self.uid.quality = ''.join(qual_update)
@@ -67,7 +267,10 @@ class Consensus(object):
                max_dist=0.02):
         """Update consensus sequence.
 
-        The read represented by `seq_other` is added to the consensus.
+        The read represented by `seq_other` is added to the consensus. The UID and
+        read may also be given as plain (sequence, quality) pairs, which avoids
+        creating :obj:`pyrates.sequence.SequenceWithQuality` objects for reads
+        that are merged into an existing consensus.
 
         Args:
             uid_other (:obj:`pyrates.sequence.SequenceWithQuality`): UID
@@ -77,8 +280,9 @@ class Consensus(object):
                 added to the consensus.
             size_other (:obj:`int`, optional): Treat the sequence provided for
                 updating as a representative of this many sequences.
-            diffs_other (:obj:`dict`, optional): Differences already recorded
-                for other sequence.
+            diffs_other (:obj:`DiffCounts`, optional): Differences already recorded
+                for other sequence. A :obj:`dict` mapping positions to nucleotide
+                counts is accepted as well.
             discard (:obj:`bool`, optional): If this is `True` sequences that
                 are rejected for consensus computations are counted and are
                 assumed to be excluded from further concideration. They are
@@ -92,17 +296,21 @@ class Consensus(object):
             :obj:`bool`: `True` if the sequence was successfully added to the
                 consensus, `False` otherwise.
         """
+        uid_other = _unwrap(uid_other)
+        read = seq_other
+        seq_other = _unwrap(seq_other)
         # better do some sanity checking
-        if len(self.uid) != len(uid_other):
+        if self._uid_length() != len(uid_other[0]):
             self._logger.error("Mismatch in id quality length, this should not happen. " +
                                "Check your input.")
             self._logger.debug("Mismatching quality strings were '%s' and '%s'",
-                               self.uid.sequence, uid_other.sequence)
+                               self.uid.sequence, uid_other[0])
             return False
 
         # if sequence length is shorter, count this occurance, abandon this
         # sequence and move on
-        if len(self.sequence) > len(seq_other):
+        seq_length = self._length()
+        if seq_length > len(seq_other[0]):
             if discard:
                 self.shorter += size_other
             self._logger.debug("Mismatch in sequence length")
@@ -110,18 +318,19 @@ class Consensus(object):
 
         # if new sequence is longer, count this occurance
         # replace consensus sequence if built from only one other sequence
-        if len(self.sequence) < len(seq_other):
+        if seq_length < len(seq_other[0]):
             if discard:
                 if self.size == 1:
-                    self.sequence = seq_other
+                    if isinstance(read, tuple):
+                        read = pseq.SequenceWithQuality(read[0], read[1], self.sequence.name)
+                    self.sequence = read
                     self.shorter += size_other
                 else: self.longer += size_other
             self._logger.debug("Mismatch in sequence length")
             return False
 
         # if grossly different then just count this and move on
-        if self.sequence.grosslydifferent(seq_other, length=10,
-                                          tolerance=max_dist*len(self.sequence)):
+        if self._grosslydifferent(seq_other[0], length=10, tolerance=max_dist*seq_length):
             if discard:
                 self.different += size_other
             self._logger.debug("Sequences are too different")
@@ -129,27 +338,79 @@ class Consensus(object):
 
 
         self._update_uid(uid_other)
+        self._update_sequence(seq_other, size_other, diffs_other)
+        self.size += size_other
+        return True
+
+    def grosslydifferent(self, seq_other, length=10, tolerance=7):
+        """Compare prefix of consensus sequence to another sequence.
+
+        See :meth:`pyrates.sequence.SequenceWithQuality.grosslydifferent`.
+
+        Args:
+            seq_other: Read sequence as :obj:`str`, (sequence, quality) pair or
+                :obj:`pyrates.sequence.SequenceWithQuality`.
+            length (:obj:`int`, optional): length of the prefix to test.
+            tolerance (:obj:`int`, optional): Maximum number of mismatches allowed.
+        """
+        if not isinstance(seq_other, str):
+            seq_other = _unwrap(seq_other)[0]
+        return self._grosslydifferent(seq_other, length, tolerance)
+
+    def _length(self):
+        """Length of the consensus sequence."""
+        return len(self.sequence)
+
+    def _uid_length(self):
+        """Length of the UID."""
+        return len(self.uid)
+
+    def _get_sequence(self):
+        """Consensus sequence and qualities as :obj:`str`."""
+        return self.sequence.sequence, self.sequence.quality
+
+    def _set_sequence(self, sequence, quality):
+        """Replace consensus sequence and qualities with strings of the same length."""
+        self.sequence.sequence = sequence
+        self.sequence.quality = quality
+
+    def _grosslydifferent(self, seq_other, length, tolerance):
+        """Compare prefix of consensus sequence to another sequence :obj:`str`."""
+        seq = self.sequence.sequence
+        diff = 0
+        for i in range(length):
+            if seq[i] != seq_other[i]:
+                diff = diff + 1
+        return diff > tolerance
 
+    def _update_sequence(self, seq_other, size_other, diffs_other):
+        """Update consensus sequence, qualities and differences.
+
+        Args:
+            seq_other (:obj:`tuple`): Sequence and qualities of a read
+                of the same length as the consensus.
+            size_other (:obj:`int`): Number of sequences represented by `seq_other`.
+            diffs_other (:obj:`DiffCounts`): Differences already recorded for other
+                sequence or `None`.
+        """
         # Step through sequence, record highest quality at each step, want to save diffs
         # for changes to the sequence but not the quality.
         # If we encounter a mismatch between consensus and newly observed read,
         # keep the current sequence
-        seq_update = self.sequence.sequence
-        qual_update = self.sequence.quality
-        qual_other = seq_other.quality
-        seq_other = seq_other.sequence
+        (seq_update, qual_update) = self._get_sequence()
+        (seq_other, qual_other) = seq_other
         max_qual = list(map(max, zip(zip(qual_other, [0]*len(qual_other), seq_other),
                                      zip(qual_update, [1]*len(qual_update), seq_update))))
         qual_update = [q[0] for q in max_qual]
         diff = [s != o for s, o in zip(seq_update, seq_other)]
         if diffs_other is None:
             diffs_other = {}
+        diffs = self.diffs
         if diffs_other:
             for i in diffs_other:
-                if i not in self.diffs:
-                    self.diffs[i][seq_update[i]] += self.size
-                for nuc in diffs_other[i]:
-                    self.diffs[i][nuc] += diffs_other[i][nuc]
+                if i not in diffs:
+                    diffs.add(i, seq_update[i], self.size)
+            diffs.merge(diffs_other)
         if any(diff):
             for (i, is_diff) in enumerate(diff):
                 # check if new sequence has different nucleotide at this position
@@ -158,22 +419,19 @@ class Consensus(object):
                         nuc = seq_update[i]
                         nuc_other = seq_other[i]
                         # update diff to record reading discrepancy at this position
-                        if self.diffs[i][nuc] == 0:
+                        if diffs.get(i, nuc) == 0:
                             # update for count seen so far
-                            self.diffs[i][nuc] = self.size
-                        self.diffs[i][nuc_other] += size_other
-                elif i in self.diffs:
-                    self.diffs[i][seq_update[i]] += size_other
-            seq_update = [q[2] for q in max_qual]
-            self.sequence.sequence = ''.join(seq_update)
-        elif self.diffs and not diffs_other:
-            for i in self.diffs:
-                self.diffs[i][seq_update[i]] += size_other
-        self.size += size_other
+                            diffs.add(i, nuc, self.size)
+                        diffs.add(i, nuc_other, size_other)
+                elif i in diffs:
+                    diffs.add(i, seq_update[i], size_other)
+            seq_update = ''.join([q[2] for q in max_qual])
+        elif diffs and not diffs_other:
+            for i in diffs:
+                diffs.add(i, seq_update[i], size_other)
 
         # regardless of sequence values we will remember the highest quality value
-        self.sequence.quality = ''.join(map(max, zip(qual_update, qual_other)))
-        return True
+        self._set_sequence(seq_update, ''.join(map(max, zip(qual_update, qual_other))))
 
     def merge(self, other, tolerance, max_dist=0.02):
         """Merge two consensus sequences.
@@ -197,16 +455,11 @@ class Consensus(object):
         return self.update(other.uid, other.sequence, other.size, diffs_other=other.diffs,
                            discard=False, max_dist=max_dist)
 
+    def __len__(self):
+        return self._length()
+
     def __str__(self):
-        diff_str = ''
-        diff_pos = sorted(self.diffs)
-        diff_str = []
-        for pos in diff_pos:
-            pos_diff = str(pos+1)
-            for nuc in sorted(self.diffs[pos]):
-                pos_diff += nuc + str(self.diffs[pos][nuc])
-            diff_str.append(pos_diff)
-        diff_str = ' '.join(diff_str)
+        diff_str = str(self.diffs)
         return "@%s:%s:%s:%d:%d:%d:%d\n%s\n+%s\n%s" % (self.sequence.name,
                                                        self.uid.sequence, self.uid.quality,
                                                        self.size, self.shorter, self.longer,
@@ -216,4 +469,464 @@ class Consensus(object):
 
     def __repr__(self):
         return "Consensus(uid=%r, sequence=%r, diffs=%r, size=%r)" % \
-                         (self.uid, self.sequence, dict(self.diffs), self.size)
+                         (self.uid, self.sequence, self.diffs.to_dict(), self.size)
+
+class ArrayConsensus(Consensus):
+    """Consensus sequence with sequence and qualities stored as arrays.
+
+    This produces the same results as :obj:`Consensus` but merges reads into the
+    consensus with a small number of vectorised operations rather than by stepping
+    through the sequence. This is considerably faster for clusters containing many
+    reads. Requires NumPy.
+
+    Note:
+        The :obj:`pyrates.sequence.SequenceWithQuality` returned by the `sequence`
+        attribute is created on demand. Changes to the sequence or qualities of this
+        object are not reflected in the consensus; assign a new sequence instead.
+
+    Args:
+        uid (:obj:`pyrates.sequence.SequenceWithQuality`): The
+            unique molecular identifier associated with this
+            sequence.
+        sequence (:obj:`pyrates.sequence.SequenceWithQuality`): The
+            sequence of the first read that serves as the basis for the
+            subsequent consensus computations.
+
+    Raises:
+        ImportError: if NumPy is not available.
+    """
+    __slots__ = '_bases', '_quals', '_name', '_sequence'
+
+    def __init__(self, uid, sequence):
+        if np is None:
+            raise ImportError("ArrayConsensus requires NumPy.")
+        super(ArrayConsensus, self).__init__(uid, sequence)
+
+    @property
+    def sequence(self):
+        """The consensus sequence as :obj:`pyrates.sequence.SequenceWithQuality`."""
+        if self._sequence is None:
+            self._sequence = pseq.SequenceWithQuality(self._bases.tobytes().decode('ascii'),
+                                                      self._quals.tobytes().decode('ascii'),
+                                                      self._name)
+        return self._sequence
+
+    @sequence.setter
+    def sequence(self, value):
+        self._bases = _as_array(value.sequence).copy()
+        self._quals = _as_array(value.quality).copy()
+        self._name = value.name
+        self._sequence = value
+
+    def _length(self):
+        return len(self._bases)
+
+    def _grosslydifferent(self, seq_other, length, tolerance):
+        mismatch = self._bases[:length] != _as_array(seq_other[:length])
+        return int(mismatch.sum()) > tolerance
+
+    def _update_sequence(self, seq_other, size_other, diffs_other):
+        bases = self._bases
+        (seq_other, qual_other) = seq_other
+        bases_other = _as_array(seq_other)
+        quals_other = _as_array(qual_other)
+        if self._sequence is not None:
+            self._name = self._sequence.name
+            self._sequence = None
+        if diffs_other is None:
+            diffs_other = {}
+        diffs = self.diffs
+        if diffs_other:
+            for i in diffs_other:
+                if i not in diffs:
+                    diffs.add(i, chr(bases[i]), self.size)
+            diffs.merge(diffs_other)
+        diff = np.flatnonzero(bases != bases_other).tolist()
+        if diff:
+            for i in diff:
+                if i not in diffs_other:
+                    nuc = chr(bases[i])
+                    # update diff to record reading discrepancy at this position
+                    if diffs.get(i, nuc) == 0:
+                        # update for count seen so far
+                        diffs.add(i, nuc, self.size)
+                    diffs.add(i, seq_other[i], size_other)
+            diff = set(diff)
+            for i in [pos for pos in diffs if pos not in diff]:
+                diffs.add(i, chr(bases[i]), size_other)
+            # keep the consensus base unless the new read has higher quality
+            np.copyto(bases, bases_other, where=quals_other > self._quals)
+        elif diffs and not diffs_other:
+            for i in diffs:
+                diffs.add(i, chr(bases[i]), size_other)
+        np.maximum(self._quals, quals_other, out=self._quals)
+
+class Singleton(object):
+    """Compact representation of a cluster that consists of a single read.
+
+    Most clusters never receive a second read. Storing them as plain strings avoids
+    creating a full consensus object, with its sequence and difference records, for
+    each of them. A singleton is converted with :meth:`promote` once another read
+    is added.
+
+    Args:
+        uid_quality (:obj:`str`): Qualities of the UID.
+        sequence (:obj:`str`): Read sequence.
+        quality (:obj:`str`): Read qualities.
+        name (:obj:`str`, optional): Name of the read sequence.
+    """
+    __slots__ = 'uid_quality', 'sequence', 'quality', 'name'
+
+    def __init__(self, uid_quality, sequence, quality, name=''):
+        self.uid_quality = uid_quality
+        self.sequence = sequence
+        self.quality = quality
+        self.name = name
+
+    def grosslydifferent(self, seq_other, length=10, tolerance=7):
+        """Compare prefix of the read sequence to another sequence :obj:`str`.
+
+        See :meth:`Consensus.grosslydifferent`.
+        """
+        diff = 0
+        for i in range(length):
+            if self.sequence[i] != seq_other[i]:
+                diff = diff + 1
+        return diff > tolerance
+
+    def promote(self, uid, consensus=Consensus):
+        """Create a full consensus sequence for this cluster.
+
+        Args:
+            uid (:obj:`str`): UID of the cluster.
+            consensus (:obj:`type`, optional): Class used to represent the consensus.
+
+        Returns:
+            :obj:`Consensus`: Consensus sequence equivalent to this singleton.
+        """
+        return consensus(pseq.SequenceWithQuality(uid, self.uid_quality),
+                         pseq.SequenceWithQuality(self.sequence, self.quality, self.name))
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __repr__(self):
+        return "Singleton(uid_quality=%r, sequence=%r, quality=%r, name=%r)" % \
+               (self.uid_quality, self.sequence, self.quality, self.name)
+
+class ClusterTable(object):
+    """Consensus sequences of many clusters stored in a column oriented table.
+
+    Each cluster occupies a row of the table. UIDs and their qualities are kept in
+    fixed width byte arrays, consensus sequences and qualities in a shared byte array
+    indexed by start position and length, and the read counts in integer arrays. This
+    avoids the overhead of separate Python objects for each cluster. Sequence differences
+    are only stored for clusters in which differences were observed.
+
+    The table behaves like a mapping of UIDs to consensus sequences. Consensus sequences
+    are returned as :obj:`TableConsensus` objects, which are created on demand and
+    modify the table when updated.
+
+    Args:
+        centres (:obj:`dict`, optional): Existing consensus sequences, identified by UID,
+            that are copied into the table.
+
+    Attributes:
+        size (:obj:`array.array`): Number of reads used to compute each consensus.
+        different (:obj:`array.array`): Number of reads rejected for each cluster
+            because they were too different from the consensus.
+        shorter (:obj:`array.array`): Number of reads rejected for each cluster because
+            they were too short.
+        longer (:obj:`array.array`): Number of reads rejected for each cluster because
+            they were too long.
+    """
+    __slots__ = ('_rows', '_uids', '_uid_quals', '_uid_length', '_bases', '_quals',
+                 '_starts', '_lengths', '_names', '_diffs', '_unused',
+                 'size', 'different', 'shorter', 'longer')
+
+    def __init__(self, centres=None):
+        self._rows = {}
+        self._uids = bytearray()
+        self._uid_quals = bytearray()
+        self._uid_length = None
+        self._bases = bytearray()
+        self._quals = bytearray()
+        self._starts = array('q')
+        self._lengths = array('l')
+        self._names = []
+        self._diffs = {}
+        self._unused = 0
+        self.size = array('l')
+        self.different = array('l')
+        self.shorter = array('l')
+        self.longer = array('l')
+        if centres:
+            for (uid, consensus) in centres.items():
+                self[uid] = consensus
+
+    def add(self, uid, sequence):
+        """Add a new cluster.
+
+        Args:
+            uid (:obj:`pyrates.sequence.SequenceWithQuality`): UID for the new cluster.
+            sequence (:obj:`pyrates.sequence.SequenceWithQuality`): Sequence of the first
+                read in the cluster.
+
+        Returns:
+            :obj:`TableConsensus`: The consensus sequence of the new cluster.
+
+        Raises:
+            ValueError: if the UID is already present or differs in length from the
+                UIDs in the table.
+        """
+        if uid.sequence in self._rows:
+            raise ValueError("Duplicate UID %r" % uid.sequence)
+        if self._uid_length is None:
+            self._uid_length = len(uid)
+        elif len(uid) != self._uid_length:
+            raise ValueError("UID of length %d expected, got %r" % (self._uid_length,
+                                                                    uid.sequence))
+        row = len(self._names)
+        self._rows[uid.sequence] = row
+        self._uids.extend(uid.sequence.encode('ascii'))
+        self._uid_quals.extend(uid.quality.encode('ascii'))
+        self._starts.append(len(self._bases))
+        self._lengths.append(len(sequence))
+        self._bases.extend(sequence.sequence.encode('ascii'))
+        self._quals.extend(sequence.quality.encode('ascii'))
+        self._names.append(sequence.name)
+        self.size.append(1)
+        self.different.append(0)
+        self.shorter.append(0)
+        self.longer.append(0)
+        return TableConsensus(self, row)
+
+    def _sequence(self, row):
+        """Sequence and qualities of a row as :obj:`str`."""
+        start = self._starts[row]
+        end = start + self._lengths[row]
+        return str(self._bases[start:end], 'ascii'), str(self._quals[start:end], 'ascii')
+
+    def _set_sequence(self, row, sequence, quality):
+        """Replace sequence and qualities of a row.
+
+        Sequences that don't fit into the space used by the current sequence are
+        appended to the end of the table. Space that is no longer used is reclaimed
+        by :meth:`_compact` once it makes up half of the table.
+        """
+        length = len(sequence)
+        if length > self._lengths[row]:
+            if self._unused + self._lengths[row] > len(self._bases)//2:
+                self._compact()
+            self._unused += self._lengths[row]
+            self._starts[row] = len(self._bases)
+            self._bases.extend(b' '*length)
+            self._quals.extend(b' '*length)
+        else:
+            self._unused += self._lengths[row] - length
+        start = self._starts[row]
+        self._bases[start:start + length] = sequence.encode('ascii')
+        self._quals[start:start + length] = quality.encode('ascii')
+        self._lengths[row] = length
+
+    def _compact(self):
+        """Copy the sequences of all rows into new arrays without unused space."""
+        bases = bytearray()
+        quals = bytearray()
+        for row in sorted(self._rows.values(), key=lambda row: self._starts[row]):
+            start = self._starts[row]
+            end = start + self._lengths[row]
+            self._starts[row] = len(bases)
+            bases.extend(self._bases[start:end])
+            quals.extend(self._quals[start:end])
+        self._bases = bases
+        self._quals = quals
+        self._unused = 0
+
+    def __setitem__(self, uid, consensus):
+        if uid != consensus.uid.sequence:
+            raise ValueError("UID %r doesn't match consensus %r" % (uid, consensus.uid.sequence))
+        view = self.add(consensus.uid, consensus.sequence)
+        view.size = consensus.size
+        view.different = consensus.different
+        view.shorter = consensus.shorter
+        view.longer = consensus.longer
+        if consensus.diffs:
+            view.diffs.merge(consensus.diffs)
+
+    def __getitem__(self, uid):
+        return TableConsensus(self, self._rows[uid])
+
+    def __delitem__(self, uid):
+        ## the row stays in the table, but its sequence space can be reclaimed
+        row = self._rows.pop(uid)
+        self._diffs.pop(row, None)
+        self._unused += self._lengths[row]
+
+    def __contains__(self, uid):
+        return uid in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def keys(self):
+        """UIDs of all clusters."""
+        return self._rows.keys()
+
+    def values(self):
+        """Consensus sequences of all clusters."""
+        return (TableConsensus(self, row) for row in self._rows.values())
+
+    def items(self):
+        """UID / consensus sequence pairs."""
+        return ((uid, TableConsensus(self, row)) for (uid, row) in self._rows.items())
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for (slot, value) in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return "ClusterTable(<%d clusters>)" % len(self)
+
+class TableConsensus(Consensus):
+    """Consensus sequence stored in a row of a :obj:`ClusterTable`.
+
+    This provides the same interface as :obj:`Consensus`. All attributes are read
+    from and written to the table.
+
+    Note:
+        The :obj:`pyrates.sequence.SequenceWithQuality` objects returned by the `uid`
+        and `sequence` attributes are created on demand. Changes to them are not
+        reflected in the consensus; assign a new sequence instead.
+
+    Args:
+        table (:obj:`ClusterTable`): Table holding the consensus sequence.
+        row (:obj:`int`): Row of the consensus sequence in the table.
+    """
+    __slots__ = '_table', '_row'
+
+    def __init__(self, table, row):
+        # pylint: disable=super-init-not-called
+        self._table = table
+        self._row = row
+
+    @property
+    def uid(self):
+        """The UID as :obj:`pyrates.sequence.SequenceWithQuality`."""
+        table = self._table
+        start = self._row*table._uid_length
+        end = start + table._uid_length
+        return pseq.SequenceWithQuality(str(table._uids[start:end], 'ascii'),
+                                        str(table._uid_quals[start:end], 'ascii'))
+
+    @property
+    def sequence(self):
+        """The consensus sequence as :obj:`pyrates.sequence.SequenceWithQuality`."""
+        (sequence, quality) = self._table._sequence(self._row)
+        return pseq.SequenceWithQuality(sequence, quality, self._table._names[self._row])
+
+    @sequence.setter
+    def sequence(self, value):
+        self._table._set_sequence(self._row, value.sequence, value.quality)
+        self._table._names[self._row] = value.name
+
+    @property
+    def diffs(self):
+        """Differences between the consensus and the underlying reads as :obj:`DiffCounts`."""
+        diffs = self._table._diffs.get(self._row)
+        if diffs is None:
+            diffs = self._table._diffs[self._row] = DiffCounts()
+        return diffs
+
+    @property
+    def size(self):
+        """Number of reads used to compute the consensus."""
+        return self._table.size[self._row]
+
+    @size.setter
+    def size(self, value):
+        self._table.size[self._row] = value
+
+    @property
+    def different(self):
+        """Number of reads rejected because they were too different."""
+        return self._table.different[self._row]
+
+    @different.setter
+    def different(self, value):
+        self._table.different[self._row] = value
+
+    @property
+    def shorter(self):
+        """Number of reads rejected because they were too short."""
+        return self._table.shorter[self._row]
+
+    @shorter.setter
+    def shorter(self, value):
+        self._table.shorter[self._row] = value
+
+    @property
+    def longer(self):
+        """Number of reads rejected because they were too long."""
+        return self._table.longer[self._row]
+
+    @longer.setter
+    def longer(self, value):
+        self._table.longer[self._row] = value
+
+    def _length(self):
+        return self._table._lengths[self._row]
+
+    def _uid_length(self):
+        return self._table._uid_length
+
+    def _get_sequence(self):
+        return self._table._sequence(self._row)
+
+    def _set_sequence(self, sequence, quality):
+        self._table._set_sequence(self._row, sequence, quality)
+
+    def _grosslydifferent(self, seq_other, length, tolerance):
+        start = self._table._starts[self._row]
+        prefix = self._table._bases[start:start + length]
+        diff = 0
+        for (nuc, nuc_other) in zip(prefix, seq_other[:length].encode('ascii')):
+            if nuc != nuc_other:
+                diff += 1
+        return diff > tolerance
+
+    def _update_uid(self, uid_other):
+        table = self._table
+        start = self._row*table._uid_length
+        end = start + table._uid_length
+        quals = table._uid_quals
+        quals[start:end] = bytes(map(max, zip(quals[start:end],
+                                              _unwrap(uid_other)[1].encode('ascii'))))
+
+    def _update_sequence(self, seq_other, size_other, diffs_other):
+        if not diffs_other and self._row not in self._table._diffs:
+            (sequence, quality) = self._get_sequence()
+            if sequence == seq_other[0]:
+                # identical reads only affect the qualities
+                self._set_sequence(sequence, ''.join(map(max, zip(quality, seq_other[1]))))
+                return
+        super(TableConsensus, self)._update_sequence(seq_other, size_other, diffs_other)
+
+    def __str__(self):
+        table = self._table
+        row = self._row
+        diffs = table._diffs.get(row)
+        (sequence, quality) = table._sequence(row)
+        uid = self.uid
+        return "@%s:%s:%s:%d:%d:%d:%d\n%s\n+%s\n%s" % (table._names[row],
+                                                       uid.sequence, uid.quality,
+                                                       table.size[row], table.shorter[row],
+                                                       table.longer[row], table.different[row],
+                                                       sequence, str(diffs) if diffs else '',
+                                                       quality)
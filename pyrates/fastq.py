@@ -0,0 +1,527 @@
+"""Fast reading of FASTQ files.
+
+Records are parsed from large blocks of input rather than line by line. This
+avoids most of the per-line overhead of iterating over the file and makes it
+cheap to hand complete batches of reads to later processing steps.
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import io
+import mmap
+import multiprocessing
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+import pyrates.utils as utils
+
+BLOCK_SIZE = 4*1024*1024
+PREFETCH = 4
+COMPRESSION_LEVEL = 6
+
+## external programs used to decompress gzip files, in order of preference
+DECOMPRESSORS = ('pigz', 'igzip', 'gzip')
+
+class _Pipe(object):
+    """Text stream produced by an external decompression program.
+
+    Args:
+        command (:obj:`list`): Command to run. The program is expected to
+            write the decompressed data to stdout.
+    """
+    __slots__ = '_process', '_stream', '_eof'
+
+    def __init__(self, command):
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        self._stream = io.TextIOWrapper(self._process.stdout, encoding='ascii')
+        self._eof = False
+
+    def read(self, size=-1):
+        """Read up to `size` characters."""
+        data = self._stream.read(size)
+        if not data:
+            self._eof = True
+        return data
+
+    def close(self):
+        """Close the stream and wait for the decompression program to exit.
+
+        Raises:
+            IOError: if the input was read completely but the decompression
+            program reported an error.
+        """
+        if self._eof:
+            status = self._process.wait()
+            self._stream.close()
+        else:
+            self._stream.close()
+            self._process.terminate()
+            status = self._process.wait()
+        if self._eof and status != 0:
+            raise IOError("%r failed with exit status %d" % (self._process.args, status))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_fastq(file_name, external=True):
+    """Open a FASTQ file for reading.
+
+    Compressed files are decompressed by an external program if one of
+    :data:`DECOMPRESSORS` is available. This moves decompression into a separate
+    process that runs concurrently with the processing of the reads.
+
+    Args:
+        file_name (:obj:`str`): Name of the file to open. Files with a *.gz*
+            extension are assumed to be gzip compressed.
+        external (:obj:`bool`, optional): Whether an external program should be used
+            to decompress gzip compressed files.
+
+    Returns:
+        A file object that produces the content of the file as text.
+    """
+    if external and file_name.endswith('.gz'):
+        for program in DECOMPRESSORS:
+            path = shutil.which(program)
+            if path is not None:
+                return _Pipe([path, '-dc', file_name])
+    open_fun = utils.smart_open(file_name)
+    return open_fun(file_name, 'rt')
+
+def prefetch(iterable, size=PREFETCH):
+    """Iterate over items produced by a background thread.
+
+    The thread fetches items from `iterable` ahead of time and keeps up to `size`
+    of them in a queue. This allows input to be read and parsed while previous items
+    are processed. Exceptions raised by `iterable` are passed on to the caller.
+    Close the returned generator to stop the background thread early.
+
+    Args:
+        iterable: Items to fetch.
+        size (:obj:`int`, optional): Maximum number of items fetched in advance.
+
+    Yields:
+        The items produced by `iterable`.
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as err: # pylint: disable=broad-except
+            put((False, err))
+        else:
+            put((False, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            (more, item) = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def read_blocks(fastq, block_size=BLOCK_SIZE, offsets=False):
+    """Parse records from a FASTQ file.
+
+    Args:
+        fastq: File object opened for reading in text mode.
+        block_size (:obj:`int`, optional): Number of characters to read from
+            the file at a time.
+        offsets (:obj:`bool`, optional): Whether the number of characters read up
+            to the end of each block of records should be reported as well.
+
+    Yields:
+        :obj:`list`: The records contained in the next block of input. Each record
+        is a (header, sequence, quality) tuple. The leading *@* is removed from
+        the header. If `offsets` is _True_ (records, offset) tuples are produced
+        instead, where `offset` is the position in the input immediately after
+        the last of the records.
+
+    Raises:
+        ValueError: if the input ends with an incomplete record.
+    """
+    pending = []
+    tail = ''
+    total = 0
+    while True:
+        block = fastq.read(block_size)
+        if not block:
+            break
+        total += len(block)
+        lines = (tail + block).split('\n')
+        tail = lines.pop()
+        if pending:
+            lines[0:0] = pending
+        complete = len(lines) - len(lines) % 4
+        records = [(lines[i][1:], lines[i+1], lines[i+3]) for i in range(0, complete, 4)]
+        pending = lines[complete:]
+        if offsets:
+            yield records, total - len(tail) - sum(len(line) + 1 for line in pending)
+        else:
+            yield records
+    if tail:
+        pending.append(tail)
+    while pending and not pending[-1]:
+        pending.pop()
+    if len(pending) % 4:
+        raise ValueError("Incomplete FASTQ record at end of input: %r" % pending)
+    if pending:
+        records = [(pending[i][1:], pending[i+1], pending[i+3])
+                   for i in range(0, len(pending), 4)]
+        if offsets:
+            yield records, total
+        else:
+            yield records
+
+def skip(fastq, count, block_size=BLOCK_SIZE):
+    """Discard characters from the start of the input.
+
+    The characters are read rather than skipped with a seek, so that this works
+    for all inputs produced by :func:`open_fastq`, including compressed files.
+
+    Args:
+        fastq: File object opened for reading in text mode.
+        count (:obj:`int`): Number of characters to discard.
+        block_size (:obj:`int`, optional): Number of characters to read from
+            the file at a time.
+
+    Raises:
+        ValueError: if the input has fewer than `count` characters.
+    """
+    remaining = count
+    while remaining > 0:
+        block = fastq.read(min(remaining, block_size))
+        if not block:
+            raise ValueError("Input ended after %d of %d characters" %
+                             (count - remaining, count))
+        remaining -= len(block)
+
+def _records(lines):
+    """Group lines into (header, sequence, quality) tuples."""
+    return [(lines[i][1:], lines[i+1], lines[i+3]) for i in range(0, len(lines), 4)]
+
+def read_mapped(file_name, block_size=BLOCK_SIZE, offsets=False, start=0, end=None):
+    """Parse records from an uncompressed FASTQ file through a memory map.
+
+    Blocks of records are decoded directly from the mapped file, avoiding the
+    buffering and incremental decoding of text mode files. Lines may end in *\\r\\n*
+    as well as *\\n*. Offsets are positions in the file, in bytes.
+
+    Args:
+        file_name (:obj:`str`): Name of the file to read.
+        block_size (:obj:`int`, optional): Number of bytes to decode at a time.
+            This is increased as necessary to accommodate long records.
+        offsets (:obj:`bool`, optional): Whether the position in the file after each
+            block of records should be reported as well (see :func:`read_blocks`).
+        start (:obj:`int`, optional): Position in the file at which to start parsing.
+            This has to be the start of a record.
+        end (:obj:`int`, optional): Position in the file at which to stop parsing.
+            This has to be the start of a record or the end of the file.
+
+    Yields:
+        :obj:`list`: The records contained in the next block of input in the same
+        form as produced by :func:`read_blocks`.
+
+    Raises:
+        ValueError: if the input ends with an incomplete record.
+    """
+    with open(file_name, 'rb') as raw:
+        size = os.fstat(raw.fileno()).st_size
+        if end is not None:
+            size = min(size, end)
+        if size <= start:
+            return
+        with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                memoryview(data) as view:
+            pos = start
+            window = block_size
+            while pos < size:
+                end = min(pos + window, size)
+                text = str(view[pos:end], 'ascii')
+                lines = text.split('\n')
+                if end == size:
+                    while lines and not lines[-1].rstrip('\r'):
+                        lines.pop()
+                    if len(lines) % 4:
+                        raise ValueError("Incomplete FASTQ record at end of input: %r" %
+                                         lines[-(len(lines) % 4):])
+                    consumed = end - pos
+                else:
+                    consumed = len(text) - len(lines.pop())
+                    extra = len(lines) % 4
+                    if extra:
+                        consumed -= sum(len(line) + 1 for line in lines[-extra:])
+                        del lines[-extra:]
+                    if not lines:
+                        window *= 2
+                        continue
+                pos += consumed
+                window = block_size
+                if '\r' in text:
+                    ## same as the newline translation of files opened in text mode
+                    lines = [line.rstrip('\r') for line in lines]
+                if offsets:
+                    yield _records(lines), pos
+                else:
+                    yield _records(lines)
+
+def _line_end(data, pos, size):
+    """Position of the end of the line starting at `pos`."""
+    end = data.find(b'\n', pos, size)
+    return size if end < 0 else end
+
+def record_start(data, pos, size=None):
+    """Find the start of the first FASTQ record at or after a position.
+
+    A line is taken to be the header of a record if it starts with *@*, the line
+    after the next one starts with *+* and the sequence and quality lines that follow
+    the header have the same length. This distinguishes headers from quality lines
+    that start with *@*.
+
+    Args:
+        data: Content of a FASTQ file, e.g. a :obj:`mmap.mmap`.
+        pos (:obj:`int`): Position at which to start the search.
+        size (:obj:`int`, optional): Size of the file.
+
+    Returns:
+        :obj:`int`: The start of the next record or `size` if there are no further records.
+    """
+    if size is None:
+        size = len(data)
+    if pos > 0:
+        pos = _line_end(data, pos - 1, size) + 1
+    while pos < size:
+        ends = [_line_end(data, pos, size)]
+        for _ in range(3):
+            ends.append(_line_end(data, ends[-1] + 1, size))
+        if data[pos:pos + 1] == b'@' and data[ends[1] + 1:ends[1] + 2] == b'+' and \
+           ends[0] < size and ends[1] - ends[0] == ends[3] - ends[2]:
+            return pos
+        pos = ends[0] + 1
+    return size
+
+def _parse_range(file_name, start, end, block_size, process):
+    """Parse the records in part of a file, for use by worker processes."""
+    records = [rec for block in read_mapped(file_name, block_size, start=start, end=end)
+               for rec in block]
+    if process is not None:
+        records = process(records)
+    return records, end
+
+def read_parallel(file_name, workers=2, block_size=BLOCK_SIZE, offsets=False, start=0,
+                  process=None):
+    """Parse records from an uncompressed FASTQ file in several processes.
+
+    The file is divided into ranges of about `block_size` bytes. The boundaries of
+    each range are moved forward to the start of the next record (see
+    :func:`record_start`), and the ranges are parsed in parallel by worker processes.
+    Blocks of records are produced in the order in which they appear in the file,
+    so the result is the same as that of :func:`read_mapped`. Worker processes are
+    started with the *spawn* method, because this is usually called from a
+    background thread (see :func:`prefetch`).
+
+    Args:
+        file_name (:obj:`str`): Name of the file to read.
+        workers (:obj:`int`, optional): Number of worker processes.
+        block_size (:obj:`int`, optional): Approximate number of bytes per range.
+        offsets (:obj:`bool`, optional): Whether the position in the file after each
+            block of records should be reported as well.
+        start (:obj:`int`, optional): Position in the file at which to start parsing.
+            This has to be the start of a record.
+        process (:obj:`function`, optional): Function applied to each block of records
+            by the worker processes, e.g. a :func:`functools.partial` of
+            :func:`split_reads`. This has to be picklable.
+
+    Yields:
+        :obj:`list`: The records contained in the next range of input, or the result
+        of `process` for these records. If `offsets` is _True_ (records, offset) tuples
+        are produced instead.
+    """
+    with open(file_name, 'rb') as raw:
+        size = os.fstat(raw.fileno()).st_size
+        if size <= start:
+            return
+        with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            executor = concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'))
+            pending = collections.deque()
+            try:
+                pos = start
+                while pos < size or pending:
+                    while pos < size and len(pending) < 2*workers:
+                        end = record_start(data, pos + block_size, size)
+                        pending.append(executor.submit(_parse_range, file_name, pos, end,
+                                                       block_size, process))
+                        pos = end
+                    (records, end) = pending.popleft().result()
+                    if offsets:
+                        yield records, end
+                    else:
+                        yield records
+            finally:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown()
+
+def read_file(file_name, block_size=BLOCK_SIZE, offsets=False, start=0, process=None,
+              readers=1):
+    """Parse records from a FASTQ file.
+
+    Uncompressed files are read through :func:`read_mapped`, or with :func:`read_parallel`
+    if several `readers` are requested. All others are opened with :func:`open_fastq`
+    and parsed with :func:`read_blocks`.
+
+    Args:
+        file_name (:obj:`str`): Name of the file to read.
+        block_size (:obj:`int`, optional): Amount of input to parse at a time.
+        offsets (:obj:`bool`, optional): Whether the position in the input after each
+            block of records should be reported as well.
+        start (:obj:`int`, optional): Position in the input at which to start parsing,
+            as reported with `offsets`. The reported positions include `start`.
+        process (:obj:`function`, optional): Function applied to each block of records.
+        readers (:obj:`int`, optional): Number of processes used to parse uncompressed
+            files. Compressed files are always parsed by a single process.
+
+    Yields:
+        :obj:`list`: The records contained in the next block of input, or the result
+        of `process` for these records. If `offsets` is _True_ (records, offset) tuples
+        are produced instead (see :func:`read_blocks`).
+    """
+    fastq = None
+    if file_name.endswith('.gz'):
+        fastq = open_fastq(file_name)
+        try:
+            skip(fastq, start, block_size)
+        except ValueError:
+            fastq.close()
+            raise
+        blocks = ((records, start + offset) for (records, offset)
+                  in read_blocks(fastq, block_size, offsets=True))
+    elif readers > 1:
+        blocks = read_parallel(file_name, readers, block_size, offsets=True, start=start,
+                               process=process)
+        process = None
+    else:
+        blocks = read_mapped(file_name, block_size, offsets=True, start=start)
+    try:
+        for (records, offset) in blocks:
+            if process is not None:
+                records = process(records)
+            if offsets:
+                yield records, offset
+            else:
+                yield records
+    finally:
+        blocks.close()
+        if fastq is not None:
+            fastq.close()
+
+def read_fastq(fastq, block_size=BLOCK_SIZE):
+    """Iterate over the records in a FASTQ file.
+
+    Args:
+        fastq: File object opened for reading in text mode.
+        block_size (:obj:`int`, optional): Number of characters to read from
+            the file at a time.
+
+    Yields:
+        :obj:`tuple`: (header, sequence, quality) for each record.
+    """
+    for block in read_blocks(fastq, block_size):
+        for record in block:
+            yield record
+
+def split_reads(records, id_length, adapter_length):
+    """Separate UIDs from read sequences.
+
+    Reads are expected to start and end with a UID of length `id_length`, followed
+    (or preceded) by an adapter sequence. The two parts of the UID are combined and
+    the adapters are removed from the remaining sequence.
+
+    Args:
+        records (:obj:`list`): FASTQ records as produced by :func:`read_blocks`.
+        id_length (:obj:`int`): Length of UID sequence at beginning/end of read.
+        adapter_length (:obj:`int`): Length of the adapter sequence.
+
+    Returns:
+        :obj:`list`: A (uid, uid quality, sequence, sequence quality) tuple for
+        each record.
+    """
+    adapt_length = id_length + adapter_length
+    return [(seq[:id_length] + seq[-id_length:], qual[:id_length] + qual[-id_length:],
+             seq[adapt_length:-adapt_length], qual[adapt_length:-adapt_length])
+            for (_, seq, qual) in records]
+
+def _compress(text, level):
+    """Compress text as a single gzip member."""
+    data = io.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode='wb', compresslevel=level, mtime=0) as member:
+        member.write(text.encode('ascii'))
+    return data.getvalue()
+
+def write_compressed(output, chunks, compress, threads=1):
+    """Compress chunks of data in parallel and write them in order.
+
+    At most twice as many chunks as there are threads are held in memory at a time.
+
+    Args:
+        output: File object opened for writing in binary mode.
+        chunks: Iterable producing the data to compress.
+        compress (:obj:`function`): Function that compresses a single chunk.
+        threads (:obj:`int`, optional): Number of threads used for compression.
+
+    Returns:
+        :obj:`list`: The size of each compressed chunk in bytes.
+    """
+    sizes = []
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max(threads, 1)) as executor:
+        for chunk in chunks:
+            if len(pending) >= 2*max(threads, 1):
+                sizes.append(output.write(pending.popleft().result()))
+            pending.append(executor.submit(compress, chunk))
+        while pending:
+            sizes.append(output.write(pending.popleft().result()))
+    return sizes
+
+def write_gzip(output, chunks, level=COMPRESSION_LEVEL, threads=1):
+    """Write gzip compressed text.
+
+    Each chunk is compressed independently and written as a separate gzip member.
+    Compression of several chunks proceeds in parallel. The output can be read
+    like any other gzip file.
+
+    Args:
+        output: File object opened for writing in binary mode.
+        chunks: Iterable producing the text to write in chunks.
+        level (:obj:`int`, optional): Compression level between 1 (fastest) and
+            9 (smallest output).
+        threads (:obj:`int`, optional): Number of threads used for compression.
+    """
+    write_compressed(output, chunks, lambda text: _compress(text, level), threads)
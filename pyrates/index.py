@@ -0,0 +1,221 @@
+"""Random access to consensus sequences by UID.
+
+Consensus sequences are written in the blocked gzip format (BGZF) used by
+samtools and htslib. The output can be decompressed like any other gzip file,
+but because each block of up to 64 kB is compressed independently, a record can
+be extracted by decompressing only the blocks that contain it. The location of
+each record is stored as a virtual file offset, i.e. the position of the
+compressed block in the file shifted left by 16 bits plus the position of the
+record within the uncompressed block, in a sidecar index file.
+
+The index consists of fixed width lines with the UID and the virtual offset of
+the corresponding record in hexadecimal, sorted by UID. Records can therefore be
+located with a binary search without reading the entire index.
+"""
+
+import argparse
+import struct
+import zlib
+
+import pyrates.fastq as fq
+import pyrates.utils as utils
+
+## maximum amount of uncompressed data per block, as used by htslib
+BLOCK_SIZE = 0xff00
+INDEX_SUFFIX = '.idx'
+## empty block marking the end of a BGZF file
+EOF_BLOCK = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00' + \
+            b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+_HEADER = struct.Struct('<4BI2BH2BHH')
+_FOOTER = struct.Struct('<II')
+
+def compress_block(data, level=fq.COMPRESSION_LEVEL):
+    """Compress data as a single BGZF block.
+
+    Args:
+        data (:obj:`bytes`): Up to :data:`BLOCK_SIZE` bytes of data.
+        level (:obj:`int`, optional): Compression level between 1 (fastest) and
+            9 (smallest output).
+
+    Returns:
+        :obj:`bytes`: The compressed block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = _HEADER.size + len(deflated) + _FOOTER.size
+    return _HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, size - 1) + \
+           deflated + _FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+def _read_block(handle):
+    """Read and decompress the BGZF block at the current position of `handle`."""
+    header = handle.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return b''
+    fields = _HEADER.unpack(header)
+    if fields[:2] != (0x1f, 0x8b) or fields[8:10] != (ord('B'), ord('C')):
+        raise IOError("Invalid BGZF block at offset %d" % (handle.tell() - len(header)))
+    deflated = handle.read(fields[11] + 1 - _HEADER.size - _FOOTER.size)
+    handle.read(_FOOTER.size)
+    return zlib.decompress(deflated, -15)
+
+def _blocks(records, positions):
+    """Pack records into blocks of at most :data:`BLOCK_SIZE` bytes.
+
+    The number of the block containing the start of each record and the position
+    within that block are appended to `positions` as (uid, block, offset) tuples.
+    """
+    block = bytearray()
+    count = 0
+    for (uid, text) in records:
+        positions.append((uid, count, len(block)))
+        block.extend(text.encode('ascii'))
+        while len(block) >= BLOCK_SIZE:
+            yield bytes(block[:BLOCK_SIZE])
+            del block[:BLOCK_SIZE]
+            count += 1
+    if block:
+        yield bytes(block)
+
+def write_indexed(records, output_file, level=fq.COMPRESSION_LEVEL, threads=1):
+    """Write records to a BGZF compressed file and create an index.
+
+    Args:
+        records: Iterable of (uid, record) pairs. Each record is the text of a
+            FASTQ record, including the final newline.
+        output_file (:obj:`str`): File name for output. The index is written to a
+            file with the same name and the suffix *.idx*.
+        level (:obj:`int`, optional): Compression level between 1 (fastest) and
+            9 (smallest output).
+        threads (:obj:`int`, optional): Number of threads used for compression.
+
+    Raises:
+        ValueError: if the UIDs differ in length.
+    """
+    positions = []
+    with open(output_file, 'wb') as output:
+        sizes = fq.write_compressed(output, _blocks(records, positions),
+                                    lambda data: compress_block(data, level), threads)
+        output.write(EOF_BLOCK)
+    starts = [0]
+    for size in sizes:
+        starts.append(starts[-1] + size)
+    positions.sort()
+    if positions and len(set(len(uid) for (uid, _, _) in positions)) > 1:
+        raise ValueError("All UIDs need to have the same length to be indexed.")
+    with open(output_file + INDEX_SUFFIX, 'w') as index:
+        for (uid, block, offset) in positions:
+            index.write("%s\t%016x\n" % (uid, starts[block] << 16 | offset))
+
+class IndexedFastq(object):
+    """Random access to the records of an indexed BGZF compressed FASTQ file.
+
+    Args:
+        file_name (:obj:`str`): Name of a file created by :func:`write_indexed`.
+    """
+    __slots__ = '_fastq', '_index', '_line', '_count'
+    _logger = utils.get_logger(__name__)
+
+    def __init__(self, file_name):
+        self._fastq = open(file_name, 'rb')
+        self._index = open(file_name + INDEX_SUFFIX, 'rb')
+        first = self._index.readline()
+        self._line = len(first)
+        self._index.seek(0, 2)
+        self._count = self._index.tell()//self._line if self._line else 0
+
+    def _uid(self, line):
+        self._index.seek(line*self._line)
+        return self._index.read(self._line - 18).decode('ascii')
+
+    def offset(self, uid):
+        """Virtual file offset of the record for a UID.
+
+        Raises:
+            KeyError: if there is no record for the UID.
+        """
+        low = 0
+        high = self._count
+        while low < high:
+            mid = (low + high)//2
+            if self._uid(mid) < uid:
+                low = mid + 1
+            else:
+                high = mid
+        if low == self._count or self._uid(low) != uid:
+            raise KeyError(uid)
+        return int(self._index.read(17)[1:], 16)
+
+    def fetch(self, uid):
+        """Retrieve the record for a UID.
+
+        Args:
+            uid (:obj:`str`): UID of the requested consensus sequence.
+
+        Returns:
+            :obj:`str`: The FASTQ record, without the final newline.
+
+        Raises:
+            KeyError: if there is no record for the UID.
+        """
+        offset = self.offset(uid)
+        self._fastq.seek(offset >> 16)
+        data = _read_block(self._fastq)[offset & 0xffff:]
+        while data.count(b'\n') < 4:
+            block = _read_block(self._fastq)
+            if not block:
+                break
+            data += block
+        return b'\n'.join(data.split(b'\n', 4)[:4]).decode('ascii')
+
+    def close(self):
+        """Close the underlying files."""
+        self._fastq.close()
+        self._index.close()
+
+    def __getitem__(self, uid):
+        return self.fetch(uid)
+
+    def __contains__(self, uid):
+        try:
+            self.offset(uid)
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def main():
+    """Entrypoint for command-line interface
+    """
+    parser = argparse.ArgumentParser(
+        description="Retrieve consensus sequences from indexed output by UID",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('fastq',
+                        help='Indexed consensus sequences, as written with --index-output')
+    parser.add_argument('uids', nargs='*', metavar='UID',
+                        help='UIDs of the consensus sequences to retrieve')
+    parser.add_argument(
+        '--uid-file', '-f',
+        metavar='FILE',
+        help='File with one UID per line to retrieve in addition to those given as arguments.'
+    )
+    args = parser.parse_args()
+    uids = list(args.uids)
+    if args.uid_file is not None:
+        with open(args.uid_file) as uid_file:
+            uids.extend(line.strip() for line in uid_file if line.strip())
+    logger = utils.get_logger('pyrates', 'WARNING', [utils.console_handler()])
+    with IndexedFastq(args.fastq) as fastq:
+        for uid in uids:
+            try:
+                print(fastq.fetch(uid))
+            except KeyError:
+                logger.warning("No consensus sequence for UID %r", uid)
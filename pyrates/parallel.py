@@ -0,0 +1,287 @@
+"""Parallel search for similar UIDs using several worker processes.
+"""
+
+import multiprocessing
+import zlib
+
+import pyrates.sequence as pseq
+import pyrates.utils as utils
+
+def _serve(conn, max_length, alphabet, tag_size, max_diff, wildcard, packed, index):
+    """Maintain one partition of a :obj:`PartitionedSequenceStore`.
+
+    Commands are received through `conn` as (command, data) tuples. Valid commands
+    are *add* and *remove*, which take a list of sequences, *search*, which returns
+    the list of stored sequences within `max_diff` of each of the sequences provided,
+    *contains*, which returns whether each of the sequences provided is stored,
+    *size* and *wild*, which return the number of stored sequences and those with
+    wildcards in their tags, and *stop*.
+    """
+    store = pseq.create_store(max_length, alphabet=alphabet, tag_size=tag_size,
+                              max_diff=max_diff, wildcard=wildcard, packed=packed, index=index)
+    diff = pseq.SequenceStore.diff
+    while True:
+        command, data = conn.recv()
+        if command == 'add':
+            for sequence in data:
+                store.add(sequence)
+        elif command == 'remove':
+            for sequence in data:
+                store.discard(sequence)
+        elif command == 'search':
+            conn.send([[cand for cand in store.search(sequence, max_hits=None, raw=True)
+                        if diff(sequence, cand) <= max_diff] for sequence in data])
+        elif command == 'contains':
+            conn.send([sequence in store for sequence in data])
+        elif command == 'size':
+            conn.send(len(store))
+        elif command == 'wild':
+            conn.send(list(store.wild_tags))
+        else:
+            break
+    conn.close()
+
+class PartitionedSequenceStore(object):
+    """Store a collection of sequences across several worker processes.
+
+    This behaves like a GroupedSequenceStore but distributes the work required to search
+    for approximate matches. Each worker process holds the sequences for a disjoint set of
+    prefixes and searches its share of the store for all requested sequences in parallel
+    with the other workers. Searches should therefore be requested in batches through
+    :meth:`prefetch`.
+
+    The sequences are only held by the workers, the main process keeps no copy of the
+    store. Sequences are handed to the workers when :meth:`flush` is called. Until then
+    they are kept in a small local store that is searched in addition to the results
+    obtained from the workers, and sequences removed since the last flush are filtered
+    from these results. Search results therefore always reflect the current content of
+    the store, regardless of when they were requested. Membership tests and the size
+    of the store are answered by the workers.
+
+    Args:
+        max_length (:obj:`int`): Maximum sequence length supported by this store.
+        workers (:obj:`int`, optional): Number of worker processes to use.
+        alphabet (:obj:`tuple`, optional): A list of all valid sequence characters.
+        tag_size (:obj:`int`, optional): Length of prefix to use for grouping of reads.
+        max_diff (:obj:`int`, optional): Maximum number of mismatches allowed.
+        wildcard (:obj:`string`, optional): Character that should be treated as wildcard.
+        packed (:obj:`bool`, optional): Flag indicating whether sequences should be
+            stored in packed form (see :obj:`pyrates.sequence.SequenceStore`).
+        index (:obj:`type`, optional): Class used to store the sequences of each group
+            or :obj:`pyrates.sequence.PigeonholeStore` (see
+            :func:`pyrates.sequence.create_store`).
+    """
+    __slots__ = '_recent', '_added', '_sent', '_removed', '_stale', '_hits', '_workers', \
+                '_processes', '_owner', '_tag_size', '_max_diff'
+    _logger = utils.get_logger(__name__)
+
+    def __init__(self, max_length, workers=2, alphabet=('A', 'C', 'G', 'T'),
+                 tag_size=4, max_diff=4, wildcard=None, packed=False,
+                 index=pseq.SequenceStore):
+        self._recent = pseq.create_store(max_length, alphabet=alphabet, tag_size=tag_size,
+                                         max_diff=max_diff, wildcard=wildcard, packed=packed,
+                                         index=index)
+        self._tag_size = tag_size
+        self._max_diff = max_diff
+        self._added = []
+        self._sent = 0
+        self._removed = []
+        self._stale = set()
+        self._hits = {}
+        self._owner = {}
+        self._workers = []
+        self._processes = []
+        for _ in range(workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve,
+                                              args=(child_conn, max_length, alphabet,
+                                                    tag_size, max_diff, wildcard, packed,
+                                                    index))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self._workers.append(parent_conn)
+            self._processes.append(process)
+        self._logger.debug("Started %d worker processes", workers)
+
+    def _partition(self, sequence):
+        """Index of the worker responsible for a sequence."""
+        key = sequence[:self._tag_size] if self._tag_size > 0 else sequence
+        if key not in self._owner:
+            self._owner[key] = zlib.crc32(key.encode('ascii')) % len(self._workers)
+        return self._owner[key]
+
+    def _dispatch(self, command, sequences):
+        batches = [[] for _ in self._workers]
+        for sequence in sequences:
+            batches[self._partition(sequence)].append(sequence)
+        for (conn, batch) in zip(self._workers, batches):
+            if batch:
+                conn.send((command, batch))
+
+    def _send(self):
+        """Hand changes made since the last call to the worker processes."""
+        self._dispatch('remove', self._removed)
+        self._dispatch('add', [seq for seq in self._added[self._sent:] if seq in self._recent])
+        self._removed = []
+        self._sent = len(self._added)
+
+    def _query(self, command, sequence=None):
+        """Send a command to the workers and collect their replies.
+
+        Changes to the store that haven't been handed to the workers yet are sent first.
+        If `sequence` is given, only the worker responsible for it is asked.
+        """
+        self._send()
+        if sequence is not None:
+            conn = self._workers[self._partition(sequence)]
+            conn.send((command, [sequence]))
+            return conn.recv()[0]
+        for conn in self._workers:
+            conn.send((command, None))
+        return [conn.recv() for conn in self._workers]
+
+    def prefetch(self, sequences):
+        """Search for approximate matches of several sequences in parallel.
+
+        The results are retained until the next call to :meth:`flush` and used to
+        answer searches for these sequences.
+
+        Args:
+            sequences (:obj:`list`): Sequences to search for.
+        """
+        sequences = list(sequences)
+        if not sequences:
+            return
+        for conn in self._workers:
+            conn.send(('search', sequences))
+        hits = [[] for _ in sequences]
+        for conn in self._workers:
+            for (seq_hits, worker_hits) in zip(hits, conn.recv()):
+                seq_hits.extend(worker_hits)
+        self._hits.update(zip(sequences, hits))
+
+    def flush(self):
+        """Hand recently added sequences to the worker processes.
+
+        This invalidates all results obtained through :meth:`prefetch`.
+        """
+        self._send()
+        for sequence in self._added:
+            self._recent.discard(sequence)
+        self._added = []
+        self._sent = 0
+        self._stale = set()
+        self._hits = {}
+
+    def close(self):
+        """Shut down all worker processes."""
+        for conn in self._workers:
+            conn.send(('stop', None))
+            conn.close()
+        for process in self._processes:
+            process.join()
+        self._workers = []
+        self._processes = []
+
+    def add(self, sequence):
+        """Add a sequence to the store.
+
+        Args:
+            sequence (:obj:`string`): New sequence to be added.
+        """
+        if sequence not in self._recent:
+            self._recent.add(sequence)
+            self._added.append(sequence)
+
+    def remove(self, item):
+        """Remove a sequence from the sequence store.
+
+        Args:
+            item (:obj:`string`): Sequence to be removed.
+
+        Raises:
+            KeyError: if the sequence doesn't exist in the store.
+        """
+        if item not in self:
+            raise KeyError(item)
+        self._recent.discard(item)
+        self._removed.append(item)
+        self._stale.add(item)
+
+    def discard(self, item):
+        """Remove a sequence from the store if it exists.
+
+        Args:
+            item (:obj:`string`): Sequence to be removed.
+        """
+        if item in self:
+            self.remove(item)
+
+    def find(self, sequence):
+        """Find best match for sequence in the store.
+
+        Args:
+            sequence (:obj:`string`): Sequence to search for.
+
+        Returns:
+            :obj:`tuple`: A tuple consisting of the best match found in the store and
+            the number of differences between the returned match and the search string.
+            If no suitable match was found `None` is returned instead.
+        """
+        match = self.search(sequence, 1)
+        if len(match) == 0:
+            return None
+        return match[0]
+
+    def search(self, sequence, max_hits=10, raw=False, max_diff=None):
+        """Search the sequence store for all approximate matches to a search pattern.
+
+        Args:
+            sequence (:obj:`string`): Sequence to search for.
+            max_hits (:obj:`int`, optional): Maximum number of results to return.
+                set to _None_ to return all candidates. Ignored if `raw` is _True_.
+            raw (:obj:`bool`, optional): Flag indicating whether the raw sequence
+                matches should be returned instead of sequence/distance pairs.
+            max_diff (:obj:`int`, optional): Search radius, if it should be smaller
+                than the maximum number of mismatches the store was created with.
+                The worker processes always search the full radius, their results
+                are narrowed down locally.
+
+        Returns:
+            If `raw` is _True_ an unordered :obj:`list` of candidates is returned,
+            otherwise a list of (sequence, distance) tuples is returned.
+        """
+        if max_diff is None or max_diff > self._max_diff:
+            max_diff = self._max_diff
+        if sequence not in self._hits:
+            self.prefetch([sequence])
+        diff = pseq.SequenceStore.diff
+        candidates = set(cand for cand in self._hits[sequence] if cand not in self._stale)
+        if max_diff < self._max_diff:
+            candidates = set(cand for cand in candidates if diff(sequence, cand) <= max_diff)
+        candidates.update(self._recent.search(sequence, max_hits=None, raw=True,
+                                              max_diff=max_diff))
+        candidates = list(candidates)
+        if raw:
+            return candidates
+        candidates = [(cand, diff(sequence, cand)) for cand in candidates]
+        candidates = [cand for cand in candidates if cand[1] <= max_diff]
+        candidates.sort(key=lambda x: x[1])
+        if max_hits is not None:
+            candidates = candidates[:max_hits]
+        return candidates
+
+    @property
+    def wild_tags(self):
+        """All sequences with wildcards in their tags.
+        """
+        return set(seq for worker_tags in self._query('wild') for seq in worker_tags)
+
+    def __len__(self):
+        return sum(self._query('size'))
+
+    def __contains__(self, item):
+        if item in self._recent:
+            return True
+        return self._query('contains', item)
@@ -0,0 +1,336 @@
+"""Clustering of inputs that don't fit into memory.
+
+Reads are processed in two phases. The first phase splits the input into a number of
+partition files on disk, such that all reads whose UIDs share a prefix end up in the
+same partition. The second phase clusters one partition at a time with
+:meth:`pyrates.clustering.Clustering.from_fastq`. Only the clusters of a single
+partition are held in memory at any time.
+
+Reads are assigned to partitions based on the same UID prefix that is used to group
+UIDs during clustering. UIDs that differ only outside of this prefix therefore always
+share a partition. Reads with errors in the prefix may end up in a different partition
+than the cluster they belong to, where they form separate clusters. Once all partitions
+have been clustered, the clusters are matched against the clusters of the other
+partitions in a second pass, and the reads of matching clusters are clustered together
+(see :func:`cluster_partitioned`).
+"""
+
+from array import array
+import contextlib
+import heapq
+import os.path
+import pickle
+import tempfile
+import zlib
+
+import pyrates.clustering as clust
+import pyrates.fastq as fq
+import pyrates.sequence as pseq
+import pyrates.utils as utils
+
+_logger = utils.get_logger(__name__)
+
+def partition_key(uid, prefix, partitions):
+    """Index of the partition for a UID.
+
+    Args:
+        uid (:obj:`str`): Combined UID sequence of a read.
+        prefix (:obj:`int`): Length of the UID prefix that determines the partition.
+        partitions (:obj:`int`): Total number of partitions.
+
+    Returns:
+        :obj:`int`: A number between 0 and `partitions` - 1.
+    """
+    return zlib.crc32(uid[:prefix].encode('ascii')) % partitions
+
+def _format(record):
+    """FASTQ record for a (header, sequence, quality) tuple."""
+    return "@%s\n%s\n+\n%s\n" % record
+
+def partition_fastq(input_file, directory, id_length, prefix=5, partitions=16,
+                    positions=False):
+    """Split a FASTQ file into partitions by UID prefix.
+
+    The order of reads within each partition is the same as in the input.
+
+    Args:
+        input_file (:obj:`str`): Name of input file.
+        directory (:obj:`str`): Directory for the partition files.
+        id_length (:obj:`int`): Length of UID sequence at beginning/end of read.
+        prefix (:obj:`int`, optional): Length of the UID prefix that determines the partition.
+        partitions (:obj:`int`, optional): Number of partitions to create.
+        positions (:obj:`bool`, optional): Whether the position of each read in the
+            input should be recorded as well (see :func:`read_positions`).
+
+    Returns:
+        :obj:`list`: Names of the partition files. Files for empty partitions are omitted.
+    """
+    name = os.path.basename(input_file).split('.')[0]
+    file_names = [os.path.join(directory, "%s.%d.fastq" % (name, i)) for i in range(partitions)]
+    counts = [0]*partitions
+    outputs = []
+    pos_outputs = []
+    try:
+        for file_name in file_names:
+            outputs.append(open(file_name, 'w'))
+            if positions:
+                pos_outputs.append(open(file_name + '.pos', 'wb'))
+        records = fq.read_file(input_file)
+        read_count = 0
+        with contextlib.closing(records), contextlib.closing(fq.prefetch(records)) as blocks:
+            for block in blocks:
+                batches = [[] for _ in range(partitions)]
+                indices = [array('q') for _ in range(partitions)]
+                for (pos, (header, sequence, quality)) in enumerate(block, read_count):
+                    uid = sequence[:id_length] + sequence[-id_length:]
+                    key = partition_key(uid, prefix, partitions)
+                    batches[key].append(_format((header, sequence, quality)))
+                    indices[key].append(pos)
+                read_count += len(block)
+                for (i, batch) in enumerate(batches):
+                    if batch:
+                        outputs[i].write(''.join(batch))
+                        counts[i] += len(batch)
+                        if positions:
+                            indices[i].tofile(pos_outputs[i])
+    finally:
+        for output in outputs + pos_outputs:
+            output.close()
+    _logger.info("Split %d reads into %d partitions, largest partition: %d reads",
+                 sum(counts), partitions, max(counts))
+    for (file_name, count) in zip(file_names, counts):
+        if count == 0:
+            os.remove(file_name)
+            if positions:
+                os.remove(file_name + '.pos')
+    return [file_name for (file_name, count) in zip(file_names, counts) if count > 0]
+
+def read_positions(file_name):
+    """Reads of a partition together with their position in the input.
+
+    Args:
+        file_name (:obj:`str`): Name of a partition file created by :func:`partition_fastq`
+            with `positions` enabled.
+
+    Yields:
+        :obj:`tuple`: (position, record) for each read, where `record` is a
+        (header, sequence, quality) tuple.
+    """
+    index = array('q')
+    with open(file_name + '.pos', 'rb') as pos_input:
+        index.frombytes(pos_input.read())
+    with open(file_name) as fastq:
+        for item in zip(index, fq.read_fastq(fastq)):
+            yield item
+
+def _write_positions(file_name, reads):
+    """Write (position, record) pairs in the format read by :func:`read_positions`."""
+    index = array('q')
+    with open(file_name, 'w') as output:
+        for (pos, record) in reads:
+            output.write(_format(record))
+            index.append(pos)
+    with open(file_name + '.pos', 'wb') as pos_output:
+        index.tofile(pos_output)
+
+def _remove_positions(file_name):
+    """Remove a file written with :func:`_write_positions`."""
+    os.remove(file_name)
+    os.remove(file_name + '.pos')
+
+def _uid(record, id_length):
+    """Combined UID of a (header, sequence, quality) record."""
+    return record[1][:id_length] + record[1][-id_length:]
+
+def _best_matches(seq, partition, summary, best, threshold):
+    """Record the best matching cluster for clusters of another partition.
+
+    Args:
+        seq (:obj:`pyrates.clustering.Clustering`): Clusters of one partition.
+        partition (:obj:`int`): Index of the partition.
+        summary (:obj:`list`): (uid, sequence, size) tuples for the clusters of another
+            partition.
+        best (:obj:`dict`): Best match found so far for each UID in `summary`, as a
+            (distance, uid, partition) tuple. This is updated with matches in `seq` that
+            are closer, or that have the same distance and a lexicographically smaller
+            UID, as in :meth:`pyrates.clustering.Clustering.merge_target`.
+        threshold (:obj:`int`): Maximum number of differences allowed between UIDs.
+    """
+    for (uid, sequence, _) in summary:
+        similar_id = seq.find(uid, sequence, threshold)
+        if similar_id is not None:
+            match = (pseq.SequenceStore.diff(uid, similar_id), similar_id, partition)
+            if uid not in best or match[:2] < best[uid][:2]:
+                best[uid] = match
+
+def _destinations(best, clusters):
+    """Assign groups of matching clusters from different partitions to a single partition.
+
+    Clusters are grouped with their best match in any other partition. Each group is
+    assigned to the partition of its largest cluster, with ties resolved in favour of
+    the partition with the lowest index.
+
+    Args:
+        best (:obj:`list`): The best match for clusters of each partition, as
+            produced by :func:`_best_matches`.
+        clusters (:obj:`dict`): Cluster sizes by (partition, uid).
+
+    Returns:
+        :obj:`list`: A :obj:`dict` for each partition, mapping the UIDs of clusters
+        that should be moved to the index of their new partition.
+    """
+    parent = {}
+
+    def root(node):
+        while parent.get(node, node) != node:
+            node = parent[node]
+        return node
+
+    for (partition, matches) in enumerate(best):
+        for (uid, (_, similar_id, other)) in matches.items():
+            (node, other_node) = (root((partition, uid)), root((other, similar_id)))
+            if node != other_node:
+                parent[max(node, other_node)] = min(node, other_node)
+    groups = {}
+    for node in parent:
+        groups.setdefault(root(node), set()).add(node)
+    for (key, group) in groups.items():
+        group.add(key)
+    moves = [{} for _ in best]
+    for group in groups.values():
+        target = max(group, key=lambda node: (clusters[node], -node[0]))[0]
+        for (partition, uid) in group:
+            if partition != target:
+                moves[partition][uid] = target
+    return moves
+
+def _recluster(file_name, incoming, skip, id_length, adapter, prefix, kwargs):
+    """Cluster a partition together with reads from other partitions.
+
+    Args:
+        file_name (:obj:`str`): Name of the partition file.
+        incoming (:obj:`list`): (position, record) pairs for the additional reads.
+        skip (:obj:`set`): Positions of reads in the partition that should be skipped.
+        id_length (:obj:`int`): Length of UID sequence at beginning/end of read.
+        adapter (:obj:`str`): Adapter sequence.
+        prefix (:obj:`int`): Length of UID prefix used to group UIDs.
+        kwargs (:obj:`dict`): Additional arguments for
+            :meth:`pyrates.clustering.Clustering.from_fastq`.
+
+    Returns:
+        :obj:`pyrates.clustering.Clustering`: Clusters of all reads, which are processed
+        in the order of the input.
+    """
+    merged_name = file_name + '.merged'
+    own = ((pos, record) for (pos, record) in read_positions(file_name) if pos not in skip)
+    _write_positions(merged_name, heapq.merge(own, sorted(incoming)))
+    try:
+        return clust.Clustering.from_fastq(merged_name, id_length, adapter, prefix=prefix,
+                                           **kwargs)
+    finally:
+        _remove_positions(merged_name)
+
+def cluster_partitioned(input_file, id_length, adapter, prefix=5, partitions=16,
+                        tmp_dir=None, **kwargs):
+    """Generate consensus sequences one partition at a time.
+
+    Reads with errors in the UID prefix may be assigned to a different partition than
+    the cluster they belong to, where they form separate clusters. To find these, each
+    partition is clustered and the clusters are saved to disk. The clusters are then
+    loaded one partition at a time and matched against the clusters of all other
+    partitions. Clusters are grouped with their best match and the reads of each group
+    are moved to a single partition. Partitions that gained or lost reads in this way are
+    clustered again, with all reads processed in the order of the input.
+
+    The temporary directory holding partition files and saved clusters is removed once
+    all partitions have been processed or the generator is closed.
+
+    Args:
+        input_file (:obj:`str`): Name of input file.
+        id_length (:obj:`int`): Length of UID sequence at beginning/end of read.
+        adapter (:obj:`str`): Adapter sequence.
+        prefix (:obj:`int`, optional): Length of UID prefix used to assign reads to
+            partitions and to group UIDs during clustering.
+        partitions (:obj:`int`, optional): Number of partitions to create.
+        tmp_dir (:obj:`str`, optional): Directory in which the partition files are created.
+            Uses the system default for temporary files if this is `None`.
+        kwargs: Additional arguments for :meth:`pyrates.clustering.Clustering.from_fastq`.
+            All UID matches are retained during the first round of clustering, so that
+            reads can be moved with their clusters, and `cache_size` only applies to
+            partitions that are clustered again.
+
+    Yields:
+        :obj:`pyrates.clustering.Clustering`: The clusters for each partition.
+    """
+    threshold = kwargs.get('threshold', 5)
+    with tempfile.TemporaryDirectory(prefix='pyrates', dir=tmp_dir) as directory:
+        file_names = partition_fastq(input_file, directory, id_length, prefix, partitions,
+                                     positions=True)
+        if len(file_names) == 1:
+            yield clust.Clustering.from_fastq(file_names[0], id_length, adapter, prefix=prefix,
+                                              **kwargs)
+            return
+        for (i, file_name) in enumerate(file_names):
+            _logger.info("Clustering partition %d of %d", i + 1, len(file_names))
+            id_map = utils.LRUCache()
+            seq = clust.Clustering.from_fastq(file_name, id_length, adapter, prefix=prefix,
+                                              id_map=id_map, **kwargs)
+            summary = [(uid, cluster.sequence.sequence, cluster.size)
+                       for (uid, cluster) in seq.items()]
+            for (suffix, data) in (('.pickle', seq), ('.map', id_map), ('.summary', summary)):
+                with open(file_name + suffix, 'wb') as output:
+                    pickle.dump(data, output, pickle.HIGHEST_PROTOCOL)
+            del seq, id_map, summary
+        best = [{} for _ in file_names]
+        clusters = {}
+        for (i, file_name) in enumerate(file_names):
+            _logger.info("Matching clusters to partition %d of %d", i + 1, len(file_names))
+            with open(file_name + '.pickle', 'rb') as saved:
+                seq = pickle.load(saved)
+            for (j, other_name) in enumerate(file_names):
+                if j != i:
+                    with open(other_name + '.summary', 'rb') as saved:
+                        summary = pickle.load(saved)
+                    _best_matches(seq, i, summary, best[j], threshold)
+                    clusters.update(((j, uid), size) for (uid, _, size) in summary
+                                    if uid in best[j])
+            for matches in best:
+                for (_, similar_id, partition) in matches.values():
+                    if partition == i:
+                        clusters[(i, similar_id)] = seq.clusters[similar_id].size
+            del seq, summary
+        for file_name in file_names:
+            os.remove(file_name + '.summary')
+        moves = _destinations(best, clusters)
+        del best, clusters
+        _logger.info("Moving %d clusters to other partitions",
+                     sum(len(moved) for moved in moves))
+        ## reads moved into each partition and positions of reads moved out
+        incoming = [[] for _ in file_names]
+        outgoing = [set() for _ in file_names]
+        for (j, file_name) in enumerate(file_names):
+            if not moves[j]:
+                os.remove(file_name + '.map')
+                continue
+            with open(file_name + '.map', 'rb') as saved:
+                id_map = pickle.load(saved)
+            os.remove(file_name + '.map')
+            for (pos, record) in read_positions(file_name):
+                uid = _uid(record, id_length)
+                target = moves[j].get(uid if uid in moves[j] else id_map.get(uid))
+                if target is not None:
+                    incoming[target].append((pos, record))
+                    outgoing[j].add(pos)
+            del id_map
+        for (i, file_name) in enumerate(file_names):
+            if incoming[i] or outgoing[i]:
+                _logger.info("Clustering partition %d of %d again", i + 1, len(file_names))
+                seq = _recluster(file_name, incoming[i], outgoing[i], id_length, adapter,
+                                 prefix, kwargs)
+            else:
+                with open(file_name + '.pickle', 'rb') as saved:
+                    seq = pickle.load(saved)
+            os.remove(file_name + '.pickle')
+            _remove_positions(file_name)
+            incoming[i] = outgoing[i] = None
+            yield seq
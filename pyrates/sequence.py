@@ -1,9 +1,86 @@
 """Classes and functions to handle sequence data.
 """
 import itertools as itools
+import math
 
 import pyrates.utils as utils
 
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(value):
+        return bin(value).count('1')
+
+_CODECS = {}
+
+def _codec(alphabet, wildcard):
+    """Translation tables used to encode sequences over `alphabet`."""
+    key = (tuple(alphabet), wildcard)
+    if key not in _CODECS:
+        if len(alphabet) > 4:
+            raise ValueError("Packed encoding requires an alphabet with at most four letters, " +
+                             "got %r." % (alphabet,))
+        bases = dict((ord(letter), str(i)) for (i, letter) in enumerate(alphabet))
+        bases[ord(wildcard)] = '0'
+        wilds = dict((ord(letter), '0') for letter in alphabet)
+        wilds[ord(wildcard)] = '1'
+        _CODECS[key] = (bases, wilds)
+    return _CODECS[key]
+
+def encode(sequence, alphabet=('A', 'C', 'G', 'T'), wildcard='N'):
+    """Encode a sequence as an integer using two bits per base.
+
+    The resulting integer consists of a leading marker bit, followed by a mask
+    indicating the positions of wildcards and the base codes. Encoded sequences
+    of equal length can be compared with :func:`packed_diff`.
+
+    Args:
+        sequence (:obj:`str`): Sequence to encode.
+        alphabet (:obj:`tuple`, optional): Up to four valid sequence characters.
+        wildcard (:obj:`str`, optional): Additional character used as a wildcard.
+
+    Returns:
+        :obj:`int`: The encoded sequence.
+
+    Raises:
+        ValueError: if the sequence contains characters that are neither
+        part of the alphabet nor the wildcard.
+    """
+    length = len(sequence)
+    if length == 0:
+        return 1
+    bases, wilds = _codec(alphabet, wildcard)
+    return (1 << 4*length) | (int(sequence.translate(wilds), 4) << 2*length) | \
+           int(sequence.translate(bases), 4)
+
+def decode(code, alphabet=('A', 'C', 'G', 'T'), wildcard='N'):
+    """Recover a sequence from its packed representation.
+
+    Args:
+        code (:obj:`int`): Sequence encoded by :func:`encode`.
+        alphabet (:obj:`tuple`, optional): Alphabet used for encoding.
+        wildcard (:obj:`str`, optional): Wildcard character used for encoding.
+
+    Returns:
+        :obj:`str`: The decoded sequence.
+    """
+    length = (code.bit_length() - 1) >> 2
+    bits = format(code, 'b')[1:]
+    return ''.join(wildcard if bits[2*i + 1] == '1' else
+                   alphabet[int(bits[2*(length + i):2*(length + i + 1)], 2)]
+                   for i in range(length))
+
+def packed_diff(code1, code2):
+    """Compute Hamming distance between two packed sequences of the same length.
+
+    Wildcards are treated like any other character, i.e. they only match other
+    wildcards.
+    """
+    width = code1.bit_length() >> 1
+    diff = code1 ^ code2
+    bases = diff & ((1 << width) - 1)
+    return _popcount(((bases | (bases >> 1)) & (((1 << width) - 1) // 3)) | (diff >> width))
+
 class SequenceWithQuality(object):
     """A sequence and its quality scores.
 
@@ -98,13 +175,19 @@ class SequenceStore(object):
     Args:
         max_length (:obj:`int`): Maximum sequence length supported by this store.
         alphabet (:obj:`tuple`): A list of all valid sequence characters.
+        packed (:obj:`bool`, optional): Flag indicating whether sequences should be
+            stored in packed form (see :func:`encode`). This substantially reduces
+            the memory required to store large numbers of sequences. In this mode
+            all sequences have to be of the same length and may only contain
+            characters from the alphabet and *N*.
     """
-    __slots__ = '_alphabet', '_composition', '_index'
+    __slots__ = '_alphabet', '_composition', '_index', '_packed'
     _logger = utils.get_logger(__name__)
 
-    def __init__(self, max_length, alphabet=('A', 'C', 'G', 'T')):
+    def __init__(self, max_length, alphabet=('A', 'C', 'G', 'T'), packed=False):
         self._index = {}
         self._alphabet = alphabet
+        self._packed = packed
         self._composition = {letter:[set() for _ in range(max_length+1)] for letter in alphabet}
 
     @classmethod
@@ -131,7 +214,9 @@ class SequenceStore(object):
             sequence (:obj:`string`): New sequence to be added.
             wildcard (:obj:`string`): Character that should be treated as wildcard.
         """
-        if sequence not in self._index:
+        if self._packed:
+            self._add_packed(sequence, wildcard)
+        elif sequence not in self._index:
             self._index[sequence] = {}
             if wildcard is None:
                 for letter in self._alphabet:
@@ -147,6 +232,18 @@ class SequenceStore(object):
                     for i in range(*letter_index):
                         self._composition[letter][i].add(sequence)
 
+    def _add_packed(self, sequence, wildcard):
+        key = encode(sequence, self._alphabet)
+        if key not in self._index:
+            wilds = 0
+            if wildcard is not None:
+                wilds = sequence.count(wildcard)
+            self._index[key] = wilds
+            for letter in self._alphabet:
+                letter_count = sequence.count(letter)
+                for i in range(letter_count, letter_count + wilds + 1):
+                    self._composition[letter][i].add(key)
+
     def remove(self, item):
         """Remove a sequence from the sequence store.
 
@@ -156,6 +253,15 @@ class SequenceStore(object):
         Raises:
             KeyError: if the sequence doesn't exist in the store.
         """
+        if self._packed:
+            key = encode(item, self._alphabet)
+            wilds = self._index[key]
+            for letter in self._alphabet:
+                letter_count = item.count(letter)
+                for i in range(letter_count, letter_count + wilds + 1):
+                    self._composition[letter][i].remove(key)
+            del self._index[key]
+            return
         for letter in self._alphabet:
             for i in range(*self._index[item][letter]):
                 self._composition[letter][i].remove(item)
@@ -167,7 +273,7 @@ class SequenceStore(object):
         Args:
             item (:obj:`string`): Sequence to be removed.
         """
-        if item in self._index:
+        if item in self:
             self.remove(item)
 
     def find(self, sequence, max_diff, wildcard=None):
@@ -201,9 +307,13 @@ class SequenceStore(object):
 
         Returns:
             If `raw` is _True_ an unordered :obj:`list` of candidates is returned,
-            otherwise a list of (sequence, distance) tuples is returned.
+            otherwise a list of (sequence, distance) tuples is returned. For packed
+            stores only candidates within `max_diff` are returned.
         """
-        if sequence in self._index:
+        key = sequence
+        if self._packed:
+            key = encode(sequence, self._alphabet)
+        if key in self._index:
             if raw:
                 return [sequence]
             return [(sequence, 0)]
@@ -223,6 +333,16 @@ class SequenceStore(object):
             max_count = min(len(self._composition[letter]), letter_count + max_diff + wilds + 1)
             for cand in self._composition[letter][min_count:max_count]:
                 candidates.extend(cand)
+        if self._packed:
+            candidates = [(cand, packed_diff(key, cand)) for cand in set(candidates)]
+            candidates = [(decode(cand, self._alphabet), diff) for (cand, diff) in candidates
+                          if diff <= max_diff]
+            if raw:
+                return [cand for (cand, _) in candidates]
+            candidates.sort(key=lambda x: x[1])
+            if max_hits is not None:
+                candidates = candidates[:max_hits]
+            return candidates
         candidates = list(set(candidates))
         if raw:
             return candidates
@@ -247,10 +367,207 @@ class SequenceStore(object):
         return len(self._index)
 
     def __contains__(self, item):
+        if self._packed:
+            try:
+                item = encode(item, self._alphabet)
+            except ValueError:
+                return False
+        return item in self._index
+
+    def __iter__(self):
+        for key in self._index:
+            if self._packed:
+                key = decode(key, self._alphabet)
+            yield key
+
+class BKTreeStore(object):
+    """Store a collection of sequences in a BK-tree.
+
+    This provides the same interface as :obj:`SequenceStore` but organises sequences
+    in a metric tree based on their Hamming distance. Searches only visit subtrees
+    that can contain matches and only return sequences within the requested distance,
+    rather than all sequences with a compatible composition. All sequences in the store
+    have to be of the same length.
+
+    Removed sequences remain in the tree to guide searches but are no longer reported.
+    Once they outnumber the sequences in the store, the tree is rebuilt without them.
+
+    Args:
+        max_length (:obj:`int`): Maximum sequence length supported by this store.
+        alphabet (:obj:`tuple`): A list of all valid sequence characters.
+        packed (:obj:`bool`, optional): Flag indicating whether sequences should be
+            stored in packed form (see :obj:`SequenceStore`).
+    """
+    __slots__ = '_alphabet', '_packed', '_root', '_tree', '_index'
+    _logger = utils.get_logger(__name__)
+
+    def __init__(self, max_length, alphabet=('A', 'C', 'G', 'T'), packed=False):
+        self._alphabet = alphabet
+        self._packed = packed
+        self._root = None
+        self._tree = {}
+        self._index = set()
+
+    @classmethod
+    def from_list(cls, sequences, **kw):
+        """Create BKTreeStore from a list of sequences.
+
+        Args:
+            sequences (:obj:`list`): A list of sequences.
+
+            Additional named arguments will be passed to the BKTreeStore constructor.
+
+        Returns:
+            :obj:`pyrates.sequence.BKTreeStore`
+        """
+        store = cls(len(sequences[0]), **kw)
+        for seq in sequences:
+            store.add(seq)
+        return store
+
+    def _key(self, sequence):
+        if self._packed:
+            return encode(sequence, self._alphabet)
+        return sequence
+
+    def _diff(self, key1, key2):
+        if self._packed:
+            return packed_diff(key1, key2)
+        return SequenceStore.diff(key1, key2)
+
+    def add(self, sequence, wildcard=None):
+        """Add a sequence to the store.
+
+        Args:
+            sequence (:obj:`string`): New sequence to be added.
+            wildcard (:obj:`string`): Ignored. Wildcards are treated like any other character.
+        """
+        key = self._key(sequence)
+        if key in self._index:
+            return
+        self._index.add(key)
+        if key not in self._tree:
+            self._insert(key)
+
+    def _insert(self, key):
+        """Add a node to the tree."""
+        self._tree[key] = {}
+        if self._root is None:
+            self._root = key
+            return
+        node = self._root
+        while True:
+            diff = self._diff(key, node)
+            children = self._tree[node]
+            if diff not in children:
+                children[diff] = key
+                break
+            node = children[diff]
+
+    def remove(self, item):
+        """Remove a sequence from the sequence store.
+
+        Args:
+            item (:obj:`string`): Sequence to be removed.
+
+        Raises:
+            KeyError: if the sequence doesn't exist in the store.
+        """
+        self._index.remove(self._key(item))
+        if len(self._tree) > 2*len(self._index):
+            self._rebuild()
+
+    def _rebuild(self):
+        """Recreate the tree from the sequences in the store, dropping removed nodes."""
+        self._root = None
+        self._tree = {}
+        for key in self._index:
+            self._insert(key)
+
+    def discard(self, item):
+        """Remove a sequence from the store if it exists.
+
+        Args:
+            item (:obj:`string`): Sequence to be removed.
+        """
+        if item in self:
+            self.remove(item)
+
+    def find(self, sequence, max_diff, wildcard=None):
+        """Find best match for sequence in the store.
+
+        Args:
+            sequence (:obj:`string`): Sequence to search for.
+            max_diff (:obj:`int`): Maximum number of mismatches allowed for a match.
+            wildcard (:obj:`str`, optional): Ignored.
+
+        Returns:
+            :obj:`tuple`: A tuple consisting of the best match found in the store and
+            the number of differences between the returned match and the search string.
+            If no suitable match was found `None` is returned instead.
+        """
+        match = self.search(sequence, max_diff, 1, wildcard=wildcard)
+        if len(match) == 0:
+            return None
+        return match[0]
+
+    def search(self, sequence, max_diff, max_hits=10, raw=False, wildcard=None):
+        """Search the sequence store for all approximate matches to a search pattern.
+
+        Args:
+            sequence (:obj:`string`): Sequence to search for.
+            max_diff (:obj:`int`): Maximum number of mismatches allowed for a match.
+            max_hits (:obj:`int`, optional): Maximum number of results to return.
+                set to _None_ to return all candidates. Ignored if `raw` is _True_.
+            raw (:obj:`bool`, optional): Flag indicating whether the raw sequence
+                matches should be returned instead of sequence/distance pairs.
+            wildcard (:obj:`str`, optional): Ignored.
+
+        Returns:
+            If `raw` is _True_ an unordered :obj:`list` of matches is returned,
+            otherwise a list of (sequence, distance) tuples is returned. Only
+            sequences within `max_diff` of the search pattern are included.
+        """
+        key = self._key(sequence)
+        if key in self._index:
+            if raw:
+                return [sequence]
+            return [(sequence, 0)]
+        candidates = []
+        if self._root is not None:
+            pending = [self._root]
+            while pending:
+                node = pending.pop()
+                diff = self._diff(key, node)
+                if diff <= max_diff and node in self._index:
+                    candidates.append((node, diff))
+                for (child_diff, child) in self._tree[node].items():
+                    if diff - max_diff <= child_diff <= diff + max_diff:
+                        pending.append(child)
+        if self._packed:
+            candidates = [(decode(cand, self._alphabet), diff) for (cand, diff) in candidates]
+        if raw:
+            return [cand for (cand, _) in candidates]
+        candidates.sort(key=lambda x: x[1])
+        if max_hits is not None:
+            candidates = candidates[:max_hits]
+        return candidates
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, item):
+        if self._packed:
+            try:
+                item = encode(item, self._alphabet)
+            except ValueError:
+                return False
         return item in self._index
 
     def __iter__(self):
         for key in self._index:
+            if self._packed:
+                key = decode(key, self._alphabet)
             yield key
 
 class GroupedSequenceStore(object):
@@ -266,28 +583,62 @@ class GroupedSequenceStore(object):
         tag_size (:obj:`int`, optional): Length of prefix to use for grouping of reads.
         max_diff (:obj:`int`, optional): Maximum number of mismatches allowed.
         wildcard (:obj:`string`, optional): Character that should be treated as wildcard.
+        packed (:obj:`bool`, optional): Flag indicating whether sequences should be
+            stored in packed form (see :obj:`SequenceStore`).
+        index (:obj:`type`, optional): Class used to store the sequences of each group,
+            either :obj:`SequenceStore` or :obj:`BKTreeStore`.
     """
-    __slots__ = '_alphabet', '_store', '_wild_store', '_wildcard', '_tag_size', '_tag_diff', \
-                '_length', '_max_diff'
+    __slots__ = '_alphabet', '_store', '_wild_store', '_wildcard', '_tag_size', '_ball_size', \
+                '_length', '_max_diff', '_max_length', '_packed', '_index_type'
     _logger = utils.get_logger(__name__)
 
     def __init__(self, max_length, alphabet=('A', 'C', 'G', 'T'),
-                 tag_size=4, max_diff=4, wildcard=None):
+                 tag_size=4, max_diff=4, wildcard=None, packed=False, index=SequenceStore):
         self._alphabet = alphabet
         self._tag_size = tag_size
-        self._store = {''.join(tag):SequenceStore(max_length, alphabet) for
-                       tag in itools.product(alphabet, repeat=tag_size)}
+        self._max_length = max_length
+        self._packed = packed
+        self._index_type = index
+        ## groups are created when the first sequence with the corresponding tag is added
+        self._store = {}
         self._max_diff = max_diff
-        self._tag_diff = {tag:{} for tag in self._store}
-        for tag in self._store:
-            for other_tag in self._store:
-                diff = SequenceStore.diff(tag, other_tag)
-                if diff <= max_diff:
-                    self._tag_diff[tag][other_tag] = diff
-        self._wild_store = SequenceStore(max_length, alphabet)
+        ## number of tags within max_diff of any given tag
+        self._ball_size = sum(math.factorial(tag_size)//math.factorial(diff)//
+                              math.factorial(tag_size - diff)*(len(alphabet) - 1)**diff
+                              for diff in range(min(max_diff, tag_size) + 1))
+        self._wild_store = index(max_length, alphabet, packed)
         self._wildcard = wildcard
         self._length = 0
 
+    def _neighbours(self, tag, max_diff):
+        """Non-empty groups with tags within `max_diff` of `tag`.
+
+        If there are fewer groups than tags within `max_diff` the existing groups
+        are checked, otherwise all tags within `max_diff` are enumerated.
+
+        Yields:
+            :obj:`tuple`: (tag, distance, store) for each matching group.
+        """
+        if self._ball_size >= len(self._store):
+            for (other_tag, store) in self._store.items():
+                if store:
+                    diff = SequenceStore.diff(tag, other_tag)
+                    if diff <= max_diff:
+                        yield (other_tag, diff, store)
+            return
+        for diff in range(min(max_diff, len(tag)) + 1):
+            for positions in itools.combinations(range(len(tag)), diff):
+                choices = [[letter for letter in self._alphabet if letter != tag[pos]]
+                           for pos in positions]
+                for letters in itools.product(*choices):
+                    other_tag = list(tag)
+                    for (pos, letter) in zip(positions, letters):
+                        other_tag[pos] = letter
+                    other_tag = ''.join(other_tag)
+                    store = self._store.get(other_tag)
+                    if store:
+                        yield (other_tag, diff, store)
+
     @classmethod
     def from_list(cls, sequences, **kw):
         """Create GroupedSequenceStore from a list of sequences.
@@ -316,6 +667,9 @@ class GroupedSequenceStore(object):
             if self._wildcard is not None and self._wildcard in tag:
                 self._wild_store.add(sequence)
             else:
+                if tag not in self._store:
+                    self._store[tag] = self._index_type(self._max_length, self._alphabet,
+                                                        self._packed)
                 self._store[tag].add(sequence[self._tag_size:], self._wildcard)
             self._length += 1
 
@@ -360,7 +714,7 @@ class GroupedSequenceStore(object):
             return None
         return match[0]
 
-    def search(self, sequence, max_hits=10, raw=False):
+    def search(self, sequence, max_hits=10, raw=False, max_diff=None):
         """Search the sequence store for all approximate matches to a search pattern.
 
         Args:
@@ -369,32 +723,38 @@ class GroupedSequenceStore(object):
                 set to _None_ to return all candidates. Ignored if `raw` is _True_.
             raw (:obj:`bool`, optional): Flag indicating whether the raw sequence
                 matches should be returned instead of sequence/distance pairs.
+            max_diff (:obj:`int`, optional): Search radius, if it should be smaller
+                than the maximum number of mismatches the store was created with.
+
+        Note:
+            Sequences with wildcards in their tag are only matched exactly by other
+            sequences. As search patterns they are compared to all groups, with each
+            wildcard in the tag counted as a mismatch.
 
         Returns:
             If `raw` is _True_ an unordered :obj:`list` of candidates is returned,
             otherwise a list of (sequence, distance) tuples is returned.
         """
+        if max_diff is None or max_diff > self._max_diff:
+            max_diff = self._max_diff
         tag = sequence[:self._tag_size]
         tail = sequence[self._tag_size:]
         candidates = []
-        if self._wildcard is not None and self._wildcard in tag:
-            if sequence in self._wild_store:
-                if raw:
-                    return [sequence]
-                else:
-                    return [(sequence, 0)]
+        if self._wildcard is not None and self._wildcard in tag and \
+           sequence in self._wild_store:
+            if raw:
+                return [sequence]
             else:
-                return []
+                return [(sequence, 0)]
         else:
-            if tail in self._store[tag]:
+            if tag in self._store and tail in self._store[tag]:
                 if raw:
                     return [sequence]
                 else:
                     return [(sequence, 0)]
-            for other_tag in self._tag_diff[tag]:
-                tag_diff = self._tag_diff[tag][other_tag]
-                tag_cand = self._store[other_tag].search(
-                    tail, self._max_diff - tag_diff, max_hits=max_hits,
+            for (other_tag, tag_diff, store) in self._neighbours(tag, max_diff):
+                tag_cand = store.search(
+                    tail, max_diff - tag_diff, max_hits=max_hits,
                     raw=raw, wildcard=self._wildcard)
                 if not raw:
                     tag_cand = [(other_tag + seq, diff + tag_diff) for seq, diff in tag_cand]
@@ -420,4 +780,221 @@ class GroupedSequenceStore(object):
         tag = item[:self._tag_size]
         if self._wildcard and self._wildcard in tag:
             return item in self._wild_store
-        return item[self._tag_size:] in self._store[tag]
+        return tag in self._store and item[self._tag_size:] in self._store[tag]
+
+class PigeonholeStore(object):
+    """Store a collection of sequences indexed by exact matches of sequence blocks.
+
+    Sequences are split into `max_diff` + 1 consecutive blocks and each block is stored in
+    a separate hash table. Since two sequences that differ in at most `max_diff`
+    positions have at least one block in common, all approximate matches can be found by
+    looking up the blocks of the search pattern and verifying the resulting candidates.
+    Searches return exactly the sequences within `max_diff` of the search pattern.
+
+    This can be used in place of a :obj:`GroupedSequenceStore`. As with that class,
+    sequences with wildcards in their first `tag_size` positions are not returned by
+    approximate searches, but they can be searched for.
+
+    Args:
+        max_length (:obj:`int`): Maximum sequence length supported by this store.
+        alphabet (:obj:`tuple`, optional): A list of all valid sequence characters.
+        tag_size (:obj:`int`, optional): Length of prefix checked for wildcards.
+        max_diff (:obj:`int`, optional): Maximum number of mismatches allowed.
+        wildcard (:obj:`string`, optional): Character that should be treated as wildcard.
+        packed (:obj:`bool`, optional): Flag indicating whether sequences should be
+            stored in packed form (see :obj:`SequenceStore`).
+    """
+    __slots__ = '_alphabet', '_blocks', '_bounds', '_index', '_wild_store', '_wildcard', \
+                '_tag_size', '_max_diff', '_packed'
+    _logger = utils.get_logger(__name__)
+
+    def __init__(self, max_length, alphabet=('A', 'C', 'G', 'T'),
+                 tag_size=4, max_diff=4, wildcard=None, packed=False):
+        self._alphabet = alphabet
+        self._tag_size = tag_size
+        self._max_diff = max_diff
+        self._wildcard = wildcard
+        self._packed = packed
+        self._blocks = [{} for _ in range(max_diff + 1)]
+        self._bounds = {}
+        self._index = set()
+        self._wild_store = set()
+
+    @classmethod
+    def from_list(cls, sequences, **kw):
+        """Create PigeonholeStore from a list of sequences.
+
+        Args:
+            sequences (:obj:`list`): A list of sequences.
+
+            Additional named arguments will be passed to the PigeonholeStore constructor.
+
+        Returns:
+            :obj:`pyrates.sequence.PigeonholeStore`
+        """
+        store = cls(len(sequences[0]), **kw)
+        for seq in sequences:
+            store.add(seq)
+        return store
+
+    def _split(self, sequence):
+        """Blocks of a sequence."""
+        length = len(sequence)
+        if length not in self._bounds:
+            count = len(self._blocks)
+            self._bounds[length] = [(length*i//count, length*(i + 1)//count)
+                                    for i in range(count)]
+        return [sequence[start:end] for (start, end) in self._bounds[length]]
+
+    def _is_wild(self, sequence):
+        return self._wildcard is not None and self._wildcard in sequence[:self._tag_size]
+
+    def add(self, sequence):
+        """Add a sequence to the store.
+
+        Args:
+            sequence (:obj:`string`): New sequence to be added.
+        """
+        if self._is_wild(sequence):
+            self._wild_store.add(sequence)
+            return
+        key = encode(sequence, self._alphabet) if self._packed else sequence
+        if key in self._index:
+            return
+        self._index.add(key)
+        for (table, block) in zip(self._blocks, self._split(sequence)):
+            if block in table:
+                table[block].add(key)
+            else:
+                table[block] = {key}
+
+    def remove(self, item):
+        """Remove a sequence from the sequence store.
+
+        Args:
+            item (:obj:`string`): Sequence to be removed.
+
+        Raises:
+            KeyError: if the sequence doesn't exist in the store.
+        """
+        if self._is_wild(item):
+            self._wild_store.remove(item)
+            return
+        key = encode(item, self._alphabet) if self._packed else item
+        self._index.remove(key)
+        for (table, block) in zip(self._blocks, self._split(item)):
+            table[block].remove(key)
+            if not table[block]:
+                del table[block]
+
+    def discard(self, item):
+        """Remove a sequence from the store if it exists.
+
+        Args:
+            item (:obj:`string`): Sequence to be removed.
+        """
+        if item in self:
+            self.remove(item)
+
+    def find(self, sequence):
+        """Find best match for sequence in the store.
+
+        Args:
+            sequence (:obj:`string`): Sequence to search for.
+
+        Returns:
+            :obj:`tuple`: A tuple consisting of the best match found in the store and
+            the number of differences between the returned match and the search string.
+            If no suitable match was found `None` is returned instead.
+        """
+        match = self.search(sequence, 1)
+        if len(match) == 0:
+            return None
+        return match[0]
+
+    def search(self, sequence, max_hits=10, raw=False, max_diff=None):
+        """Search the sequence store for all approximate matches to a search pattern.
+
+        Args:
+            sequence (:obj:`string`): Sequence to search for.
+            max_hits (:obj:`int`, optional): Maximum number of results to return.
+                set to _None_ to return all candidates. Ignored if `raw` is _True_.
+            raw (:obj:`bool`, optional): Flag indicating whether the raw sequence
+                matches should be returned instead of sequence/distance pairs.
+            max_diff (:obj:`int`, optional): Search radius, if it should be smaller
+                than the maximum number of mismatches the store was created with.
+                Sequences within a radius of `max_diff` share at least one of any
+                `max_diff` + 1 blocks with the search pattern, so only that many
+                blocks are looked up.
+
+        Note:
+            Sequences with wildcards in their tag are only matched exactly by other
+            sequences. As search patterns they are compared to all other sequences,
+            with each wildcard counted as a mismatch.
+
+        Returns:
+            If `raw` is _True_ an unordered :obj:`list` of matches is returned,
+            otherwise a list of (sequence, distance) tuples is returned.
+        """
+        if max_diff is None or max_diff > self._max_diff:
+            max_diff = self._max_diff
+        if sequence in self:
+            if raw:
+                return [sequence]
+            return [(sequence, 0)]
+        candidates = set()
+        for (table, block) in zip(self._blocks[:max_diff + 1], self._split(sequence)):
+            if block in table:
+                candidates.update(table[block])
+        if self._packed:
+            key = encode(sequence, self._alphabet)
+            candidates = [(cand, packed_diff(key, cand)) for cand in candidates]
+            candidates = [(decode(cand, self._alphabet), diff) for (cand, diff) in candidates
+                          if diff <= max_diff]
+        else:
+            candidates = [(cand, SequenceStore.diff(sequence, cand)) for cand in candidates
+                          if len(cand) == len(sequence)]
+            candidates = [cand for cand in candidates if cand[1] <= max_diff]
+        if raw:
+            return [cand for (cand, _) in candidates]
+        candidates.sort(key=lambda x: x[1])
+        if max_hits is not None:
+            candidates = candidates[:max_hits]
+        return candidates
+
+    @property
+    def wild_tags(self):
+        """All sequences with wildcards in their tags.
+        """
+        return self._wild_store
+
+    def __len__(self):
+        return len(self._index) + len(self._wild_store)
+
+    def __contains__(self, item):
+        if self._is_wild(item):
+            return item in self._wild_store
+        if self._packed:
+            try:
+                item = encode(item, self._alphabet)
+            except ValueError:
+                return False
+        return item in self._index
+
+def create_store(max_length, index=SequenceStore, **kw):
+    """Create a store for approximate searches of UIDs.
+
+    Args:
+        max_length (:obj:`int`): Maximum sequence length supported by the store.
+        index (:obj:`type`, optional): Either :obj:`PigeonholeStore` or the class used
+            to store the groups of a :obj:`GroupedSequenceStore`.
+
+        Additional named arguments will be passed to the constructor of the store.
+
+    Returns:
+        :obj:`pyrates.sequence.PigeonholeStore` if requested, otherwise a
+        :obj:`pyrates.sequence.GroupedSequenceStore`.
+    """
+    if index is PigeonholeStore:
+        return PigeonholeStore(max_length, **kw)
+    return GroupedSequenceStore(max_length, index=index, **kw)
@@ -2,6 +2,7 @@
 
 import os
 import os.path
+import random
 import pyrates.sequence as sequence
 import pyrates.consensus as cons
 import pyrates.clustering as clust
@@ -117,6 +118,64 @@ def teardown_fastq_mismatch():
     """Remove files created for simple fastq test"""
     os.remove(TMP + 'mismatch.fastq')
 
+def _mutate(seq, rate, rand, alphabet='ACGTN'):
+    """Introduce random substitutions into a sequence."""
+    return ''.join(rand.choice(alphabet) if rand.random() < rate else base for base in seq)
+
+def setup_fastq_errors():
+    """Create fastq file with reads from many clusters with errors in UIDs and sequences."""
+    rand = random.Random(42)
+    adapter = 'ACGT'
+    reads = []
+    quals = []
+    for _ in range(300):
+        uid = ''.join(rand.choice('ACGT') for _ in range(8))
+        insert = ''.join(rand.choice('ACGT') for _ in range(rand.choice([30, 31, 40])))
+        for _ in range(rand.randint(1, 8)):
+            read_uid = _mutate(uid, 0.05, rand)
+            read = read_uid[:4] + adapter + _mutate(insert, 0.02, rand) + adapter + read_uid[4:]
+            reads.append(read)
+            quals.append(''.join(rand.choice('#5?I') for _ in read))
+    order = list(range(len(reads)))
+    rand.shuffle(order)
+    create_fastq([reads[i] for i in order], [quals[i] for i in order], 'errors.fastq')
+
+def _create_sorted(file_name, protected, seed=17):
+    """Create fastq file with reads sorted by UID and errors outside the first
+    `protected` positions of the UID."""
+    rand = random.Random(seed)
+    adapter = 'ACGT'
+    reads = []
+    for _ in range(300):
+        uid = ''.join(rand.choice('ACGT') for _ in range(12))
+        insert = ''.join(rand.choice('ACGT') for _ in range(rand.choice([30, 31, 40])))
+        for _ in range(rand.randint(1, 8)):
+            read_uid = uid[:protected] + _mutate(uid[protected:], 0.05, rand)
+            read = read_uid[:6] + adapter + _mutate(insert, 0.02, rand) + adapter + read_uid[6:]
+            reads.append((read_uid, read, ''.join(rand.choice('#5?I') for _ in read)))
+    reads.sort(key=lambda read: read[0])
+    create_fastq([read[1] for read in reads], [read[2] for read in reads], file_name)
+
+def setup_fastq_sorted():
+    """Create fastq file with reads sorted by UID and errors outside the UID prefix."""
+    _create_sorted('sorted.fastq', 2)
+
+def teardown_fastq_sorted():
+    """Remove files created for fastq test with sorted reads"""
+    os.remove(TMP + 'sorted.fastq')
+
+def setup_fastq_sorted_errors():
+    """Create fastq file with reads sorted by UID and errors anywhere in the UID."""
+    _create_sorted('sorted_errors.fastq', 0, seed=23)
+
+def teardown_fastq_sorted_errors():
+    """Remove files created for fastq test with sorted reads and errors in UID prefixes"""
+    os.remove(TMP + 'sorted_errors.fastq')
+
+def teardown_fastq_errors():
+    """Remove files created for fastq test with errors"""
+    os.remove(TMP + 'errors.fastq')
+
 def create_consensus(uids, uid_qual, seqs, seq_qual):
     """Create consensus dictionary from raw sequences.
 
@@ -0,0 +1,41 @@
+"""Tests for benchmark utilities"""
+
+import os
+from nose2.tools.decorators import with_teardown
+
+import pyrates.consensus as cons
+import pyrates.fastq as fq
+from pyrates.bench import data, runner
+from pyrates.test import TMP
+
+def _remove_bench():
+    for name in ['bench1.fastq', 'bench2.fastq']:
+        if os.path.isfile(TMP + name):
+            os.remove(TMP + name)
+
+@with_teardown(_remove_bench)
+def test_generate():
+    """Synthetic data is reproducible"""
+    count = data.generate(TMP + 'bench1.fastq', molecules=20, duplicates=3, id_length=4,
+                          adapter='ACGT', read_length=30, seed=1)
+    data.generate(TMP + 'bench2.fastq', molecules=20, duplicates=3, id_length=4,
+                  adapter='ACGT', read_length=30, seed=1)
+    with open(TMP + 'bench1.fastq') as fastq1, open(TMP + 'bench2.fastq') as fastq2:
+        assert fastq1.read() == fastq2.read(), "Output differs between runs"
+    with fq.open_fastq(TMP + 'bench1.fastq') as fastq:
+        records = list(fq.read_fastq(fastq))
+    assert len(records) == count, "%r != %r" % (len(records), count)
+    assert all(len(seq) == len(qual) for (_, seq, qual) in records), \
+           "Sequence and quality lengths differ"
+
+@with_teardown(_remove_bench)
+def test_run():
+    """Record timings for clustering stages"""
+    count = data.generate(TMP + 'bench1.fastq', molecules=20, duplicates=3, id_length=4,
+                          adapter='ACGT', read_length=30, uid_error=0.05)
+    stats = runner.run(TMP + 'bench1.fastq', 4, 'ACGT', threshold=2, prefix=2)
+    assert stats['reads'] == count, "%r != %r" % (stats['reads'], count)
+    for stage in ['Clustering.from_fastq', 'Clustering.write', 'Consensus.update',
+                  'GroupedSequenceStore.search']:
+        assert stage in stats['stages'], "%r missing from %r" % (stage, stats['stages'])
+    assert not hasattr(cons.Consensus.update, '__wrapped__'), "Instrumentation was not removed"
@@ -1,14 +1,24 @@
 """Tests for sequence clustering"""
 
+import gzip
 import os
+import random
+import unittest
 from nose2.tools import params
 from nose2.tools.decorators import with_setup, with_teardown
+from nose2.tools.such import helper
 
 import pyrates.clustering as clust
+import pyrates.consensus as cons
+import pyrates.fastq as fq
+import pyrates.index as pidx
 import pyrates.sequence as pseq
 from pyrates.test import TMP
 from pyrates.test.fixtures import (setup_fastq_mismatch, setup_fastq_simple,
                                    setup_fastq_missing, setup_fastq_map,
+                                   setup_fastq_errors, teardown_fastq_errors,
+                                   setup_fastq_sorted, teardown_fastq_sorted,
+                                   setup_fastq_sorted_errors, teardown_fastq_sorted_errors,
                                    teardown_fastq_map, teardown_fastq_missing,
                                    teardown_fastq_mismatch, teardown_fastq_simple,
                                    create_consensus)
@@ -74,7 +84,82 @@ def test_merge_targets():
     assert cand == uid2 + uid2, "%r != %r" % (cand, uid2 + uid2)
     cand = clusters.merge_target(uid, seq3[0], {}, 1)
     assert cand is None, "%r != %r" % (cand, None)
+    cand = clusters.merge_target(('GGGGGGAA', 'I'*8), (seq3[0].sequence, seq3[0].quality),
+                                 {}, 2)
+    assert cand == uid2 + uid2, "%r != %r" % (cand, uid2 + uid2)
 
+def test_singleton_promotion():
+    """Store single read clusters compactly until a second read is added"""
+    clusters = clust.Clustering({}, pseq.GroupedSequenceStore(8, tag_size=2, max_diff=2))
+    reads = [('AACCGGTT', 'IIIIIIII', 'ACTGTTTGTCTAAGC', 'IIIDIIIIIIIIIII'),
+             ('TTGGCCAA', 'IIIIIIII', 'ACTGTTTGTCTAAGC', 'IIIIIIIIIIIIIII'),
+             ('AACCGGTA', 'IIII#III', 'ACTGTTTGTCTAAGC', 'IIIIIIIIIIIIIII')]
+    clusters.cluster_reads(reads[:2], {}, 2, name='test')
+    for uid in ('AACCGGTT', 'TTGGCCAA'):
+        assert isinstance(clusters._clusters[uid], cons.Singleton), \
+               "%r is not a singleton" % clusters._clusters[uid]
+    expect = "@test:AACCGGTT:IIIIIIII:1:0:0:0\nACTGTTTGTCTAAGC\n+\nIIIDIIIIIIIIIII"
+    for values in (dict(clusters.items()), clusters.clusters,
+                   dict(zip(clusters.keys(), clusters.values())), dict(clusters.iteritems()),
+                   dict(zip(clusters.iterkeys(), clusters.itervalues()))):
+        obs = values['AACCGGTT']
+        assert str(obs) == expect, "%r != %r" % (str(obs), expect)
+    assert len(clusters.values()) == len(clusters.items()) == 2, "Unexpected number of clusters"
+    assert isinstance(clusters._clusters['AACCGGTT'], cons.Singleton), \
+           "Singleton was replaced when accessed through a view"
+    clusters.cluster_reads(reads[2:], {}, 2, name='test')
+    assert isinstance(clusters._clusters['AACCGGTT'], cons.Consensus), \
+           "%r was not promoted" % clusters._clusters['AACCGGTT']
+    assert isinstance(clusters._clusters['TTGGCCAA'], cons.Singleton), \
+           "%r is not a singleton" % clusters._clusters['TTGGCCAA']
+    assert clusters['AACCGGTT'].size == 2, "%r != 2" % clusters['AACCGGTT'].size
+    assert clusters['TTGGCCAA'].size == 1, "%r != 1" % clusters['TTGGCCAA'].size
+
+@params(cons.Consensus, cons.ClusterTable)
+def test_assign_clusters(consensus):
+    """Replace and modify clusters through the clusters attribute"""
+    clusters = clust.Clustering({}, pseq.GroupedSequenceStore(8, tag_size=2, max_diff=2),
+                                consensus=consensus)
+    centre = cons.Consensus(pseq.SequenceWithQuality('AACCGGTT', 'IIIIIIII'),
+                            pseq.SequenceWithQuality('ACTGTTTGTC', 'IIIIIIIIII'))
+    clusters.clusters = {'AACCGGTT':centre}
+    assert list(clusters.clusters) == ['AACCGGTT'], \
+           "%r != ['AACCGGTT']" % list(clusters.clusters)
+    obs = clusters.clusters['AACCGGTT'].sequence.sequence
+    assert obs == 'ACTGTTTGTC', "%r != 'ACTGTTTGTC'" % obs
+    clusters.clusters['TTGGCCAA'] = cons.Consensus(pseq.SequenceWithQuality('TTGGCCAA', 'IIIIIIII'),
+                                                   centre.sequence)
+    assert len(clusters) == 2, "%r != 2" % len(clusters)
+    del clusters.clusters['AACCGGTT']
+    assert list(clusters.keys()) == ['TTGGCCAA'], "%r != ['TTGGCCAA']" % list(clusters.keys())
+    clusters.clusters = clusters.clusters
+    assert len(clusters) == 1, "%r != 1" % len(clusters)
+
+@params(pseq.GroupedSequenceStore, pseq.PigeonholeStore)
+def test_merge_wild_prefix(index):
+    """Merge reads with wildcards in the UID prefix into existing clusters"""
+    clusters = clust.Clustering({}, index(8, tag_size=2, max_diff=2, wildcard='N'))
+    reads = [('AACCGGTT', 'IIIIIIII', 'ACTGTTTGTCTAAGC', 'IIIIIIIIIIIIIII'),
+             ('ANCCGGTT', 'I#IIIIII', 'ACTGTTTGTCTAAGC', 'IIIIIIIIIIIIIII'),
+             ('NNCCGGTA', '##IIIIII', 'ACTGTTTGTCTAAGC', 'IIIIIIIIIIIIIII')]
+    clusters.cluster_reads(reads, {}, 2)
+    assert list(clusters) == ['AACCGGTT', 'NNCCGGTA'], \
+           "%r != ['AACCGGTT', 'NNCCGGTA']" % list(clusters)
+    assert clusters['AACCGGTT'].size == 2, "%r != 2" % clusters['AACCGGTT'].size
+    assert clusters.fail_count == 1, "%r != 1" % clusters.fail_count
+
+def test_merge_target_length():
+    """Only consider clusters with consensus of the same length as the read"""
+    clusters = clust.Clustering({}, pseq.GroupedSequenceStore(8, tag_size=2, max_diff=2))
+    reads = [('AACCGGTT', 'IIIIIIII', 'ACTGTTTGTCTAAGC', 'IIIIIIIIIIIIIII'),
+             ('AACCGGTT', 'IIIIIIII', 'ACTGTTTGTCTAAGCA', 'IIIIIIIIIIIIIIII')]
+    clusters.cluster_reads(reads, {}, 2)
+    read = ('ACTGTTTGTCTAAGC', 'IIIIIIIIIIIIIII')
+    cand = clusters.merge_target(('AACCGGTA', 'IIIIIIII'), read, {}, 2)
+    assert cand is None, "%r != None" % cand
+    read = ('ACTGTTTGTCTAAGCA', 'IIIIIIIIIIIIIIII')
+    cand = clusters.merge_target(('AACCGGTC', 'IIIIIIII'), read, {}, 2)
+    assert cand == 'AACCGGTT', "%r != 'AACCGGTT'" % cand
 
 @with_setup(setup_fastq_simple)
 @with_teardown(teardown_fastq_simple)
@@ -199,6 +284,133 @@ def test_fastq_mismatch():
     assert cluster[uid3_expect].sequence.sequence == seq3_expect, \
            "%r != %r" % (cluster[uid3_expect].sequence.sequence, seq3_expect)
 
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_fastq_packed():
+    """Packed UID storage doesn't change clustering"""
+    plain = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2)
+    packed = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2,
+                                         packed=True)
+    assert [str(packed[uid]) for uid in packed] == [str(plain[uid]) for uid in plain], \
+           "Packed clustering differs from default"
+    assert packed.stats['total_fixed'] == plain.stats['total_fixed'], \
+        "%r != %r" % (packed.stats['total_fixed'], plain.stats['total_fixed'])
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_fastq_array_consensus():
+    """Array consensus doesn't change clustering"""
+    if cons.np is None:
+        raise unittest.SkipTest("NumPy not available")
+    plain = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2)
+    array = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2,
+                                        consensus=cons.ArrayConsensus)
+    assert [str(array[uid]) for uid in array] == [str(plain[uid]) for uid in plain], \
+           "Array consensus differs from default"
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_fastq_cluster_table():
+    """Cluster table doesn't change clustering"""
+    plain = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2)
+    table = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2,
+                                        consensus=cons.ClusterTable)
+    assert isinstance(table._clusters, cons.ClusterTable), \
+           "Unexpected cluster type %r" % type(table._clusters)
+    assert [str(table[uid]) for uid in table] == [str(plain[uid]) for uid in plain], \
+           "Cluster table differs from default"
+
+@params(pseq.SequenceStore, pseq.BKTreeStore, pseq.PigeonholeStore)
+def test_fastq_deepening(index):
+    """Iterative deepening of UID search doesn't change clustering"""
+    setup_fastq_errors()
+    try:
+        plain = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=3,
+                                            prefix=2, index=index)
+        for workers in (1, 2):
+            deep = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=3,
+                                               prefix=2, index=index, workers=workers,
+                                               deepening=True)
+            assert [str(deep[uid]) for uid in deep] == [str(plain[uid]) for uid in plain], \
+                   "Iterative deepening changes clustering"
+            assert deep.stats['total_fixed'] == plain.stats['total_fixed'], \
+                "%r != %r" % (deep.stats['total_fixed'], plain.stats['total_fixed'])
+    finally:
+        teardown_fastq_errors()
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_fastq_bktree():
+    """BK-tree UID index doesn't change clustering"""
+    plain = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2)
+    for packed in (False, True):
+        tree = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                           prefix=2, packed=packed, index=pseq.BKTreeStore)
+        assert [str(tree[uid]) for uid in tree] == [str(plain[uid]) for uid in plain], \
+               "BK-tree clustering differs from default"
+        assert tree.stats['total_fixed'] == plain.stats['total_fixed'], \
+            "%r != %r" % (tree.stats['total_fixed'], plain.stats['total_fixed'])
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_fastq_pigeonhole():
+    """Pigeonhole UID index doesn't change clustering"""
+    plain = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2)
+    for packed in (False, True):
+        store = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                            prefix=2, packed=packed, index=pseq.PigeonholeStore)
+        assert [str(store[uid]) for uid in store] == [str(plain[uid]) for uid in plain], \
+               "Pigeonhole clustering differs from default"
+        assert store.stats['total_fixed'] == plain.stats['total_fixed'], \
+            "%r != %r" % (store.stats['total_fixed'], plain.stats['total_fixed'])
+        assert store.fail_count == plain.fail_count, \
+            "%r != %r" % (store.fail_count, plain.fail_count)
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_fastq_cache_size():
+    """Bounded UID cache doesn't change set of corrected UIDs"""
+    plain = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2,
+                                        cache_size=None)
+    small = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2,
+                                        cache_size=5)
+    assert sorted(small) == sorted(plain), "Clusters differ with small cache"
+    assert small.stats['total_fixed'] == plain.stats['total_fixed'], \
+        "%r != %r" % (small.stats['total_fixed'], plain.stats['total_fixed'])
+
+@params(cons.Consensus, cons.ArrayConsensus, cons.ClusterTable)
+def test_collapse_duplicates(consensus):
+    """Collecting duplicate reads doesn't change clustering"""
+    if consensus is cons.ArrayConsensus and cons.np is None:
+        raise unittest.SkipTest("NumPy not available")
+    rand = random.Random(7)
+    reads = []
+    for _ in range(20):
+        uid = ''.join(rand.choice('ACGT') for _ in range(8))
+        inserts = [''.join(rand.choice('ACGT') for _ in range(rand.choice([20, 21])))
+                   for _ in range(3)]
+        for _ in range(rand.randint(1, 30)):
+            read_uid = uid if rand.random() < 0.9 else uid[:-1] + rand.choice('ACGT')
+            insert = inserts[0] if rand.random() < 0.8 else rand.choice(inserts)
+            reads.append((read_uid, ''.join(rand.choice('5?I') for _ in read_uid),
+                          insert, ''.join(rand.choice('5?I') for _ in insert)))
+    rand.shuffle(reads)
+    results = []
+    for collapse in (False, True):
+        clusters = clust.Clustering({}, pseq.GroupedSequenceStore(8, tag_size=2, max_diff=2),
+                                    consensus=consensus)
+        id_map = {}
+        for start in range(0, len(reads), 50):
+            clusters.cluster_reads(reads[start:start + 50], id_map, 2, collapse=collapse)
+        results.append(clusters)
+    (single, collapsed) = results
+    assert [str(collapsed[uid]) for uid in collapsed] == [str(single[uid]) for uid in single], \
+           "Collapsed clustering differs from default"
+    for stat in ['total_skipped', 'total_merged', 'total_fixed', 'single_count', 'reads',
+                 'clusters']:
+        assert collapsed.stats[stat] == single.stats[stat], \
+               "%s: %r != %r" % (stat, collapsed.stats[stat], single.stats[stat])
+
 @with_teardown(lambda: os.remove(TMP + "write.fastq"))
 def test_write():
     """Write fastq output"""
@@ -218,6 +430,172 @@ def test_write():
             assert out_line == expect_line, "Error in line %r of fastq record:\n%r\n  !=\n%r" % \
                     (i, out_line, expect_line)
 
+def _check_stream(file_name, index):
+    """Compare clusters of streamed sorted input to clusters of the entire input."""
+    expect = clust.Clustering.from_fastq(TMP + file_name, 6, 'ACGT', threshold=2, prefix=4,
+                                         index=index)
+    windows = list(clust.Clustering.stream_fastq(TMP + file_name, 6, 'ACGT', threshold=2,
+                                                 prefix=4, index=index))
+    assert len(windows) > 1, "Expected more than one group of clusters"
+    obs = {uid:str(cluster) for seq in windows for (uid, cluster) in seq.items()}
+    assert len(obs) == sum(len(seq) for seq in windows), "Clusters returned repeatedly"
+    expect = {uid:str(cluster) for (uid, cluster) in expect.items()}
+    assert obs == expect, "Streamed clusters differ from clusters of entire input"
+    assert windows[0].stats['reads'] == windows[-1].stats['reads'], "Statistics not shared"
+
+@params(pseq.SequenceStore, pseq.PigeonholeStore)
+def test_stream_sorted(index):
+    """Cluster sorted input while it is read"""
+    setup_fastq_sorted()
+    try:
+        _check_stream('sorted.fastq', index)
+    finally:
+        teardown_fastq_sorted()
+
+@params(pseq.SequenceStore, pseq.PigeonholeStore)
+def test_stream_prefix_errors(index):
+    """Add reads with errors in the UID prefix to clusters of sorted input"""
+    setup_fastq_sorted_errors()
+    try:
+        _check_stream('sorted_errors.fastq', index)
+    finally:
+        teardown_fastq_sorted_errors()
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_parallel_readers():
+    """Parse input in several processes"""
+    expect = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2)
+    block_size = fq.BLOCK_SIZE
+    fq.BLOCK_SIZE = 5000
+    try:
+        obs = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                          prefix=2, readers=2)
+    finally:
+        fq.BLOCK_SIZE = block_size
+    assert list(obs) == list(expect), "Clusters differ with parallel parsing"
+    for uid in expect:
+        assert str(obs[uid]) == str(expect[uid]), "%r != %r" % (str(obs[uid]), str(expect[uid]))
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_stream_unsorted():
+    """Reject input that isn't grouped by UID prefix"""
+    with helper.assertRaises(ValueError):
+        list(clust.Clustering.stream_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                           prefix=2))
+
+@with_setup(setup_fastq_sorted)
+@with_teardown(lambda: (teardown_fastq_sorted(), os.remove(TMP + 'sorted.out.fastq.gz')))
+def test_write_stream():
+    """Write consensus sequences while they are computed"""
+    windows = clust.Clustering.stream_fastq(TMP + 'sorted.fastq', 6, 'ACGT', threshold=2,
+                                            prefix=4)
+    clust.write_consensus(TMP + 'sorted.out.fastq.gz',
+                          (item for seq in windows for item in seq.items()), level=1,
+                          threads=2, batch_size=10)
+    expect = clust.Clustering.from_fastq(TMP + 'sorted.fastq', 6, 'ACGT', threshold=2, prefix=4)
+    with gzip.open(TMP + 'sorted.out.fastq.gz', 'rt') as output:
+        obs = sorted(output.read().split('\n@'))
+    expect = sorted(''.join(str(expect[uid]) + "\n" for uid in expect).split('\n@'))
+    assert obs == expect, "Streamed output differs from consensus sequences"
+
+class _Interrupted(clust.Clustering):
+    """Clustering that fails after a fixed number of batches."""
+    __slots__ = ()
+    batches = 0
+
+    def cluster_reads(self, *args, **kwargs):
+        if _Interrupted.batches == 0:
+            raise RuntimeError("interrupted")
+        _Interrupted.batches -= 1
+        super(_Interrupted, self).cluster_reads(*args, **kwargs)
+
+def _remove_checkpoint():
+    teardown_fastq_errors()
+    if os.path.exists(TMP + 'errors.ckpt'):
+        os.remove(TMP + 'errors.ckpt')
+
+@params((pseq.SequenceStore, 1, cons.Consensus), (pseq.PigeonholeStore, 1, cons.Consensus),
+        (pseq.SequenceStore, 2, cons.Consensus), (pseq.SequenceStore, 1, cons.ClusterTable))
+def test_resume(index, workers, consensus):
+    """Resume clustering from a checkpoint"""
+    setup_fastq_errors()
+    block_size = fq.BLOCK_SIZE
+    fq.BLOCK_SIZE = 2000
+    try:
+        expect = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                             prefix=2, index=index, workers=workers,
+                                             consensus=consensus)
+        _Interrupted.batches = 5
+        with helper.assertRaises(RuntimeError):
+            _Interrupted.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2,
+                                    index=index, workers=workers, consensus=consensus,
+                                    checkpoint=TMP + 'errors.ckpt', checkpoint_interval=0)
+        state = clust.load_checkpoint(TMP + 'errors.ckpt', {})
+        assert 0 < state['reads'] < sum(expect.stats['reads']), \
+            "Unexpected number of reads in checkpoint: %d" % state['reads']
+        obs = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                          prefix=2, index=index, workers=workers,
+                                          consensus=consensus, checkpoint=TMP + 'errors.ckpt',
+                                          resume=True)
+    finally:
+        fq.BLOCK_SIZE = block_size
+        _remove_checkpoint()
+    assert list(obs) == list(expect), "Clusters differ after resuming"
+    for uid in expect:
+        assert str(obs[uid]) == str(expect[uid]), "%r != %r" % (str(obs[uid]), str(expect[uid]))
+    for key in ['reads', 'clusters', 'single_count', 'total_fixed', 'total_merged']:
+        assert obs.stats[key] == expect.stats[key], \
+            "%s: %r != %r" % (key, obs.stats[key], expect.stats[key])
+
+@with_teardown(_remove_checkpoint)
+def test_resume_settings():
+    """Refuse to resume with different settings"""
+    setup_fastq_errors()
+    clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2, prefix=2,
+                                checkpoint=TMP + 'errors.ckpt', checkpoint_interval=0)
+    with helper.assertRaises(ValueError):
+        clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=3, prefix=2,
+                                    checkpoint=TMP + 'errors.ckpt', resume=True)
+
+@params(1, 3)
+def test_write_gzip(threads):
+    """Write compressed fastq output in batches"""
+    setup_fastq_errors()
+    try:
+        clusters = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                               prefix=2)
+    finally:
+        teardown_fastq_errors()
+    try:
+        clusters.write(TMP + "write.fastq.gz", level=1, threads=threads, batch_size=7)
+        with gzip.open(TMP + "write.fastq.gz", 'rt') as output:
+            obs = output.read()
+    finally:
+        os.remove(TMP + "write.fastq.gz")
+    expect = ''.join(str(clusters[uid]) + "\n" for uid in clusters)
+    assert obs == expect, "Compressed output differs from consensus sequences"
+
+def test_write_indexed():
+    """Write indexed fastq output"""
+    setup_fastq_errors()
+    try:
+        clusters = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                               prefix=2)
+    finally:
+        teardown_fastq_errors()
+    try:
+        clusters.write(TMP + "write.fastq.bgz", level=1, indexed=True)
+        with pidx.IndexedFastq(TMP + "write.fastq.bgz") as output:
+            obs = {uid:output[uid] for uid in clusters}
+    finally:
+        for name in ["write.fastq.bgz", "write.fastq.bgz" + pidx.INDEX_SUFFIX]:
+            if os.path.isfile(TMP + name):
+                os.remove(TMP + name)
+    for uid in clusters:
+        assert obs[uid] == str(clusters[uid]), "%r != %r" % (obs[uid], clusters[uid])
+
 def test_keys():
     """Retrieve cluster IDs"""
     uid1 = "ACCT"
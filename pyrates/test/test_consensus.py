@@ -1,7 +1,11 @@
 """
 Test consensus module.
 """
+import pickle
+import random
+import unittest
 from nose2.tools import params
+from nose2.tools.such import helper
 
 import pyrates.consensus as cons
 import pyrates.sequence as sequence
@@ -121,6 +125,26 @@ def test_consensus_diff():
     assert consensus.diffs == diff_expect, \
            "Incorrect sequence diff (%r != %r)" % (consensus.diffs, diff_expect)
 
+@params(cons.Consensus, cons.ArrayConsensus)
+def test_consensus_raw(consensus_type):
+    """Update consensus from (sequence, quality) pairs"""
+    if consensus_type is cons.ArrayConsensus and cons.np is None:
+        return
+    suffix = 'A'*45
+    reads = [("ACTTTTTGTCTTAGC"+suffix, "IIIIIIIIIDIDIII"*4),
+             ("ACTGTTTGTCTAAGC"+suffix, "IIIDIIIIIIIIIII"*4),
+             ("ACTTTTTGTGTTAGC"+suffix, "IIIIIIIIIqIDIII"*4),
+             ("ACTTTTTGTGTTAGC", "IIIIIIIIIqIDIII")]
+    expect = consensus_type(sequence.SequenceWithQuality("AAAA", "IIII"),
+                            sequence.SequenceWithQuality(*reads[0]))
+    obs = consensus_type(sequence.SequenceWithQuality("AAAA", "IIII"),
+                         sequence.SequenceWithQuality(*reads[0]))
+    for read in reads[1:]:
+        expect.update(sequence.SequenceWithQuality("AAAA", "I#II"),
+                      sequence.SequenceWithQuality(*read))
+        obs.update(("AAAA", "I#II"), read)
+    assert str(obs) == str(expect), "%r != %r" % (str(obs), str(expect))
+
 def test_consensus_str():
     """String representation of consensus sequences"""
     suffix = 'A'*45
@@ -178,3 +202,152 @@ def test_merge_size():
     merged = cons1.merge(cons2, 1)
     assert merged, "Merging failed unexpectedly"
     assert cons1.size == 4, "Incorrect size for merged cluster (%d != %d)" % (cons1.size, 4)
+
+def _random_read(rand, template, rate, name='test'):
+    seq = ''.join(rand.choice('ACGT') if rand.random() < rate else base for base in template)
+    qual = ''.join(rand.choice('#+5?DI') for _ in template)
+    return sequence.SequenceWithQuality(seq, qual, name=name)
+
+def test_array_consensus_diff():
+    """Update sequence diff with array consensus"""
+    if cons.np is None:
+        raise unittest.SkipTest("NumPy not available")
+    suffix = 'A'*45
+    id1 = sequence.SequenceWithQuality("AAAA", "IIII")
+    seq1 = sequence.SequenceWithQuality("ACTGTTTGTCTAAGC"+suffix, "IIIDIIIIIIIIIII"*4)
+    seq2 = sequence.SequenceWithQuality("ACTTTTTGTCTTAGC"+suffix, "IIIIIIIIIDIDIII"*4)
+    seq3 = sequence.SequenceWithQuality("ACTTTTTGTGTTAGC"+suffix, "IIIIIIIIIqIDIII"*4)
+    consensus = cons.ArrayConsensus(id1, seq2)
+    assert consensus.update(id1, seq1), "Sequence %r was rejected" % seq1
+    assert consensus.update(id1, seq3), "Sequence %r was rejected" % seq3
+
+    seq_expect = "ACTTTTTGTGTAAGC"+suffix
+    qual_expect = "IIIIIIIIIqIIIII"*4
+    diff_expect = {3:{'T':2, 'G':1},
+                   11:{'A':1, 'T':2},
+                   9:{'C':2, 'G':1}}
+    assert consensus.sequence.sequence == seq_expect, \
+           "Failed to update consensus (%s != %s)" % (consensus.sequence.sequence, seq_expect)
+    assert consensus.sequence.quality == qual_expect, \
+           "Failed to update qualities (%s != %s)" % (consensus.sequence.quality, qual_expect)
+    assert consensus.diffs == diff_expect, \
+           "Incorrect sequence diff (%r != %r)" % (consensus.diffs, diff_expect)
+
+@params(1, 2, 3)
+def test_array_consensus_random(seed):
+    """Array consensus agrees with Consensus"""
+    if cons.np is None:
+        raise unittest.SkipTest("NumPy not available")
+    rand = random.Random(seed)
+    template = ''.join(rand.choice('ACGT') for _ in range(60))
+    uid = sequence.SequenceWithQuality("ACGT", "IIII")
+    first = [_random_read(rand, template, 0.05) for _ in range(3)]
+    reads = [_random_read(rand, template, 0.05) for _ in range(40)]
+    reads.append(_random_read(rand, template + 'A', 0.05))
+    reads.append(_random_read(rand, template[1:], 0.05))
+    expect = [cons.Consensus(uid, read) for read in first]
+    obs = [cons.ArrayConsensus(uid, read) for read in first]
+    for read in reads:
+        idx = rand.randrange(len(first))
+        expect[idx].update(uid, read)
+        obs[idx].update(uid, read)
+    expect[0].merge(expect[1], 1)
+    obs[0].merge(obs[1], 1)
+    obs[2].merge(obs[0], 1)
+    expect[2].merge(expect[0], 1)
+    for (exp, cur) in zip(expect, obs):
+        assert str(cur) == str(exp), "\n%s\n!=\n%s" % (cur, exp)
+
+@params(1, 2, 3)
+def test_cluster_table_random(seed):
+    """Cluster table agrees with Consensus"""
+    rand = random.Random(seed)
+    template = ''.join(rand.choice('ACGT') for _ in range(60))
+    uids = [sequence.SequenceWithQuality(uid, "IIII") for uid in ("ACGT", "ACGA", "TCGT")]
+    first = [_random_read(rand, template, 0.05) for _ in range(3)]
+    reads = [_random_read(rand, template, 0.05) for _ in range(40)]
+    reads.append(_random_read(rand, template + 'A', 0.05))
+    reads.append(_random_read(rand, template[1:], 0.05))
+    expect = [cons.Consensus(uid, read) for (uid, read) in zip(uids, first)]
+    table = cons.ClusterTable()
+    obs = [table.add(uid, read) for (uid, read) in zip(uids, first)]
+    for read in reads:
+        idx = rand.randrange(len(first))
+        uid = sequence.SequenceWithQuality(uids[idx].sequence,
+                                           ''.join(rand.choice('5?I') for _ in range(4)))
+        expect[idx].update(uid, read)
+        obs[idx].update((uid.sequence, uid.quality), (read.sequence, read.quality))
+    expect[0].merge(expect[1], 1)
+    obs[0].merge(obs[1], 1)
+    obs[2].merge(obs[0], 1)
+    expect[2].merge(expect[0], 1)
+    table = pickle.loads(pickle.dumps(table))
+    assert len(table) == 3, "%r != 3" % len(table)
+    for (exp, uid) in zip(expect, uids):
+        assert str(table[uid.sequence]) == str(exp), "\n%s\n!=\n%s" % (table[uid.sequence], exp)
+    assert sum(table.size) == sum(exp.size for exp in expect), \
+        "%r != %r" % (sum(table.size), sum(exp.size for exp in expect))
+
+def test_cluster_table_copy():
+    """Copy consensus sequences into cluster table"""
+    uid = sequence.SequenceWithQuality("AAAA", "IIII")
+    consensus = cons.Consensus(uid, sequence.SequenceWithQuality("ACTGTTTGTCTAAGC",
+                                                                 "IIIDIIIIIIIIIII", name='test'))
+    consensus.update(uid, sequence.SequenceWithQuality("ACTTTTTGTCTAAGC", "IIIIIIIIIIIIIII"))
+    table = cons.ClusterTable({'AAAA':consensus})
+    assert 'AAAA' in table, "Missing UID in %r" % table
+    assert str(table['AAAA']) == str(consensus), "%r != %r" % (str(table['AAAA']),
+                                                               str(consensus))
+    with helper.assertRaises(ValueError):
+        table.add(uid, consensus.sequence)
+
+def test_cluster_table_compact():
+    """Reclaim space of replaced sequences in cluster table"""
+    table = cons.ClusterTable()
+    for uid in ("ACGT", "ACGA", "TCGT"):
+        table.add(sequence.SequenceWithQuality(uid, "IIII"),
+                  sequence.SequenceWithQuality("ACGT", "IIII"))
+    for length in range(5, 100):
+        table["ACGA"]._set_sequence("A"*length, "I"*length)
+    del table["TCGT"]
+    table["ACGT"]._set_sequence("C"*120, "I"*120)
+    assert len(table._bases) < 2*(99 + 120), "%r bytes used" % len(table._bases)
+    assert table._sequence(table._rows["ACGA"]) == ("A"*99, "I"*99), "Sequence corrupted"
+    assert table._sequence(table._rows["ACGT"]) == ("C"*120, "I"*120), "Sequence corrupted"
+
+def test_diff_counts():
+    """Record nucleotide counts at variable positions"""
+    diffs = cons.DiffCounts()
+    assert not diffs, "%r should be empty" % diffs
+    diffs.add(3, 'G', 2)
+    diffs[3]['T'] += 1
+    diffs.add(12, 'X', 1)
+    expect = {3:{'G':2, 'T':1}, 12:{'X':1}}
+    assert diffs == expect, "%r != %r" % (diffs, expect)
+    assert list(diffs) == [3, 12], "%r != [3, 12]" % list(diffs)
+    assert 5 not in diffs, "Unexpected position 5 in %r" % diffs
+    assert diffs[5]['A'] == 0, "%r != 0" % diffs[5]['A']
+    assert str(diffs) == '4G2T1 13X1', "%r != '4G2T1 13X1'" % str(diffs)
+
+def test_diff_counts_merge():
+    """Add counts from other differences"""
+    diffs = cons.DiffCounts()
+    diffs.add(3, 'G', 2)
+    other = cons.DiffCounts()
+    other.add(3, 'T', 1)
+    other.add(7, 'N', 4)
+    diffs.merge(other)
+    diffs.merge({7:{'A':1}})
+    expect = {3:{'G':2, 'T':1}, 7:{'A':1, 'N':4}}
+    assert diffs == expect, "%r != %r" % (diffs, expect)
+    assert len(diffs._counts) == 10, "%r != 10" % len(diffs._counts)
+
+def test_diff_counts_pickle():
+    """Pickle consensus sequences"""
+    id1 = sequence.SequenceWithQuality("AAAA", "IIII")
+    seq1 = sequence.SequenceWithQuality("ACTGTTTGTCTAAGC", "IIIDIIIIIIIIIII")
+    seq2 = sequence.SequenceWithQuality("ACTTTTTGTCTTAGC", "IIIIIIIIIDIDIII")
+    consensus = cons.Consensus(id1, seq2)
+    consensus.update(id1, seq1)
+    copy = pickle.loads(pickle.dumps(consensus))
+    assert str(copy) == str(consensus), "\n%s\n!=\n%s" % (copy, consensus)
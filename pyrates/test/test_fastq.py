@@ -0,0 +1,207 @@
+"""Tests for FASTQ parsing"""
+
+import functools
+import gzip
+import io
+import os
+import threading
+from nose2.tools import params
+from nose2.tools.decorators import with_setup, with_teardown
+from nose2.tools.such import helper
+
+import pyrates.fastq as fq
+from pyrates.test import TMP
+from pyrates.test.fixtures import setup_fastq_simple, teardown_fastq_simple
+
+RECORDS = [('read_%d' % i, 'ACGT'*(i + 1), 'IIID'*(i + 1)) for i in range(10)]
+
+def fastq_text(records):
+    """Format records as FASTQ."""
+    return ''.join("@%s\n%s\n+\n%s\n" % rec for rec in records)
+
+@params(1, 3, 7, 64, fq.BLOCK_SIZE)
+def test_read_blocks(block_size):
+    """Parse records independent of block boundaries"""
+    fastq = io.StringIO(fastq_text(RECORDS))
+    obs = [rec for block in fq.read_blocks(fastq, block_size) for rec in block]
+    assert obs == RECORDS, "%r != %r" % (obs, RECORDS)
+
+@params(1, 3, 64, fq.BLOCK_SIZE)
+def test_read_offsets(block_size):
+    """Report position after each block of records"""
+    text = fastq_text(RECORDS)
+    for (records, offset) in fq.read_blocks(io.StringIO(text), block_size, offsets=True):
+        if records:
+            obs = list(fq.read_fastq(io.StringIO(text[offset:])))
+            expect = RECORDS[RECORDS.index(records[-1]) + 1:]
+            assert obs == expect, "%r != %r" % (obs, expect)
+    assert offset == len(text), "%r != %r" % (offset, len(text))
+
+def test_skip():
+    """Discard start of input"""
+    text = fastq_text(RECORDS)
+    fastq = io.StringIO(text)
+    fq.skip(fastq, 10, block_size=3)
+    assert fastq.read() == text[10:], "Unexpected input after skip"
+    with helper.assertRaises(ValueError):
+        fq.skip(io.StringIO(text), len(text) + 1)
+
+def test_read_no_newline():
+    """Parse final record without trailing newline"""
+    fastq = io.StringIO(fastq_text(RECORDS).rstrip('\n'))
+    obs = list(fq.read_fastq(fastq, 5))
+    assert obs == RECORDS, "%r != %r" % (obs, RECORDS)
+
+def test_read_truncated():
+    """Reject incomplete records"""
+    fastq = io.StringIO(fastq_text(RECORDS) + "@extra\nACGT\n")
+    with helper.assertRaises(ValueError):
+        list(fq.read_fastq(fastq))
+
+def test_split_reads():
+    """Separate UIDs from read sequence"""
+    records = [('test', 'AAAACCCCGGGGTTTT', 'ABCDEFGHIJKLMNOP')]
+    obs = fq.split_reads(records, 2, 2)
+    expect = [('AATT', 'ABOP', 'CCCCGGGG', 'EFGHIJKL')]
+    assert obs == expect, "%r != %r" % (obs, expect)
+
+@with_setup(setup_fastq_simple)
+@with_teardown(teardown_fastq_simple)
+def test_open_plain():
+    """Read uncompressed FASTQ file"""
+    with fq.open_fastq(TMP + 'simple.fastq') as fastq:
+        records = list(fq.read_fastq(fastq))
+    assert len(records) == 8, "%r != 8" % len(records)
+    assert records[0][0] == 'test_0', "%r != 'test_0'" % records[0][0]
+
+@params(True, False)
+def test_open_gzip(external):
+    """Read gzip compressed FASTQ file"""
+    try:
+        with gzip.open(TMP + 'records.fastq.gz', 'wb') as fastq:
+            fastq.write(fastq_text(RECORDS).encode('ascii'))
+        with fq.open_fastq(TMP + 'records.fastq.gz', external=external) as fastq:
+            obs = list(fq.read_fastq(fastq))
+    finally:
+        os.remove(TMP + 'records.fastq.gz')
+    assert obs == RECORDS, "%r != %r" % (obs, RECORDS)
+
+@with_teardown(lambda: os.remove(TMP + 'records.fastq.gz'))
+def test_open_gzip_partial():
+    """Stop reading compressed FASTQ file early"""
+    with gzip.open(TMP + 'records.fastq.gz', 'wb') as fastq:
+        fastq.write(fastq_text(RECORDS*1000).encode('ascii'))
+    with fq.open_fastq(TMP + 'records.fastq.gz') as fastq:
+        obs = fastq.read(10)
+    assert obs == '@read_0\nAC', "%r != '@read_0\\nAC'" % obs
+
+def _write_records(text, file_name='records.fastq'):
+    with open(TMP + file_name, 'w') as fastq:
+        fastq.write(text)
+
+@params(1, 3, 64, fq.BLOCK_SIZE)
+def test_read_mapped(block_size):
+    """Parse memory mapped FASTQ file"""
+    text = fastq_text(RECORDS)
+    _write_records(text)
+    try:
+        blocks = list(fq.read_mapped(TMP + 'records.fastq', block_size, offsets=True))
+        (_, offset) = blocks[len(blocks)//2]
+        rest = [rec for block in fq.read_mapped(TMP + 'records.fastq', block_size,
+                                                start=offset)
+                for rec in block]
+    finally:
+        os.remove(TMP + 'records.fastq')
+    obs = [rec for (block, _) in blocks for rec in block]
+    assert obs == RECORDS, "%r != %r" % (obs, RECORDS)
+    assert blocks[-1][1] == len(text), "%r != %r" % (blocks[-1][1], len(text))
+    expect = list(fq.read_fastq(io.StringIO(text[offset:])))
+    assert rest == expect, "%r != %r" % (rest, expect)
+
+@params(1, 3, 64, fq.BLOCK_SIZE)
+def test_read_mapped_crlf(block_size):
+    """Remove carriage returns from memory mapped FASTQ file"""
+    text = fastq_text(RECORDS).replace('\n', '\r\n')
+    with open(TMP + 'records.fastq', 'w', newline='') as fastq:
+        fastq.write(text)
+    try:
+        blocks = list(fq.read_mapped(TMP + 'records.fastq', block_size, offsets=True))
+    finally:
+        os.remove(TMP + 'records.fastq')
+    obs = [rec for (block, _) in blocks for rec in block]
+    assert obs == RECORDS, "%r != %r" % (obs, RECORDS)
+    assert blocks[-1][1] == len(text), "%r != %r" % (blocks[-1][1], len(text))
+
+@with_teardown(lambda: os.remove(TMP + 'records.fastq'))
+def test_read_mapped_ends():
+    """Handle missing final newline, truncated and empty mapped files"""
+    _write_records(fastq_text(RECORDS).rstrip('\n'))
+    obs = [rec for block in fq.read_file(TMP + 'records.fastq', 5) for rec in block]
+    assert obs == RECORDS, "%r != %r" % (obs, RECORDS)
+    _write_records(fastq_text(RECORDS) + "@extra\nACGT\n")
+    with helper.assertRaises(ValueError):
+        list(fq.read_file(TMP + 'records.fastq'))
+    _write_records('')
+    obs = list(fq.read_file(TMP + 'records.fastq'))
+    assert obs == [], "%r != []" % obs
+
+def test_record_start():
+    """Find record boundaries in the presence of quality lines starting with @"""
+    records = [('read_%d' % i, 'ACGT'*(i + 1), '@III'*(i + 1)) for i in range(5)]
+    data = fastq_text(records).encode('ascii')
+    starts = [i for i in range(len(data)) if data[i:i+5] == b'@read']
+    obs = [fq.record_start(data, pos) for pos in range(len(data))]
+    expect = [min([start for start in starts if start >= pos] + [len(data)])
+              for pos in range(len(data))]
+    assert obs == expect, "%r != %r" % (obs, expect)
+
+@params((1, '\n'), (40, '\n'), (200, '\n'), (40, '\r\n'))
+def test_read_parallel(block_size, newline):
+    """Parse FASTQ file in several processes"""
+    text = fastq_text(RECORDS*20).replace('\n', newline)
+    with open(TMP + 'records.fastq', 'w', newline='') as fastq:
+        fastq.write(text)
+    try:
+        blocks = list(fq.read_parallel(TMP + 'records.fastq', 2, block_size, offsets=True,
+                                       process=functools.partial(fq.split_reads, id_length=2,
+                                                                 adapter_length=1)))
+    finally:
+        os.remove(TMP + 'records.fastq')
+    obs = [read for (block, _) in blocks for read in block]
+    expect = fq.split_reads(RECORDS*20, 2, 1)
+    assert obs == expect, "%r != %r" % (obs, expect)
+    assert blocks[-1][1] == len(text), "%r != %r" % (blocks[-1][1], len(text))
+
+@with_teardown(lambda: os.remove(TMP + 'records.fastq.gz'))
+def test_read_file_gzip():
+    """Resume parsing of compressed file from reported offset"""
+    text = fastq_text(RECORDS)
+    with gzip.open(TMP + 'records.fastq.gz', 'wb') as fastq:
+        fastq.write(text.encode('ascii'))
+    blocks = list(fq.read_file(TMP + 'records.fastq.gz', 50, offsets=True))
+    (_, offset) = blocks[1]
+    obs = [rec for (block, _) in fq.read_file(TMP + 'records.fastq.gz', 50, offsets=True,
+                                              start=offset)
+           for rec in block]
+    expect = [rec for (block, _) in blocks[2:] for rec in block]
+    assert obs == expect, "%r != %r" % (obs, expect)
+
+def test_prefetch():
+    """Fetch items in background thread"""
+    obs = list(fq.prefetch(iter(range(100)), 3))
+    assert obs == list(range(100)), "%r != %r" % (obs, list(range(100)))
+
+def test_prefetch_error():
+    """Pass on errors from background thread"""
+    fastq = io.StringIO(fastq_text(RECORDS) + "@extra\nACGT\n")
+    with helper.assertRaises(ValueError):
+        list(fq.prefetch(fq.read_blocks(fastq, 16)))
+
+def test_prefetch_close():
+    """Stop background thread early"""
+    running = threading.active_count()
+    items = fq.prefetch(iter(range(100)), 2)
+    assert next(items) == 0, "Unexpected first item"
+    items.close()
+    assert threading.active_count() == running, \
+           "%r != %r" % (threading.active_count(), running)
@@ -0,0 +1,47 @@
+"""Tests for indexed consensus output"""
+
+import gzip
+import os
+from nose2.tools import params
+from nose2.tools.such import helper
+
+import pyrates.index as idx
+from pyrates.test import TMP
+
+def _remove_indexed():
+    for name in ['indexed.fastq.gz', 'indexed.fastq.gz.idx']:
+        if os.path.isfile(TMP + name):
+            os.remove(TMP + name)
+
+def _records(count, length):
+    return [('%08d' % i, "@r%d\n%s\n+\n%s\n" % (i, 'ACGT'*length, 'I'*(4*length)))
+            for i in range(count)]
+
+@params((1, 5, 1), (500, 50, 1), (2000, 100, 3))
+def test_indexed_roundtrip(count, length, threads):
+    """Retrieve records by UID from BGZF output"""
+    try:
+        _check_roundtrip(count, length, threads)
+    finally:
+        _remove_indexed()
+
+def _check_roundtrip(count, length, threads):
+    records = _records(count, length)
+    idx.write_indexed(reversed(records), TMP + 'indexed.fastq.gz', level=1, threads=threads)
+    with gzip.open(TMP + 'indexed.fastq.gz', 'rt') as fastq:
+        obs = fastq.read()
+    expect = ''.join(text for (_, text) in reversed(records))
+    assert obs == expect, "Decompressed output differs from input"
+    with idx.IndexedFastq(TMP + 'indexed.fastq.gz') as fastq:
+        assert len(fastq) == count, "%r != %r" % (len(fastq), count)
+        for (uid, text) in records[::max(1, count//20)] + records[-1:]:
+            assert fastq[uid] == text.rstrip('\n'), "%r != %r" % (fastq[uid], text)
+        assert 'missing' not in fastq, "Unexpected record for 'missing'"
+        with helper.assertRaises(KeyError):
+            fastq.fetch('99999999')
+
+def test_compress_block():
+    """Create valid BGZF block"""
+    block = idx.compress_block(b'ACGT'*100)
+    assert gzip.decompress(block) == b'ACGT'*100, "Block doesn't decompress"
+    assert gzip.decompress(idx.EOF_BLOCK) == b'', "EOF marker isn't empty"
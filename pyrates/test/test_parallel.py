@@ -0,0 +1,60 @@
+"""Tests for parallel UID search"""
+
+from nose2.tools.decorators import with_setup, with_teardown
+
+import pyrates.clustering as clust
+import pyrates.parallel as par
+import pyrates.sequence as pseq
+from pyrates.test import TMP
+from pyrates.test.fixtures import setup_fastq_errors, teardown_fastq_errors
+
+def test_partitioned_search():
+    """Find all approximate matches across workers"""
+    store = par.PartitionedSequenceStore(4, workers=3, max_diff=2, tag_size=2)
+    try:
+        for seq in ["AAAA", "AAAT", "AATT", "ATTT", "CCTT"]:
+            store.add(seq)
+        store.prefetch(['TTTT', 'AAAA'])
+        store.flush()
+        assert "AATT" in store, "'AATT' not found in store"
+        assert len(store) == 5, "%r != 5" % len(store)
+        store.prefetch(['TTTT'])
+        store.add("TTTA")
+        match = store.search('TTTT', max_hits=None)
+        expect = [('ATTT', 1), ('TTTA', 1), ('AATT', 2), ('CCTT', 2)]
+        assert sorted(match, key=lambda x: (x[1], x[0])) == expect, "%r != %r" % (match, expect)
+        store.remove("ATTT")
+        match = store.search('TTTT', max_hits=None, raw=True)
+        assert sorted(match) == ['AATT', 'CCTT', 'TTTA'], "%r" % match
+        assert "ATTT" not in store, "'ATTT' still in store after removal"
+        assert len(store) == 5, "%r != 5" % len(store)
+        assert store.find('AAAA') == ('AAAA', 0), "%r" % (store.find('AAAA'),)
+    finally:
+        store.close()
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_parallel_fastq():
+    """Parallel clustering produces same output as single process"""
+    serial = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT',
+                                         threshold=2, prefix=2)
+    for workers in (2, 3):
+        parallel = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT',
+                                               threshold=2, prefix=2, workers=workers)
+        assert list(serial) == list(parallel), "Clusters differ with %d workers" % workers
+        assert [str(serial[uid]) for uid in serial] == \
+               [str(parallel[uid]) for uid in parallel], \
+               "Consensus sequences differ with %d workers" % workers
+        assert serial.stats['total_fixed'] == parallel.stats['total_fixed'], \
+               "%r != %r" % (serial.stats['total_fixed'], parallel.stats['total_fixed'])
+
+@with_setup(setup_fastq_errors)
+@with_teardown(teardown_fastq_errors)
+def test_parallel_pigeonhole():
+    """Parallel clustering with pigeonhole index produces same output as single process"""
+    serial = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT',
+                                         threshold=2, prefix=2)
+    parallel = clust.Clustering.from_fastq(TMP + 'errors.fastq', 4, 'ACGT', threshold=2,
+                                           prefix=2, workers=2, index=pseq.PigeonholeStore)
+    assert [str(serial[uid]) for uid in serial] == \
+           [str(parallel[uid]) for uid in parallel], "Consensus sequences differ"
@@ -0,0 +1,95 @@
+"""Tests for clustering of partitioned input"""
+
+import os
+from nose2.tools import params
+from nose2.tools.decorators import with_teardown
+
+import pyrates.clustering as clust
+import pyrates.consensus as cons
+import pyrates.fastq as fq
+import pyrates.partition as part
+from pyrates.test import TMP
+from pyrates.test.fixtures import (create_fastq, setup_fastq_sorted, teardown_fastq_sorted,
+                                   setup_fastq_sorted_errors, teardown_fastq_sorted_errors)
+
+def _remove_partitions():
+    teardown_fastq_sorted()
+    for file_name in os.listdir(TMP):
+        if file_name.startswith('sorted.') and file_name != 'sorted.fastq':
+            os.remove(TMP + file_name)
+
+@with_teardown(_remove_partitions)
+def test_partition_fastq():
+    """Split reads into partitions by UID prefix"""
+    setup_fastq_sorted()
+    file_names = part.partition_fastq(TMP + 'sorted.fastq', TMP, 6, prefix=2, partitions=4)
+    with open(TMP + 'sorted.fastq') as fastq:
+        expect = list(fq.read_fastq(fastq))
+    obs = []
+    for (i, file_name) in enumerate(file_names):
+        assert os.path.basename(file_name).startswith('sorted.'), \
+            "Unexpected file name %r" % file_name
+        with open(file_name) as fastq:
+            records = list(fq.read_fastq(fastq))
+        keys = set(part.partition_key(seq[:6] + seq[-6:], 2, 4) for (_, seq, _) in records)
+        assert len(keys) == 1, "Partition %d has reads with keys %r" % (i, keys)
+        obs.extend(records)
+    assert sorted(obs) == sorted(expect), "Reads lost or duplicated during partitioning"
+
+@params(1, 3, 16)
+def test_cluster_partitioned(partitions):
+    """Cluster one partition at a time"""
+    setup_fastq_sorted()
+    try:
+        expect = clust.Clustering.from_fastq(TMP + 'sorted.fastq', 6, 'ACGT', threshold=2,
+                                             prefix=2)
+        windows = part.cluster_partitioned(TMP + 'sorted.fastq', 6, 'ACGT', prefix=2,
+                                           partitions=partitions, tmp_dir=TMP, threshold=2)
+        obs = {uid:str(cluster) for seq in windows for (uid, cluster) in seq.items()}
+    finally:
+        teardown_fastq_sorted()
+    expect = {uid:str(cluster) for (uid, cluster) in expect.items()}
+    assert obs == expect, "Partitioned clusters differ from clusters of entire input"
+    assert not [name for name in os.listdir(TMP) if name.startswith('pyrates')], \
+        "Temporary files not removed"
+
+@params(2, 4, 16)
+def test_partitioned_prefix_errors(partitions):
+    """Combine clusters split between partitions by errors in the UID prefix"""
+    setup_fastq_sorted_errors()
+    try:
+        expect = clust.Clustering.from_fastq(TMP + 'sorted_errors.fastq', 6, 'ACGT',
+                                             threshold=2, prefix=2)
+        windows = part.cluster_partitioned(TMP + 'sorted_errors.fastq', 6, 'ACGT', prefix=2,
+                                           partitions=partitions, tmp_dir=TMP, threshold=2)
+        obs = {uid:str(cluster) for seq in windows for (uid, cluster) in seq.items()}
+    finally:
+        teardown_fastq_sorted_errors()
+    expect = {uid:str(cluster) for (uid, cluster) in expect.items()}
+    assert sorted(obs) == sorted(expect), "Partitioned clusters differ from entire input"
+    ## a read that is equally close to clusters in two partitions may still be added to
+    ## the one in its own partition
+    differ = [uid for uid in expect if obs[uid] != expect[uid]]
+    assert len(differ) <= len(expect)//50, "Clusters %r differ" % differ
+    assert not [name for name in os.listdir(TMP) if name.startswith('pyrates')], \
+        "Temporary files not removed"
+
+@params(cons.Consensus, cons.ClusterTable)
+def test_prefix_error(consensus):
+    """Add reads with errors in the UID prefix to clusters in other partitions"""
+    insert = 'ACCTCTCCCTGTGGGTCATGTGACT'
+    uids = ['ACGTACGTACGT']*3 + ['GCGTACGTACGT', 'AGTTTTGGGGCC']
+    reads = [uid[:6] + 'ACGT' + insert + 'ACGT' + uid[6:] for uid in uids]
+    assert part.partition_key(uids[0], 2, 4) != part.partition_key(uids[3], 2, 4), \
+        "Reads with prefix error share a partition"
+    create_fastq(reads, ['I'*len(reads[0])]*len(reads), 'prefix.fastq')
+    try:
+        windows = list(part.cluster_partitioned(TMP + 'prefix.fastq', 6, 'ACGT', prefix=2,
+                                                partitions=4, tmp_dir=TMP, threshold=2,
+                                                consensus=consensus))
+    finally:
+        os.remove(TMP + 'prefix.fastq')
+    obs = {uid:cluster.size for seq in windows for (uid, cluster) in seq.items()}
+    assert obs == {uids[0]:4, uids[4]:1}, "Unexpected clusters %r" % obs
+    assert sum(sum(seq.stats['reads']) for seq in windows) == len(reads), \
+        "Reads counted more than once"
@@ -1,8 +1,10 @@
 """Test sequence module."""
 
+import random
 from nose2.tools import params
 from nose2.tools.such import helper
-from pyrates.sequence import SequenceWithQuality, SequenceStore, GroupedSequenceStore
+from pyrates.sequence import (SequenceWithQuality, SequenceStore, GroupedSequenceStore,
+                              BKTreeStore, PigeonholeStore, encode, decode, packed_diff)
 
 def test_swq_new():
     """Create sequence objects"""
@@ -261,6 +263,23 @@ def test_grouped_search(max_diff, expect_hits):
     match = store.search('TTTT', max_hits=None)
     assert len(match) == expect_hits, "%r != %r (found %r)" % (len(match), expect_hits, match)
 
+@params(1, 2, 3)
+def test_grouped_search_neighbours(max_diff):
+    """Find matches in groups of neighbouring tags"""
+    rand = random.Random(max_diff)
+    ## avoid exact matches of the query suffix, which end the search of a group early
+    queries = ['ACGTACGT', 'TTTTAAAA', 'GATTACAA']
+    seqs = set(''.join(rand.choice('ACGT') for _ in range(8)) for _ in range(500))
+    seqs = [seq for seq in seqs if seq[3:] not in [query[3:] for query in queries]]
+    store = GroupedSequenceStore(8, max_diff=max_diff, tag_size=3)
+    for seq in seqs:
+        store.add(seq)
+    for query in queries:
+        match = sorted(store.search(query, max_hits=None))
+        expect = sorted((seq, SequenceStore.diff(query, seq)) for seq in seqs
+                        if SequenceStore.diff(query, seq) <= max_diff)
+        assert match == expect, "%r != %r" % (match, expect)
+
 @params(('AAAA', ('AAAA', 0)), ('CATT', ('AATT', 1)), ('GGGG', None))
 def test_grouped_find(search, expect):
     """Find best approximate match"""
@@ -271,7 +290,8 @@ def test_grouped_find(search, expect):
     match = store.find(search)
     assert match == expect, "%r != %r" % (match, expect)
 
-@params(('AANA', ('AAAA', 1)), ('CATT', ('AATT', 1)), ('NGGG', None))
+@params(('AANA', ('AAAA', 1)), ('CATT', ('AATT', 1)), ('NGGG', None), ('NATT', ('AATT', 1)),
+        ('ANNT', ('AATT', 2)))
 def test_grouped_find_wild(search, expect):
     """Find best approximate match"""
     store = GroupedSequenceStore(4, max_diff=2, tag_size=2, wildcard='N')
@@ -280,3 +300,148 @@ def test_grouped_find_wild(search, expect):
     store.add("TTTT")
     match = store.find(search)
     assert match == expect, "%r != %r" % (match, expect)
+
+@params('', 'A', 'ACGT', 'NNNN', 'ANCNGNTN', 'TTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTTT')
+def test_encode(seq):
+    """Convert sequences to packed form and back"""
+    code = encode(seq, ('A', 'C', 'G', 'T'))
+    obs = decode(code, ('A', 'C', 'G', 'T'))
+    assert obs == seq, "%r != %r" % (obs, seq)
+
+def test_encode_invalid():
+    """Reject sequences with unknown characters"""
+    with helper.assertRaises(ValueError):
+        encode('ACXT', ('A', 'C', 'G', 'T'))
+
+@params(('AAAA', 'AAAA'), ('AAAA', 'AAAT'), ('ACGT', 'TGCA'), ('ANNA', 'AAAA'),
+        ('ANGA', 'NCGT'), ('CCCCAAAA', 'CCCCAAAT'))
+def test_packed_diff(seq1, seq2):
+    """Count differences between packed sequences"""
+    alphabet = ('A', 'C', 'G', 'T')
+    obs = packed_diff(encode(seq1, alphabet), encode(seq2, alphabet))
+    expect = SequenceStore.diff(seq1, seq2)
+    assert obs == expect, "%r != %r" % (obs, expect)
+
+def test_packed_store():
+    """Add, find and remove entries in packed SequenceStore"""
+    store = SequenceStore(4, packed=True)
+    for seq in ["AAAA", "AANT", "TTTT"]:
+        store.add(seq)
+    assert len(store) == 3, "%r != 3" % len(store)
+    assert "AANT" in store, "'AANT' not found in store"
+    assert "AAXT" not in store, "'AAXT' should not be in store"
+    assert sorted(store) == ["AAAA", "AANT", "TTTT"], "%r" % sorted(store)
+    match = store.find('CATT', 2)
+    assert match == ('AANT', 2), "%r != ('AANT', 2)" % (match,)
+    match = store.find('AANA', 2, wildcard='N')
+    assert match == ('AAAA', 1), "%r != ('AAAA', 1)" % (match,)
+    store.remove("AANT")
+    assert "AANT" not in store, "'AANT' remains in store after removal"
+    with helper.assertRaises(KeyError):
+        store.remove("AANT")
+    store.discard("AANT")
+    assert len(store) == 2, "%r != 2" % len(store)
+
+@params(('AANA', ('AAAA', 1)), ('CATT', ('AATT', 1)), ('NGGG', None))
+def test_grouped_find_packed(search, expect):
+    """Find best approximate match in packed GroupedSequenceStore"""
+    store = GroupedSequenceStore(4, max_diff=2, tag_size=2, wildcard='N', packed=True)
+    store.add("AAAA")
+    store.add("AATT")
+    store.add("TTTT")
+    match = store.find(search)
+    assert match == expect, "%r != %r" % (match, expect)
+
+@params(False, True)
+def test_bktree_store(packed):
+    """Add, find and remove entries in BKTreeStore"""
+    store = BKTreeStore(4, packed=packed)
+    for seq in ["AAAA", "AAAT", "AATT", "ATTT", "CCTT"]:
+        store.add(seq)
+    assert len(store) == 5, "%r != 5" % len(store)
+    assert "AATT" in store, "'AATT' not found in store"
+    match = store.search('TTTT', 2, max_hits=None)
+    expect = [('ATTT', 1), ('AATT', 2), ('CCTT', 2)]
+    assert sorted(match, key=lambda x: (x[1], x[0])) == expect, "%r != %r" % (match, expect)
+    assert store.find('CCTA', 1) == ('CCTT', 1), "%r" % (store.find('CCTA', 1),)
+    assert store.find('GGGG', 2) is None, "%r" % (store.find('GGGG', 2),)
+    store.remove("ATTT")
+    assert "ATTT" not in store, "'ATTT' remains in store after removal"
+    with helper.assertRaises(KeyError):
+        store.remove("ATTT")
+    store.discard("ATTT")
+    match = store.search('TTTT', 2, raw=True)
+    assert sorted(match) == ['AATT', 'CCTT'], "%r" % match
+    store.add("ATTT")
+    assert sorted(store) == ["AAAA", "AAAT", "AATT", "ATTT", "CCTT"], "%r" % sorted(store)
+
+@params(False, True)
+def test_bktree_rebuild(packed):
+    """Drop removed nodes from BKTreeStore"""
+    rand = random.Random(5)
+    seqs = sorted(set(''.join(rand.choice('ACGT') for _ in range(6)) for _ in range(200)))
+    store = BKTreeStore(6, packed=packed)
+    for seq in seqs:
+        store.add(seq)
+    for seq in seqs[:-20]:
+        store.remove(seq)
+    assert len(store._tree) <= 2*len(store), "%r nodes for %r sequences" % \
+        (len(store._tree), len(store))
+    for seq in seqs[:-20]:
+        obs = sorted(store.search(seq, 2, raw=True))
+        expect = sorted(cand for cand in seqs[-20:] if SequenceStore.diff(seq, cand) <= 2)
+        assert obs == expect, "%r != %r" % (obs, expect)
+
+@params(('AANA', ('AAAA', 1)), ('CATT', ('AATT', 1)), ('NGGG', None))
+def test_grouped_find_bktree(search, expect):
+    """Find best approximate match in GroupedSequenceStore backed by BK-trees"""
+    store = GroupedSequenceStore(4, max_diff=2, tag_size=2, wildcard='N', index=BKTreeStore)
+    store.add("AAAA")
+    store.add("AATT")
+    store.add("TTTT")
+    match = store.find(search)
+    assert match == expect, "%r != %r" % (match, expect)
+
+@params(False, True)
+def test_pigeonhole_store(packed):
+    """Add, find and remove entries in PigeonholeStore"""
+    store = PigeonholeStore(4, max_diff=2, tag_size=2, wildcard='N', packed=packed)
+    for seq in ["AAAA", "AAAT", "AATT", "ATTT", "CCTT", "ANTT"]:
+        store.add(seq)
+    assert len(store) == 6, "%r != 6" % len(store)
+    assert "ANTT" in store, "'ANTT' not found in store"
+    assert list(store.wild_tags) == ["ANTT"], "%r" % list(store.wild_tags)
+    match = store.search('TTTT', max_hits=None)
+    expect = [('ATTT', 1), ('AATT', 2), ('CCTT', 2)]
+    assert sorted(match, key=lambda x: (x[1], x[0])) == expect, "%r != %r" % (match, expect)
+    store.remove("ATTT")
+    assert "ATTT" not in store, "'ATTT' remains in store after removal"
+    with helper.assertRaises(KeyError):
+        store.remove("ATTT")
+    store.discard("ATTT")
+    match = store.search('TTTT', raw=True)
+    assert sorted(match) == ['AATT', 'CCTT'], "%r" % match
+
+@params((GroupedSequenceStore, 0), (GroupedSequenceStore, 1), (GroupedSequenceStore, 2),
+        (PigeonholeStore, 0), (PigeonholeStore, 1), (PigeonholeStore, 2))
+def test_search_radius(store_type, radius):
+    """Limit search to fewer differences than the store supports"""
+    rand = random.Random(radius)
+    seqs = set(''.join(rand.choice('ACGT') for _ in range(8)) for _ in range(500))
+    store = store_type(8, max_diff=3, tag_size=2)
+    for seq in seqs:
+        store.add(seq)
+    for query in ['ACGTACGT', 'TTTTAAAA', 'GATTACAA']:
+        match = sorted(store.search(query, max_hits=None, max_diff=radius))
+        expect = sorted((seq, SequenceStore.diff(query, seq)) for seq in seqs
+                        if SequenceStore.diff(query, seq) <= radius)
+        assert match == expect, "%r != %r" % (match, expect)
+
+@params(('AANA', ('AAAA', 1)), ('CATT', ('AATT', 1)), ('NGGG', None), ('GGGG', None),
+        ('NATT', ('AATT', 1)), ('ANNT', ('AATT', 2)))
+def test_pigeonhole_find(search, expect):
+    """Find best approximate match in PigeonholeStore"""
+    store = PigeonholeStore.from_list(["AAAA", "AATT", "TTTT"], max_diff=2, tag_size=2,
+                                      wildcard='N')
+    match = store.find(search)
+    assert match == expect, "%r != %r" % (match, expect)
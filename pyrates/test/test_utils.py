@@ -0,0 +1,24 @@
+"""Tests for utility functions"""
+
+import pyrates.utils as utils
+
+def test_lru_cache():
+    """Discard least recently used entries"""
+    cache = utils.LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1, "%r != 1" % cache.get('a')
+    cache['c'] = 3
+    assert 'b' not in cache, "'b' should have been evicted"
+    assert sorted(cache) == ['a', 'c'], "%r != ['a', 'c']" % sorted(cache)
+    assert cache.get('b') is None, "%r is not None" % cache.get('b')
+    assert (cache.hits, cache.misses) == (1, 1), "%r != (1, 1)" % ((cache.hits, cache.misses),)
+
+def test_lru_cache_unbounded():
+    """Keep all entries without size limit"""
+    cache = utils.LRUCache()
+    for i in range(100):
+        cache[i] = i
+    assert len(cache) == 100, "%r != 100" % len(cache)
+    del cache[0]
+    assert 0 not in cache, "0 remains in cache after removal"
@@ -2,6 +2,7 @@
 
 import logging
 import gzip
+from collections import OrderedDict
 
 def console_handler():
     """Create a handler for logging to the console.
@@ -46,3 +47,63 @@ def smart_open(file_name):
     if file_name.endswith('.gz'):
         access_fun = gzip.open
     return access_fun
+
+class LRUCache(object):
+    """Mapping of bounded size that discards the least recently used entries.
+
+    Lookups through :meth:`get` are counted as hits or misses.
+
+    Args:
+        max_size (:obj:`int`, optional): Maximum number of entries to keep. Set to
+            `None` for a cache of unlimited size.
+
+    Attributes:
+        hits (:obj:`int`): Number of successful lookups.
+        misses (:obj:`int`): Number of lookups for missing keys.
+    """
+    __slots__ = '_data', 'max_size', 'hits', 'misses'
+
+    def __init__(self, max_size=None):
+        self._data = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Look up a key and mark it as recently used.
+
+        Args:
+            key: The key to look up.
+            default (optional): Value to return if the key is missing.
+        """
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
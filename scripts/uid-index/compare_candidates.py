@@ -0,0 +1,62 @@
+"""Compare candidate counts of UID indices on random data."""
+
+import argparse
+import random
+import time
+
+import pyrates.sequence as pseq
+
+ALPHABET = ('A', 'C', 'G', 'T')
+INDEX = {'composition':pseq.SequenceStore, 'bktree':pseq.BKTreeStore,
+         'pigeonhole':pseq.PigeonholeStore}
+
+def mutate(uid, errors, rng):
+    """Introduce substitutions at random positions."""
+    uid = list(uid)
+    for pos in rng.sample(range(len(uid)), errors):
+        uid[pos] = rng.choice([nuc for nuc in ALPHABET if nuc != uid[pos]])
+    return ''.join(uid)
+
+def main():
+    """Entrypoint for command-line interface"""
+    parser = argparse.ArgumentParser(description="Compare candidate counts of UID indices",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--uids', '-n', default=10000, type=int,
+                        help='Number of UIDs to store.')
+    parser.add_argument('--queries', '-q', default=1000, type=int,
+                        help='Number of searches to run.')
+    parser.add_argument('--length', '-l', default=16, type=int, help='UID length.')
+    parser.add_argument('--max-diff', '-t', default=3, type=int,
+                        help='Maximum number of differences allowed for a match.')
+    parser.add_argument('--packed', action='store_true', help='Use packed UIDs.')
+    parser.add_argument('--seed', default=42, type=int, help='Random seed.')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    uids = [''.join(rng.choice(ALPHABET) for _ in range(args.length))
+            for _ in range(args.uids)]
+    queries = [mutate(rng.choice(uids), rng.randint(1, args.max_diff), rng)
+               for _ in range(args.queries)]
+
+    print("index\tbuild (s)\tsearch (s)\tcandidates\tmatches")
+    for name in sorted(INDEX):
+        started = time.time()
+        if INDEX[name] is pseq.PigeonholeStore:
+            store = pseq.PigeonholeStore.from_list(uids, tag_size=0, max_diff=args.max_diff,
+                                                   packed=args.packed)
+            built = time.time()
+            candidates = [store.search(query, raw=True) for query in queries]
+        else:
+            store = INDEX[name].from_list(uids, packed=args.packed)
+            built = time.time()
+            candidates = [store.search(query, args.max_diff, raw=True) for query in queries]
+        searched = time.time()
+        total = sum(len(cand) for cand in candidates)
+        matches = sum(1 for (query, cand) in zip(queries, candidates) for seq in cand
+                      if pseq.SequenceStore.diff(query, seq) <= args.max_diff)
+        print("%s\t%.2f\t%.2f\t%.1f\t%.1f" % (name, built - started, searched - built,
+                                            total/float(len(queries)),
+                                            matches/float(len(queries))))
+
+if __name__ == '__main__':
+    main()
@@ -31,9 +31,11 @@ setup(
     license="MIT",
     keywords="sequencing error-correction consensus fastq",
     url="https://github.com/humburg/pirates",
-    packages=['pyrates'],
+    packages=['pyrates', 'pyrates.bench'],
     entry_points={
-        "console_scripts":['pyrates = pyrates.cmd_consensus:main']
+        "console_scripts":['pyrates = pyrates.cmd_consensus:main',
+                           'pyrates-bench = pyrates.bench.runner:main',
+                           'pyrates-fetch = pyrates.index:main']
     },
     long_description=read('README.md'),
     classifiers=[
@@ -41,7 +43,9 @@ setup(
         "Topic :: Scientific/Engineering :: Bio-Informatics",
         "Intended Audience :: Science/Research",
         "License :: OSI Approved :: MIT License",
+        "Programming Language :: Python :: 3 :: Only",
     ],
+    python_requires='>=3.7',
     install_requires=dependencies('requirements.txt'),
     test_suite='nose2.collector.collector',
 )